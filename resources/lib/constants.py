@@ -123,6 +123,18 @@ PIL_RESIZE_METHODS = {
     5: 1,  # PIL.Image.LANCZOS
 }
 
+DETECTOR_STORAGE_FILES = 0
+DETECTOR_STORAGE_DATABASE = 1
+DETECTOR_DATABASE = 'hashes.db'
+DETECTOR_CACHE_LIMIT = 16 * 1024 * 1024
+DETECTOR_PRECOMPUTE_LIMIT = 4 * 1024 * 1024
+DETECTOR_DEBUG_SAVE_QUEUE_SIZE = 64
+DETECTOR_PROFILE = 'capture_profile.json'
+DETECTOR_PROFILE_PROPERTY_NAME = 'UpNext.Detector.Profile'
+DETECTOR_METRICS = 'detector_metrics.json'
+DETECTOR_METRICS_PROPERTY_NAME = 'UpNext.Detector.Metrics'
+DETECTOR_TRACE_SUFFIX = '.trace'
+
 IDLE_STATE = {
     'sleeping': 0,
     'idle': 1,
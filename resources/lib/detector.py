@@ -3,8 +3,15 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import gzip
 import json
+import struct
 import timeit
+import zlib
+from binascii import hexlify, unhexlify
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from functools import partial
 
 import constants
 import file_utils
@@ -26,6 +33,257 @@ except ImportError:
         Full as QueueFull,
     )
 
+try:
+    import multiprocessing
+    from multiprocessing import shared_memory
+except ImportError:
+    multiprocessing = None
+    shared_memory = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(value):
+        return bin(value).count('1')
+
+
+class UpNextHash(object):
+    """Class to store an image hash as integer bitmasks of set and ignored bits,
+       ordered from the first (most significant) to the last pixel"""
+
+    __slots__ = (
+        'bits',
+        'ignored',
+        'unset',
+        'size',
+        'num_set',
+        'num_ignored',
+        'num_unset',
+        '_coarse',
+    )
+
+    def __init__(self, bits=0, size=0, ignored=0):
+        self.bits = bits & ~ignored
+        self.ignored = ignored
+        self.unset = ((1 << size) - 1) & ~(bits | ignored)
+        self.size = size
+        self.num_set = _popcount(self.bits)
+        self.num_ignored = _popcount(ignored)
+        self.num_unset = _popcount(self.unset)
+        self._coarse = None
+
+    def __eq__(self, other):
+        if not isinstance(other, UpNextHash):
+            return False
+        return (self.size == other.size
+                and self.bits == other.bits
+                and self.ignored == other.ignored)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.bits, self.ignored, self.size))
+
+    def __iter__(self):
+        for bit, ignored in zip(bin(self.bits)[2:].zfill(self.size),
+                                bin(self.ignored)[2:].zfill(self.size)):
+            yield None if ignored == '1' else 1 if bit == '1' else 0
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_tuple(cls, image_hash):
+        """Pack a tuple of 1/0/None pixel values into a new hash"""
+
+        if not image_hash:
+            return cls()
+
+        return cls(
+            bits=int(''.join(['1' if bit else '0' for bit in image_hash]), 2),
+            size=len(image_hash),
+            ignored=int(''.join([
+                '1' if bit is None else '0' for bit in image_hash
+            ]), 2)
+        )
+
+    @classmethod
+    def from_bytes(cls, packed_hash, size):
+        """Unpack a hash from big-endian bytes, as written by to_bytes"""
+
+        return cls(int(hexlify(packed_hash), 16), size)
+
+    def to_bytes(self):
+        """Pack set bits into the minimum number of big-endian bytes"""
+
+        return unhexlify('{0:0{1}x}'.format(
+            self.bits, 2 * ((self.size + 7) // 8)
+        ))
+
+    def to_tuple(self):
+        return tuple(self)
+
+    def coarse(self, width):
+        """Returns the next level of a hash pyramid, at half the width and
+           height of this hash, where each bit is set if any bit in the
+           corresponding 2x2 block is set, and is ignored if any bit in the
+           block is ignored. Cached for re-use by repeated comparisons"""
+
+        if self._coarse and self._coarse[0] == width:
+            return self._coarse[1]
+
+        row_mask = (1 << width) - 1
+        # Odd widths are padded with an unset column
+        padding = width % 2
+        num_rows = self.size // width
+        coarse_bits = 0
+        coarse_ignored = 0
+        for row in range(0, num_rows, 2):
+            # Combine pairs of rows, odd heights use the last row on its own
+            num_combined = min(2, num_rows - row)
+            shift = self.size - (row + num_combined) * width
+            row_bits = 0
+            row_ignored = 0
+            for _ in range(num_combined):
+                row_bits |= (self.bits >> shift) & row_mask
+                row_ignored |= (self.ignored >> shift) & row_mask
+                shift += width
+            row_bits <<= padding
+            row_ignored <<= padding
+            for column in range(width + padding - 2, -1, -2):
+                block_mask = 3 << column
+                coarse_bits = (coarse_bits << 1) | (
+                    1 if row_bits & block_mask else 0
+                )
+                coarse_ignored = (coarse_ignored << 1) | (
+                    1 if row_ignored & block_mask else 0
+                )
+
+        coarse = UpNextHash(coarse_bits,
+                            ((num_rows + 1) // 2) * ((width + 1) // 2),
+                            coarse_ignored)
+        self._coarse = (width, coarse)
+        return coarse
+
+
+class UpNextHashDatabase(object):
+    """Class to save/load hashes, for all groups of videos, in a single SQLite
+       database using write-ahead logging to allow concurrent readers"""
+
+    __slots__ = (
+        '_connection',
+        'filename',
+    )
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS groups ('
+        ' group_name TEXT PRIMARY KEY,'
+        ' version REAL NOT NULL,'
+        ' hash_width INTEGER NOT NULL,'
+        ' hash_height INTEGER NOT NULL'
+        ');'
+        'CREATE TABLE IF NOT EXISTS hashes ('
+        ' group_name TEXT NOT NULL,'
+        ' group_idx INTEGER NOT NULL,'
+        ' end_time INTEGER NOT NULL,'
+        ' start_time INTEGER NOT NULL,'
+        ' hash BLOB NOT NULL,'
+        ' PRIMARY KEY (group_name, group_idx, end_time, start_time)'
+        ') WITHOUT ROWID;'
+        'CREATE TABLE IF NOT EXISTS timestamps ('
+        ' group_name TEXT NOT NULL,'
+        ' group_idx INTEGER NOT NULL,'
+        ' timestamp REAL,'
+        ' PRIMARY KEY (group_name, group_idx)'
+        ') WITHOUT ROWID;'
+    )
+
+    def __init__(self, filename=None):
+        self.filename = filename or file_utils.get_legal_filename(
+            constants.DETECTOR_DATABASE, prefix=SETTINGS.detector_save_path
+        )
+        self._connection = sqlite3.connect(self.filename, timeout=5)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self._SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @classmethod
+    def is_available(cls):
+        return sqlite3 is not None
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def load(self, group_name):
+        """Returns a tuple of (version, hash_size, timestamps, data) for all
+           episodes in group_name, or None if the group has not been stored"""
+
+        connection = self._connection
+        group = connection.execute(
+            'SELECT version, hash_width, hash_height FROM groups'
+            ' WHERE group_name = ?',
+            (group_name, )
+        ).fetchone()
+        if not group:
+            return None
+
+        version, hash_width, hash_height = group
+        hash_size = hash_width * hash_height
+
+        timestamps = dict(connection.execute(
+            'SELECT group_idx, timestamp FROM timestamps WHERE group_name = ?',
+            (group_name, )
+        ))
+        data = {
+            (end_time, start_time, group_idx):
+                UpNextHash.from_bytes(packed_hash, hash_size)
+            for group_idx, end_time, start_time, packed_hash
+            in connection.execute(
+                'SELECT group_idx, end_time, start_time, hash FROM hashes'
+                ' WHERE group_name = ?',
+                (group_name, )
+            )
+        }
+
+        return version, [hash_width, hash_height], timestamps, data
+
+    def save(self, group_name, version, hash_size, timestamps, data):
+        """Insert or update group details and timestamps, and insert new
+           hashes in a single transaction"""
+
+        with self._connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO groups VALUES (?, ?, ?, ?)',
+                (group_name, version, hash_size[0], hash_size[1])
+            )
+            connection.executemany(
+                'INSERT OR REPLACE INTO timestamps VALUES (?, ?, ?)',
+                [(group_name, group_idx, timestamp)
+                 for group_idx, timestamp in timestamps.items()
+                 if group_idx is not None]
+            )
+            connection.executemany(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                [(group_name, hash_index[2], hash_index[0], hash_index[1],
+                  sqlite3.Binary(image_hash.to_bytes()))
+                 for hash_index, image_hash in data.items()
+                 if hash_index[-1] != constants.UNDEFINED]
+            )
+
 
 class UpNextHashStore(object):
     """Class to store/save/load hashes used by UpNextDetector"""
@@ -36,36 +294,157 @@ class UpNextHashStore(object):
         'group_name',
         'group_idx',
         'data',
-        'timestamps'
+        'timestamps',
+        'limit',
+        '_index',
+        '_lock',
+        '_modified',
+        '_recent'
     )
 
+    # (magic, version, hash_width, hash_height, num_timestamps, num_records)
+    _HEADER = struct.Struct('<4sdHHII')
+    _MAGIC = b'UNHS'
+    # (group_idx, timestamp)
+    _TIMESTAMP = struct.Struct('<id')
+    # Learned credits template is stored as two hash records, of the template
+    # bits and of the ignored bits, using a reserved group_idx
+    _TEMPLATE_BITS = (0, 0, -2)
+    _TEMPLATE_IGNORED = (0, 1, -2)
+    # Minimum number of episodes with detected credits to learn a template
+    _TEMPLATE_MIN_EPISODES = 3
+    # Minimum proportion of hashes that must agree for a bit to be used
+    _TEMPLATE_CONFIDENCE = 0.8
+    # Minimum proportion of bits that must be used for a valid template
+    _TEMPLATE_SIGNIFICANCE = 0.25
+
     def __init__(self, **kwargs):
         self.version = kwargs.get('version', 0.2)
         self.hash_size = kwargs.get('hash_size', (8, 8))
         item = kwargs.get('item', {})
         self.group_name = item.get('group_name', '')
         self.group_idx = item.get('group_idx') or constants.UNDEFINED
-        self.data = kwargs.get('data', {})
+        # Hashes are added by multiple detector worker threads
+        self._lock = utils.create_lock()
+        self.data = {}
+        self._index = {}
+        self._modified = set()
+        # Maximum number of hashes to retain, oldest first, of those added
+        # after the limit was set. Hashes added without a limit are kept.
+        self.limit = None
+        self._recent = deque()
+        self.update(kwargs.get('data', {}))
         self.timestamps = kwargs.get('timestamps', {self.group_idx: None})
+        self.set_limit(kwargs.get('limit'))
 
-    @staticmethod
-    def int_to_hash(val, hash_size):
-        return tuple([  # pylint: disable=consider-using-generator
-            1 if bit_val == "1" else 0
-            for bit_val in bin(val)[2:].zfill(hash_size)
-        ])
+    def _index_add(self, hash_index):
+        end_time, start_time, episode = hash_index
 
-    @staticmethod
-    def hash_to_int(image_hash):
-        return sum(
-            (bit_val or 0) << i
-            for i, bit_val in enumerate(reversed(image_hash))
-        )
+        index = self._index.get(episode)
+        if index is None:
+            # Sorted lists of (start_time, end_time) and (end_time, start_time)
+            index = self._index[episode] = ([], [])
+
+        insort(index[0], (start_time, end_time))
+        insort(index[1], (end_time, start_time))
+
+    def _index_remove(self, hash_index):
+        end_time, start_time, episode = hash_index
+
+        index = self._index.get(episode)
+        if index is None:
+            return
+
+        for sorted_list, key in ((index[0], (start_time, end_time)),
+                                 (index[1], (end_time, start_time))):
+            idx = bisect_left(sorted_list, key)
+            if idx < len(sorted_list) and sorted_list[idx] == key:
+                del sorted_list[idx]
+        if not index[0]:
+            del self._index[episode]
+
+    def _trim(self):
+        if self.limit is None:
+            return
+
+        while len(self._recent) > self.limit:
+            self._discard(self._recent.popleft())
+
+    def _add(self, hash_index, image_hash):
+        if hash_index not in self.data:
+            self._index_add(hash_index)
+            if self.limit is not None:
+                self._recent.append(hash_index)
+        self.data[hash_index] = image_hash
+        self._modified.add(hash_index)
+
+    def _discard(self, hash_index):
+        if self.data.pop(hash_index, None) is None:
+            return
+        self._index_remove(hash_index)
+        self._modified.discard(hash_index)
+
+    def __getstate__(self):
+        # Lock can not be pickled, to pass hash stores to other processes
+        return {
+            attr: getattr(self, attr)
+            for attr in self.__slots__
+            if attr != '_lock' and hasattr(self, attr)
+        }
+
+    def __setstate__(self, state):
+        self._lock = utils.create_lock()
+        for attr, value in state.items():
+            setattr(self, attr, value)
 
     @classmethod
     def log(cls, msg, level=utils.LOGDEBUG):
         utils.log(msg, name=cls.__name__, level=level)
 
+    def add(self, hash_index, image_hash):
+        """Store a hash and add its timestamps to the time index"""
+
+        with self._lock:
+            self._add(hash_index, image_hash)
+            self._trim()
+
+    def discard(self, hash_index):
+        """Remove a hash, if stored, and its timestamps from the time index"""
+
+        with self._lock:
+            self._discard(hash_index)
+
+    def set_limit(self, limit):
+        """Retain at most limit hashes, as a rolling window of the most
+           recently added hashes. Older hashes are discarded as new hashes are
+           added. Hashes already stored before a limit is first set, such as
+           representative hashes, are not counted or discarded. Set to None to
+           stop discarding hashes"""
+
+        with self._lock:
+            self.limit = limit
+            self._trim()
+
+    def replace(self, data):
+        """Replace all stored hashes with hashes that have already been saved"""
+
+        with self._lock:
+            self.data = {}
+            self._index = {}
+            self._recent = deque()
+            for hash_index, image_hash in data.items():
+                self._add(hash_index, image_hash)
+            self._trim()
+            self._modified = set()
+
+    def update(self, data):
+        """Store multiple hashes from a dict of hash_index: image_hash"""
+
+        with self._lock:
+            for hash_index, image_hash in data.items():
+                self._add(hash_index, image_hash)
+            self._trim()
+
     def is_valid(self, item=None, for_saving=False):
         if item:
             group_name = item.get('group_name')
@@ -93,101 +472,1274 @@ class UpNextHashStore(object):
         # New video is being played, invalidate old hashes
         return False
 
-    def invalidate(self):
-        self.group_name = ''
-        self.group_idx = constants.UNDEFINED
+    def invalidate(self):
+        self.group_name = ''
+        self.group_idx = constants.UNDEFINED
+
+    def _decode(self, data):  # pylint: disable=too-many-locals
+        """Read hashes from the binary format written by _encode"""
+
+        (magic, version, hash_width, hash_height,
+         num_timestamps, num_records) = self._HEADER.unpack_from(data)
+        if magic != self._MAGIC:
+            raise ValueError('Invalid header')
+        offset = self._HEADER.size
+
+        timestamps = {}
+        for _ in range(num_timestamps):
+            group_idx, timestamp = self._TIMESTAMP.unpack_from(data, offset)
+            offset += self._TIMESTAMP.size
+            # NaN is used to store a timestamp of None
+            timestamps[group_idx] = (
+                None if timestamp != timestamp else timestamp  # pylint: disable=comparison-with-itself
+            )
+
+        hash_size = hash_width * hash_height
+        record = self._record_format(hash_size)
+        hashes = {}
+        for _ in range(num_records):
+            end_time, start_time, group_idx, packed_hash = record.unpack_from(
+                data, offset
+            )
+            offset += record.size
+            hashes[(end_time, start_time, group_idx)] = UpNextHash.from_bytes(
+                packed_hash, hash_size
+            )
+
+        self.version = version
+        self.hash_size = [hash_width, hash_height]
+        self.timestamps = timestamps
+        self.replace(hashes)
+
+    def _encode(self):
+        """Write hashes to a binary format consisting of a fixed size header
+           followed by timestamp records and then hash records"""
+
+        hash_width, hash_height = self.hash_size
+        hash_size = hash_width * hash_height
+        record = self._record_format(hash_size)
+
+        timestamps = [
+            self._TIMESTAMP.pack(
+                group_idx, float('nan') if timestamp is None else timestamp
+            )
+            for group_idx, timestamp in self.timestamps.items()
+            if group_idx is not None
+        ]
+        records = [
+            record.pack(
+                hash_index[0], hash_index[1], hash_index[2],
+                image_hash.to_bytes()
+            )
+            for hash_index, image_hash in self.data.items()
+            if hash_index[-1] != constants.UNDEFINED
+        ]
+
+        return b''.join([self._HEADER.pack(
+            self._MAGIC, self.version, hash_width, hash_height,
+            len(timestamps), len(records)
+        )] + timestamps + records)
+
+    def _load_json(self, identifier):
+        """Read hashes from legacy JSON files, with tuple keys stored as str"""
+
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.json'
+        )
+        try:
+            with open(target, mode='r', encoding='utf-8') as target_file:
+                hashes = json.load(target_file)
+        except (IOError, OSError, TypeError, ValueError):
+            self.log('Could not load stored hashes from {0}'.format(target))
+            return False
+
+        if not hashes:
+            return False
+
+        self.version = float(hashes.get('version', self.version))
+        self.hash_size = hashes.get('hash_size', self.hash_size)
+        if 'data' in hashes:
+            hash_size = self.hash_size[0] * self.hash_size[1]
+            self.replace({
+                # pylint: disable-next=consider-using-generator
+                tuple([utils.get_int(i) for i in key[1:-1].split(', ')]):
+                    UpNextHash(hashes['data'][key], hash_size)
+                for key in hashes['data']
+            })
+        if 'timestamps' in hashes:
+            self.timestamps = {
+                utils.get_int(group_idx):
+                    hashes['timestamps'][group_idx]
+                for group_idx in hashes['timestamps']
+                if group_idx != 'null'
+            }
+
+        self.log('Hashes loaded from {0}'.format(target))
+        return True
+
+    @staticmethod
+    def _record_format(hash_size):
+        # (end_time, start_time, group_idx, packed hash bytes)
+        return struct.Struct('<iii{0}s'.format((hash_size + 7) // 8))
+
+    def _load_database(self, identifier):
+        try:
+            with UpNextHashDatabase() as database:
+                hashes = database.load(identifier)
+        except sqlite3.Error as error:
+            self.log('Could not load stored hashes for {0}: {1}'.format(
+                identifier, error
+            ), utils.LOGWARNING)
+            return False
+
+        if not hashes:
+            self.log('No stored hashes for {0}'.format(identifier))
+            return False
+
+        self.version, self.hash_size, self.timestamps, hashes = hashes
+        self.replace(hashes)
+
+        self.log('Hashes loaded from database for {0}'.format(identifier))
+        return True
+
+    def _save_database(self, identifier):
+        try:
+            with UpNextHashDatabase() as database:
+                database.save(
+                    identifier,
+                    self.version,
+                    self.hash_size,
+                    self.timestamps,
+                    {hash_index: self.data[hash_index]
+                     for hash_index in self._modified},
+                )
+        except sqlite3.Error as error:
+            self.log('Could not save hashes for {0}: {1}'.format(
+                identifier, error
+            ), utils.LOGWARNING)
+            return False
+
+        self.log('{0} new hashes saved to database for {1}'.format(
+            len(self._modified), identifier
+        ))
+        self._modified = set()
+        return True
+
+    @staticmethod
+    def _use_database():
+        return (SETTINGS.detector_storage == constants.DETECTOR_STORAGE_DATABASE
+                and UpNextHashDatabase.is_available())
+
+    def load(self, identifier):
+        if self._use_database():
+            if self._load_database(identifier):
+                return True
+            # Migrate hashes stored in files, if any, on next save
+            if self._load_file(identifier):
+                self._modified = set(self.data)
+                return True
+            return False
+
+        return self._load_file(identifier)
+
+    def _load_file(self, identifier):
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.bin'
+        )
+        try:
+            with open(target, mode='rb') as target_file:
+                self._decode(target_file.read())
+        except (IOError, OSError, TypeError, ValueError, struct.error):
+            self.log('Could not load stored hashes from {0}'.format(target))
+            # Fallback to hashes stored by previous versions
+            return self._load_json(identifier)
+
+        self.log('Hashes loaded from {0}'.format(target))
+        return True
+
+    def save(self, identifier):
+        if self._use_database():
+            return self._save_database(identifier)
+
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.bin'
+        )
+        try:
+            file_utils.write_atomic(target, self._encode())
+            self.log('Hashes saved to {0}'.format(target))
+        except (IOError, OSError, TypeError, ValueError, struct.error):
+            self.log('Could not save hashes to {0}'.format(target),
+                     utils.LOGWARNING)
+            return False
+
+        self._modified = set()
+        return True
+
+    def estimate_credits_start(self, total_time, lead=0):
+        """Estimate the earliest time, from start of file, at which end
+           credits are expected to be detected, based on timestamps detected in
+           other episodes. Uses either the time to end of file or the time
+           relative to the runtime of each episode, whichever is more
+           consistent across episodes. Returns None if no estimate can be
+           made"""
+
+        from_end = []
+        relative = []
+        for group_idx, timestamp in self.timestamps.items():
+            if timestamp is None or group_idx not in self._index:
+                continue
+
+            # Runtime of episode is obtained from the stored hash index that
+            # corresponds to the detected timestamp
+            by_start_time = self._index[group_idx][0]
+            start_time = int(timestamp)
+            idx = bisect_left(by_start_time, (start_time, ))
+            if idx == len(by_start_time) or by_start_time[idx][0] != start_time:
+                continue
+            runtime = start_time + by_start_time[idx][1]
+            if runtime <= 0:
+                continue
+
+            from_end.append(total_time - (runtime - timestamp))
+            relative.append(total_time * timestamp / runtime)
+
+        if not from_end:
+            return None
+
+        if max(from_end) - min(from_end) <= max(relative) - min(relative):
+            estimate = min(from_end)
+        else:
+            estimate = min(relative)
+        return max(0, estimate - lead)
+
+    def get_template(self):
+        """Returns the learned credits template as a hash with ignored bits, or
+           None if a template has not been learned"""
+
+        template = self.data.get(self._TEMPLATE_BITS)
+        ignored = self.data.get(self._TEMPLATE_IGNORED)
+        if not template or not ignored or template.size != ignored.size:
+            return None
+
+        return UpNextHash(template.bits, template.size, ignored.bits)
+
+    def learn_template(self, size=SETTINGS.detect_matches):
+        """Learn a credits template from the hashes stored around the detected
+           credits timestamp of each episode. Each bit of the template is the
+           majority value of that bit, or is ignored if there is not enough
+           agreement between hashes. Returns the template, or None if it could
+           not be learned"""
+
+        hashes = []
+        num_episodes = 0
+        for group_idx, timestamp in self.timestamps.items():
+            if timestamp is None or group_idx not in self._index:
+                continue
+
+            by_start_time = self._index[group_idx][0]
+            detected_at = int(timestamp)
+            window = [
+                self.data[(end_time, start_time, group_idx)]
+                for start_time, end_time in by_start_time[
+                    bisect_left(by_start_time, (detected_at - size, )):
+                    bisect_right(by_start_time,
+                                 (detected_at + size, float('inf')))
+                ]
+            ]
+            if window:
+                hashes += window
+                num_episodes += 1
+
+        if num_episodes < self._TEMPLATE_MIN_EPISODES:
+            return None
+        num_bits = self.hash_size[0] * self.hash_size[1]
+        hashes = [image_hash for image_hash in hashes
+                  if image_hash.size == num_bits]
+        if not hashes:
+            return None
+
+        min_count = self._TEMPLATE_CONFIDENCE * len(hashes)
+        template = []
+        for column in zip(*[image_hash.to_tuple() for image_hash in hashes]):
+            if column.count(1) >= min_count:
+                template.append(1)
+            elif column.count(0) >= min_count:
+                template.append(0)
+            else:
+                template.append(None)
+
+        template = UpNextHash.from_tuple(template)
+        if (template.size - template.num_ignored
+                < self._TEMPLATE_SIGNIFICANCE * template.size):
+            return None
+
+        if template != self.get_template():
+            self.add(self._TEMPLATE_BITS, UpNextHash(template.bits, num_bits))
+            self.add(self._TEMPLATE_IGNORED,
+                     UpNextHash(template.ignored, num_bits))
+        return template
+
+    def restore_modified(self, snapshot):
+        """Mark hashes from a snapshot of this store, that could not be saved,
+           as modified again so that they are included in the next save"""
+
+        with self._lock:
+            self._modified.update(
+                hash_index
+                for hash_index in snapshot._modified  # pylint: disable=protected-access
+                if hash_index in self.data
+            )
+
+    def snapshot(self):
+        """Returns a copy of stored hashes and timestamps, without the time
+           index, that can be saved while this store continues to be used.
+           Modified hashes are only included in the snapshot, and must be
+           restored to this store if the snapshot can not be saved"""
+
+        output = self.__class__(
+            version=self.version,
+            hash_size=self.hash_size,
+            timestamps=dict(self.timestamps),
+        )
+        output.group_name = self.group_name
+        output.group_idx = self.group_idx
+        with self._lock:
+            output.data = dict(self.data)
+            output._modified = self._modified  # pylint: disable=protected-access
+            self._modified = set()
+        return output
+
+    def window(self, hash_index,  # pylint: disable=too-many-locals
+               size=SETTINGS.detect_matches, all_episodes=False):
+        """Get sets of hashes, either from all episodes or only from the first
+        and last episodes, where the timestamps are approximately equal (+/- an
+        adjustable offset) to the timestamps of the reference hash index"""
+
+        end_time, start_time, episode = hash_index
+
+        if all_episodes:
+            excluded_episodes = [constants.UNDEFINED]
+            selected_episodes = self.timestamps.keys()
+        else:
+            excluded_episodes = [constants.UNDEFINED, episode]
+            selected_episodes = {min(self.timestamps), max(self.timestamps)}
+
+        # Matching time period from start of file
+        min_start_time = (start_time - size, )
+        max_start_time = (start_time + size, float('inf'))
+        # Matching time period from end of file
+        min_end_time = (end_time - size, )
+        max_end_time = (end_time + size, float('inf'))
+
+        output = {}
+        for group_idx in selected_episodes:
+            if group_idx in excluded_episodes or group_idx not in self._index:
+                continue
+            by_start_time, by_end_time = self._index[group_idx]
+
+            for start_time, end_time in by_start_time[
+                    bisect_left(by_start_time, min_start_time):
+                    bisect_right(by_start_time, max_start_time)
+            ]:
+                hash_index = (end_time, start_time, group_idx)
+                output[hash_index] = self.data[hash_index]
+
+            for end_time, start_time in by_end_time[
+                    bisect_left(by_end_time, min_end_time):
+                    bisect_right(by_end_time, max_end_time)
+            ]:
+                hash_index = (end_time, start_time, group_idx)
+                output[hash_index] = self.data[hash_index]
+
+        return output
+
+
+class UpNextHashWriter(object):
+    """Class to save hash stores in a background thread. Repeated saves of the
+       same group, that are waiting to be written, are combined into one"""
+
+    __slots__ = (
+        '_active',
+        '_lock',
+        '_pending',
+        '_queue',
+        '_thread',
+    )
+
+    def __init__(self, maxsize=8):
+        self._active = None
+        self._lock = utils.create_lock()
+        self._pending = {}
+        self._queue = Queue(maxsize=maxsize)
+        self._thread = None
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    def _run(self):
+        while True:
+            identifier = self._queue.get()
+            if identifier is None:
+                self._queue.task_done()
+                break
+
+            with self._lock:
+                snapshot, hash_store = self._pending.pop(
+                    identifier, (None, None)
+                )
+                self._active = identifier
+            # Retry saving hashes that could not be saved with the next save
+            if snapshot and not snapshot.save(identifier):
+                hash_store.restore_modified(snapshot)
+            with self._lock:
+                self._active = None
+            self._queue.task_done()
+
+    def is_pending(self, identifier):
+        with self._lock:
+            return identifier in self._pending or identifier == self._active
+
+    def flush(self):
+        """Wait until all queued hash stores have been saved"""
+
+        if self._thread and self._thread.is_alive():
+            self._queue.join()
+
+    def push(self, identifier, hash_store):
+        """Queue a snapshot of hash_store to be saved in the background"""
+
+        snapshot = hash_store.snapshot()
+        with self._lock:
+            pending = self._pending.get(identifier)
+            self._pending[identifier] = snapshot, hash_store
+            if pending:
+                # pylint: disable-next=protected-access
+                snapshot._modified |= pending[0]._modified
+                self.log('Combined with queued save of {0}'.format(identifier))
+                return
+
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = utils.run_threaded(self._run)
+
+        # Blocks if too many groups are waiting to be saved
+        self._queue.put(identifier)
+
+    def stop(self):
+        """Save all queued hash stores and then stop the writer thread"""
+
+        if not (self._thread and self._thread.is_alive()):
+            return
+
+        self._queue.put(None)
+        self._queue.join()
+        self._thread.join()
+        self._thread = None
+        self.log('Stopped')
+
+    def wait(self, identifier):
+        """Wait until any queued save of identifier has been written"""
+
+        if self.is_pending(identifier):
+            self.log('Waiting for queued save of {0}'.format(identifier))
+            self.flush()
+
+
+HASH_WRITER = UpNextHashWriter()
+
+
+class UpNextHashCache(object):
+    """Class to keep recently used hash stores in memory, keyed by group name,
+       so that consecutive episodes of a group are not reloaded from disk.
+       Least recently used stores are discarded once the approximate memory
+       used exceeds the limit (in bytes)"""
+
+    __slots__ = (
+        '_cache',
+        '_lock',
+        'limit',
+        'size',
+    )
+
+    # Approximate memory used by each stored hash, excluding hash bits
+    _ENTRY_SIZE = 400
+
+    def __init__(self, limit):
+        self._cache = OrderedDict()
+        self._lock = utils.create_lock()
+        self.limit = limit
+        self.size = 0
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    @classmethod
+    def _estimate_size(cls, hash_store):
+        hash_width, hash_height = hash_store.hash_size
+        return len(hash_store.data) * (
+            cls._ENTRY_SIZE + (hash_width * hash_height) // 8
+        )
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.size = 0
+
+    def get(self, identifier):
+        with self._lock:
+            cached = self._cache.pop(identifier, None)
+            if not cached:
+                return None
+            # Re-insert as most recently used
+            self._cache[identifier] = cached
+
+        self.log('Using cached hashes for {0}'.format(identifier))
+        return cached[0]
+
+    def put(self, identifier, hash_store):
+        """Add or update hash_store and discard least recently used stores,
+           always keeping at least the most recent store"""
+
+        size = self._estimate_size(hash_store)
+        with self._lock:
+            cached = self._cache.pop(identifier, None)
+            if cached:
+                self.size -= cached[1]
+            self._cache[identifier] = (hash_store, size)
+            self.size += size
+
+            while self.size > self.limit and len(self._cache) > 1:
+                _, (_, discarded_size) = self._cache.popitem(last=False)
+                self.size -= discarded_size
+
+
+HASH_CACHE = UpNextHashCache(constants.DETECTOR_CACHE_LIMIT)
+
+
+class UpNextCaptureController(object):
+    """Class to adjust the capture interval and capture data limit, based on
+       the measured time taken to process each captured frame, so that the
+       detector stays within a CPU budget (as a fraction of a single core)"""
+
+    __slots__ = (
+        '_lock',
+        'budget',
+        'data_limit',
+        'interval',
+        'latency',
+        'max_data_limit',
+        'min_interval',
+        'max_interval',
+        'sparse_interval',
+    )
+
+    # Data limit (in kB) is adjusted in steps of the same size used in settings
+    _DATA_LIMIT_STEP = 8
+    # Weighting of the latest measurement in the moving average of latency
+    _SMOOTHING = 0.2
+
+    def __init__(self, min_interval, budget, data_limit, max_data_limit=None):
+        self._lock = utils.create_lock()
+        self.budget = budget / 100
+        self.data_limit = data_limit
+        self.max_data_limit = max_data_limit or data_limit
+        self.interval = min_interval
+        self.latency = None
+        self.min_interval = min_interval
+        self.max_interval = 4 * min_interval
+        self.sparse_interval = 2 * min_interval
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    def record(self, latency):
+        """Record time taken to process a captured frame"""
+
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self._SMOOTHING * (latency - self.latency)
+
+    def update(self, queue_depth, queue_size, sparse=False):
+        """Returns a tuple of the next capture interval and data limit. Sparse
+           sampling is used when end credits are not expected to be playing"""
+
+        with self._lock:
+            latency = self.latency
+        if latency is None:
+            return self.interval, self.data_limit
+
+        # Minimum interval between captures to limit CPU usage to the budget
+        interval = latency / self.budget
+        # Captured frames are not being processed fast enough, back off
+        if queue_depth >= queue_size:
+            interval = max(interval, 1.5 * self.interval)
+
+        # Reduce amount of data captured if the interval is too long, or
+        # increase amount of data if there is sufficient spare capacity
+        data_limit = self.data_limit
+        if (interval > self.max_interval
+                and data_limit > self._DATA_LIMIT_STEP):
+            data_limit -= self._DATA_LIMIT_STEP
+        elif (interval < self.min_interval / 2
+              and data_limit < self.max_data_limit):
+            data_limit += self._DATA_LIMIT_STEP
+
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if sparse:
+            interval = max(interval, self.sparse_interval)
+
+        if interval != self.interval or data_limit != self.data_limit:
+            self.log(('Capture interval: {0:.2f}s, data limit: {1}kB,'
+                      ' latency: {2:.3f}s').format(
+                interval, data_limit, latency
+            ))
+        self.interval = interval
+        self.data_limit = data_limit
+        return interval, data_limit
+
+
+class UpNextCaptureProfile(object):
+    """Class to choose the initial capture data limit from the measured time
+       taken to process frames captured using increasing data limits.
+       Measurements are cached per device, in the addon profile, and re-used
+       while the detector configuration is unchanged"""
+
+    __slots__ = (
+        '_lock',
+        'config',
+        'data_limit',
+        'filename',
+        'latencies',
+        'target_latency',
+    )
+
+    # Smallest data limit (in kB), as used in settings
+    _DATA_LIMIT_STEP = 8
+    # Number of times processing is timed for each data limit. The fastest
+    # time is used to exclude one-off setup costs
+    _NUM_SAMPLES = 3
+    _VERSION = 1
+
+    def __init__(self):
+        self._lock = utils.create_lock()
+        self.config = None
+        self.data_limit = None
+        self.filename = None
+        self.latencies = {}
+        self.target_latency = None
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    def load(self, config):
+        """Load cached measurements, unless already loaded, discarding any
+           measurements made using a different detector configuration"""
+
+        filename = file_utils.get_legal_filename(
+            constants.DETECTOR_PROFILE, prefix=SETTINGS.detector_save_path
+        ) if SETTINGS.detector_save_path else None
+        if filename == self.filename and config == self.config:
+            return
+
+        self.config = config
+        self.filename = filename
+        self.latencies = {}
+        if not filename:
+            return
+
+        try:
+            with open(filename, mode='r', encoding='utf-8') as profile_file:
+                profile = json.load(profile_file)
+        except (IOError, OSError, TypeError, ValueError):
+            self.log('Could not load capture profile from {0}'.format(
+                filename
+            ))
+            return
+
+        if (profile.get('version') != self._VERSION
+                or profile.get('config') != config):
+            self.log('Capture profile outdated')
+            return
+
+        self.latencies = {
+            utils.get_int(data_limit): latency
+            for data_limit, latency in profile.get('latencies', {}).items()
+        }
+
+    def save(self):
+        if not self.filename:
+            return False
+
+        profile = json.dumps({
+            'version': self._VERSION,
+            'config': self.config,
+            'latencies': self.latencies,
+        }, indent=4, sort_keys=True)
+        try:
+            file_utils.write_atomic(self.filename, profile.encode('utf-8'))
+        except (IOError, OSError, TypeError, ValueError):
+            self.log('Could not save capture profile to {0}'.format(
+                self.filename
+            ), utils.LOGWARNING)
+            return False
+        return True
+
+    def calibrate(self, process, max_data_limit, target_latency):
+        """Returns the largest data limit, doubling from 8kB up to
+           max_data_limit, for which the time taken by process(data_limit) is
+           within target_latency. Only data limits that have not already been
+           measured are timed"""
+
+        with self._lock:
+            data_limit = min(self._DATA_LIMIT_STEP, max_data_limit)
+            selected = data_limit
+            modified = False
+            while True:
+                latency = self.latencies.get(data_limit)
+                if latency is None:
+                    latency = min(
+                        self._time(process, data_limit)
+                        for _ in range(self._NUM_SAMPLES)
+                    )
+                    self.latencies[data_limit] = latency
+                    modified = True
+                if latency > target_latency:
+                    break
+                selected = data_limit
+                if data_limit >= max_data_limit:
+                    break
+                data_limit = min(2 * data_limit, max_data_limit)
+
+            self.data_limit = selected
+            self.target_latency = target_latency
+            if modified:
+                self.save()
+
+        self.log(('Capture data limit: {0}kB, target latency: {1:.3f}s,'
+                  ' latencies: {2}').format(
+            selected, target_latency, self.latencies
+        ))
+        utils.set_property(constants.DETECTOR_PROFILE_PROPERTY_NAME,
+                           json.dumps(self.snapshot(), sort_keys=True))
+        return selected
+
+    def snapshot(self):
+        """Returns the selected profile as a dict"""
+
+        return {
+            'data_limit': self.data_limit,
+            'target_latency': self.target_latency,
+            'latencies': {
+                str(data_limit): latency
+                for data_limit, latency in self.latencies.items()
+            },
+        }
+
+    @staticmethod
+    def _time(process, data_limit):
+        start = timeit.default_timer()
+        process(data_limit)
+        return timeit.default_timer() - start
+
+
+CAPTURE_PROFILE = UpNextCaptureProfile()
+
+
+class UpNextFrameBuffer(object):
+    """Fixed size ring of frame slots shared between the capture thread and
+       worker threads. Only the index of a slot is passed through the
+       detector queue, and slots are reused once a frame has been processed,
+       rather than creating a new container for every captured frame"""
+
+    __slots__ = (
+        '_free',
+        'frames',
+        'sizes',
+        'timestamps',
+    )
+
+    def __init__(self, num_frames):
+        self.frames = [None] * num_frames
+        self.sizes = [None] * num_frames
+        self.timestamps = [None] * num_frames
+        self._free = Queue(maxsize=num_frames)
+        for idx in range(num_frames):
+            self._free.put_nowait(idx)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def acquire(self, timeout=None):
+        """Returns index of a free slot. Raises QueueEmpty if no slot becomes
+           free within timeout"""
+
+        return self._free.get(timeout=timeout)
+
+    def captured_at(self, idx):
+        return self.timestamps[idx]
+
+    def get(self, idx):
+        return self.frames[idx], self.sizes[idx]
+
+    def put(self, idx, image_data, size):
+        self.frames[idx] = image_data
+        self.sizes[idx] = size
+        self.timestamps[idx] = timeit.default_timer()
+
+    def release(self, idx):
+        """Drop reference to frame data and return slot to the pool"""
+
+        self.frames[idx] = None
+        try:
+            self._free.put_nowait(idx)
+        except QueueFull:
+            pass
+
+
+class UpNextCaptureTrace(object):
+    """Class to record captured frames and player times to an append-only,
+       compressed trace file, and to read them back so that detection can be
+       replayed without Kodi. Each recording starts with an item record, with
+       details of the playing item, followed by frame records"""
+
+    __slots__ = (
+        '_file',
+        '_lock',
+        'filename',
+    )
+
+    # (version, record_type, play_time, total_time, speed, width, height,
+    #  num_bytes)
+    _RECORD = struct.Struct('<BBdddHHI')
+    _VERSION = 1
+    _ITEM = 0
+    _FRAME = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._lock = utils.create_lock()
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    @staticmethod
+    def get_filename(item):
+        return file_utils.get_legal_filename(
+            '{0}_{1}'.format(item.get('group_name'), item.get('group_idx')),
+            prefix=SETTINGS.detector_save_path,
+            suffix=constants.DETECTOR_TRACE_SUFFIX
+        )
+
+    @classmethod
+    def create(cls, item, resolution):
+        """Open a trace file for the playing item, in the detector save path,
+           and start a new recording. Returns None if not able to be opened"""
+
+        trace = cls(cls.get_filename(item))
+        if not trace.open(item, resolution):
+            return None
+        return trace
+
+    def open(self, item, resolution):
+        try:
+            # Each recording is appended as a new gzip member, so that
+            # existing recordings are never re-written
+            self._file = gzip.open(self.filename, mode='ab', compresslevel=1)
+        except (IOError, OSError):
+            self.log('Could not open trace file {0}'.format(self.filename),
+                     utils.LOGWARNING)
+            return False
+
+        return self._write(self._ITEM, json.dumps({
+            'item': {
+                'group_name': item.get('group_name'),
+                'group_idx': item.get('group_idx'),
+            },
+            'resolution': resolution,
+        }).encode('utf-8'))
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+            self._file = None
+
+    def write(self, image_data, size, play_time, total_time, speed=1):
+        return self._write(self._FRAME, image_data,
+                           play_time, total_time, speed, size)
+
+    # pylint: disable-next=too-many-arguments, too-many-positional-arguments
+    def _write(self, record_type, data,
+               play_time=0, total_time=0, speed=0, size=(0, 0)):
+        with self._lock:
+            if not self._file:
+                return False
+            try:
+                self._file.write(self._RECORD.pack(
+                    self._VERSION, record_type,
+                    play_time, total_time, speed,
+                    size[0], size[1], len(data)
+                ))
+                self._file.write(data)
+            except (IOError, OSError, struct.error):
+                self.log('Could not write to trace file {0}'.format(
+                    self.filename
+                ), utils.LOGWARNING)
+                self._file.close()
+                self._file = None
+                return False
+        return True
+
+    @classmethod
+    def read(cls, filename):
+        """Generator of recorded frames as tuples of (details, play_time,
+           total_time, speed, size, image_data), where details is a dict of
+           the recorded item and video resolution. Reading stops at the end of
+           a recording that was not completely written"""
+
+        details = None
+        with gzip.open(filename, mode='rb') as trace_file:
+            while True:
+                try:
+                    header = trace_file.read(cls._RECORD.size)
+                    if len(header) < cls._RECORD.size:
+                        break
+                    (version, record_type,
+                     play_time, total_time, speed,
+                     width, height, num_bytes) = cls._RECORD.unpack(header)
+                    data = trace_file.read(num_bytes)
+                except (EOFError, IOError, OSError, zlib.error):
+                    cls.log('Trace file {0} truncated'.format(filename),
+                            utils.LOGWARNING)
+                    break
+                if len(data) < num_bytes or version != cls._VERSION:
+                    break
+
+                if record_type == cls._ITEM:
+                    details = json.loads(data.decode('utf-8'))
+                elif record_type == cls._FRAME and details:
+                    yield (details, play_time, total_time, speed,
+                           (width, height), data)
+
+
+class UpNextFrameMemo(object):
+    """Class to keep the hashes and similarity stats of the most recently
+       processed frames, keyed by frame digest, so that static or repeated
+       frames do not need to be processed again"""
+
+    __slots__ = (
+        '_cache',
+        '_lock',
+        'hits',
+        'limit',
+    )
+
+    def __init__(self, limit):
+        self._cache = OrderedDict()
+        self._lock = utils.create_lock()
+        self.hits = 0
+        self.limit = limit
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+
+    def get(self, digest):
+        with self._lock:
+            cached = self._cache.pop(digest, None)
+            if not cached:
+                return None
+            # Re-insert as most recently used
+            self._cache[digest] = cached
+            self.hits += 1
+        return cached
+
+    def put(self, digest, hashes, stats):
+        with self._lock:
+            self._cache.pop(digest, None)
+            self._cache[digest] = (hashes, stats)
+            while len(self._cache) > self.limit:
+                self._cache.popitem(last=False)
+
+
+class UpNextDetectorMetrics(object):
+    """Class to keep counts of captured frames and fixed size histograms of
+       frame latencies, that are cheap enough to always be recorded, and to
+       publish snapshots that can be monitored without profiling"""
+
+    __slots__ = (
+        '_lock',
+        'counts',
+        'latencies',
+        'published',
+    )
+
+    # Minimum time (in s) between updates of the published snapshot
+    _PUBLISH_INTERVAL = 10
+
+    def __init__(self):
+        self._lock = utils.create_lock()
+        self.counts = dict.fromkeys(
+            ('captured', 'failed', 'dropped', 'processed', 'repeated',
+             'matched', 'mismatched'),
+            0
+        )
+        self.latencies = {
+            # Time from capture until a worker takes the frame from the queue
+            'queue_wait': utils.Histogram(),
+            # Time taken to create and evaluate hashes of a frame
+            'process': utils.Histogram(),
+            # Time from capture until hashes of the frame have been evaluated
+            'capture_to_hash': utils.Histogram(),
+        }
+        self.published = None
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def record_frame(self, timestamps, match, repeated=False):
+        """Record a processed frame from a tuple of the times at which it was
+           captured, taken from the queue, and evaluated"""
+
+        captured_at, started_at, finished_at = timestamps
+        if captured_at is not None:
+            self.latencies['queue_wait'].record(started_at - captured_at)
+            self.latencies['capture_to_hash'].record(
+                finished_at - captured_at
+            )
+        self.latencies['process'].record(finished_at - started_at)
+
+        with self._lock:
+            self.counts['processed'] += 1
+            if repeated:
+                self.counts['repeated'] += 1
+            if match:
+                self.counts['matched'] += 1
+            elif match is False:
+                self.counts['mismatched'] += 1
+
+    def snapshot(self, **kwargs):
+        """Returns counts, rates and latency histograms as a dict, including
+           the time taken by each image processing step. Additional items can
+           be included as keyword arguments"""
+
+        with self._lock:
+            counts = dict(self.counts)
+        captured = counts['captured'] + counts['dropped']
+        processed = counts['processed']
+
+        snapshot = {
+            'counts': counts,
+            'rates': {
+                'dropped': counts['dropped'] / captured if captured else None,
+                'failed': counts['failed'] / captured if captured else None,
+                'repeated': (counts['repeated'] / processed
+                             if processed else None),
+                'matched': (counts['matched'] / processed
+                            if processed else None),
+                'mismatched': (counts['mismatched'] / processed
+                               if processed else None),
+            },
+            'latencies': {
+                name: histogram.snapshot()
+                for name, histogram in self.latencies.items()
+            },
+            'steps': image_utils.step_stats(),
+        }
+        snapshot.update(kwargs)
+        return snapshot
+
+    def publish(self, force=False, **kwargs):
+        """Update the window property with a new snapshot, at most once every
+           _PUBLISH_INTERVAL seconds unless forced. Returns the new snapshot,
+           or None if not updated"""
+
+        now = timeit.default_timer()
+        with self._lock:
+            if (not force and self.published is not None
+                    and now - self.published < self._PUBLISH_INTERVAL):
+                return None
+            self.published = now
+
+        snapshot = self.snapshot(**kwargs)
+        utils.set_property(constants.DETECTOR_METRICS_PROPERTY_NAME,
+                           json.dumps(snapshot, sort_keys=True))
+        return snapshot
+
+    @classmethod
+    def save(cls, snapshot):
+        """Write a snapshot to a JSON file in the detector save path"""
+
+        if not SETTINGS.detector_save_path or not snapshot:
+            return False
 
-    def load(self, identifier):
         target = file_utils.get_legal_filename(
-            identifier, prefix=SETTINGS.detector_save_path, suffix='.json'
+            constants.DETECTOR_METRICS, prefix=SETTINGS.detector_save_path
         )
         try:
-            with open(target, mode='r', encoding='utf-8') as target_file:
-                hashes = json.load(target_file)
+            file_utils.write_atomic(target, json.dumps(
+                snapshot, indent=4, sort_keys=True
+            ).encode('utf-8'))
         except (IOError, OSError, TypeError, ValueError):
-            self.log('Could not load stored hashes from {0}'.format(target))
+            cls.log('Could not save metrics to {0}'.format(target),
+                    utils.LOGWARNING)
             return False
+        return True
 
-        if not hashes:
-            return False
 
-        self.version = float(hashes.get('version', self.version))
-        self.hash_size = hashes.get('hash_size', self.hash_size)
-        if 'data' in hashes:
-            hash_size = self.hash_size[0] * self.hash_size[1]
-            self.data = {
-                # pylint: disable-next=consider-using-generator
-                tuple([utils.get_int(i) for i in key[1:-1].split(', ')]):
-                    self.int_to_hash(hashes['data'][key], hash_size)
-                for key in hashes['data']
-            }
-        if 'timestamps' in hashes:
-            self.timestamps = {
-                utils.get_int(group_idx):
-                    hashes['timestamps'][group_idx]
-                for group_idx in hashes['timestamps']
-                if group_idx != 'null'
-            }
+def _create_hashes_from_buffer(buffer_name, num_bytes, size, hash_size,
+                               image_options):
+    """Create image hashes, in a worker process, from captured image data that
+       has been placed in the named shared memory buffer. Image options are
+       passed from the parent process as the worker process may not have
+       access to the playing video or current settings"""
 
-        self.log('Hashes loaded from {0}'.format(target))
-        return True
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+    try:
+        image_data = bytearray(buffer.buf[:num_bytes])
+    finally:
+        buffer.close()
 
-    def save(self, identifier):
-        output = {
-            'version': self.version,
-            'hash_size': self.hash_size,
-            'data': {
-                str(hash_index): self.hash_to_int(self.data[hash_index])
-                for hash_index in self.data
-                if hash_index[-1] != constants.UNDEFINED
-            },
-            'timestamps': self.timestamps
-        }
+    image, filtered_image = UpNextDetector._create_images(  # pylint: disable=protected-access
+        image_data, size, image_options
+    )
+    return UpNextDetector._create_hashes(  # pylint: disable=protected-access
+        image, filtered_image, hash_size
+    )
 
-        target = file_utils.get_legal_filename(
-            identifier, prefix=SETTINGS.detector_save_path, suffix='.json'
+
+class UpNextProcessPool(object):
+    """Class to create image hashes in a pool of worker processes, rather than
+       in threads limited by the GIL. Captured image data is passed to worker
+       processes using a fixed set of shared memory buffers"""
+
+    __slots__ = (
+        '_buffers',
+        '_lock',
+        '_pool',
+        'buffer_size',
+        'timeout',
+    )
+
+    def __init__(self, num_processes, buffer_size, timeout):
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self._lock = utils.create_lock()
+        self._buffers = Queue()
+        for _ in range(num_processes):
+            self._buffers.put_nowait(
+                shared_memory.SharedMemory(create=True, size=buffer_size)
+            )
+        self._pool = multiprocessing.Pool(  # pylint: disable=consider-using-with
+            processes=num_processes
         )
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    @staticmethod
+    def is_available():
+        return shared_memory is not None
+
+    @classmethod
+    def create(cls, num_processes, buffer_size, timeout):
+        """Returns a new process pool or None if unable to create one"""
+
+        if not cls.is_available():
+            cls.log('Shared memory not available', utils.LOGWARNING)
+            return None
+
         try:
-            with open(target, mode='w', encoding='utf-8') as target_file:
-                json.dump(output, target_file, indent=4)
-                self.log('Hashes saved to {0}'.format(target))
-        except (IOError, OSError, TypeError, ValueError):
-            self.log('Could not save hashes to {0}'.format(target),
-                     utils.LOGWARNING)
-        return output
+            return cls(num_processes, buffer_size, timeout)
+        except (OSError, ValueError, ImportError) as error:
+            cls.log('Unable to create process pool: {0}'.format(error),
+                    utils.LOGWARNING)
+        return None
 
-    def window(self, hash_index,
-               size=SETTINGS.detect_matches, all_episodes=False):
-        """Get sets of hashes, either from all episodes or only from the first
-        and last episodes, where the timestamps are approximately equal (+/- an
-        adjustable offset) to the timestamps of the reference hash index"""
+    @staticmethod
+    def _free_buffer(buffer):
+        buffer.close()
+        buffer.unlink()
 
-        end_time, start_time, episode = hash_index
+    def _release_buffer(self, buffer):
+        """Return a buffer for reuse, or free it if the pool has been closed
+           or disabled while the buffer was in use"""
 
-        if all_episodes:
-            excluded_episodes = [constants.UNDEFINED]
-            selected_episodes = self.timestamps.keys()
-        else:
-            excluded_episodes = [constants.UNDEFINED, episode]
-            selected_episodes = {min(self.timestamps), max(self.timestamps)}
+        with self._lock:
+            if self._pool:
+                self._buffers.put_nowait(buffer)
+                return
+        self._free_buffer(buffer)
 
-        # Matching time period from start of file
-        min_start_time = start_time - size
-        max_start_time = start_time + size
-        # Matching time period from end of file
-        min_end_time = end_time - size
-        max_end_time = end_time + size
+    def _terminate(self):
+        """Stop using the pool. Worker processes are terminated rather than
+           waited for, as a failed or killed worker process may never return
+           a result"""
 
-        return {
-            hash_index: self.data[hash_index]
-            for hash_index in self.data
-            if (hash_index[2] in selected_episodes
-                and hash_index[2] not in excluded_episodes
-                and (
-                        min_start_time <= hash_index[1] <= max_start_time
-                        or min_end_time <= hash_index[0] <= max_end_time
-                ))
-        }
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    def close(self):
+        self._terminate()
+
+        # Buffers still in use are freed once released
+        while True:
+            try:
+                buffer = self._buffers.get_nowait()
+            except QueueEmpty:
+                break
+            self._free_buffer(buffer)
+
+    def create_hashes(self, image_data, size, hash_size, image_options):
+        """Returns a tuple of image hashes, as per
+           UpNextDetector._create_hashes, or None if image data could not be
+           processed. The pool is disabled after the first failure, and image
+           data should then be processed in the calling thread instead"""
+
+        num_bytes = len(image_data)
+        if num_bytes > self.buffer_size or not self._pool:
+            return None
+
+        try:
+            buffer = self._buffers.get(timeout=self.timeout)
+        except QueueEmpty:
+            return None
+        try:
+            with self._lock:
+                pool = self._pool
+            if not pool:
+                return None
+            buffer.buf[:num_bytes] = image_data
+            return pool.apply_async(
+                _create_hashes_from_buffer,
+                (buffer.name, num_bytes, size, hash_size, image_options)
+            ).get(self.timeout)
+        # Any exception raised in the worker process is re-raised here
+        except Exception as error:  # pylint: disable=broad-except
+            self.log('Unable to create hashes, disabling process pool: '
+                     '{0!r}'.format(error), utils.LOGWARNING)
+            self._terminate()
+            return None
+        finally:
+            self._release_buffer(buffer)
 
 
 class UpNextDetector(object):
@@ -203,10 +1755,19 @@ class UpNextDetector(object):
         'match_number',
         'mismatch_number',
         # Variables
+        'capture_controller',
         'capture_interval',
+        'credits_start',
         'hash_index',
+        'image_options',
         'match_counts',
+        'metrics',
+        'reject_counts',
+        'trace',
         # Worker pool
+        'frame_buffer',
+        'frame_memo',
+        'process_pool',
         'queue',
         'workers',
         # Signals
@@ -216,18 +1777,33 @@ class UpNextDetector(object):
         '_sigterm'
     )
 
+    # Minimum fraction of dark pixels and maximum fraction of mid-tone pixels
+    # in a frame that may be end credits
+    _PREFILTER_DARK_RATIO = 0.25
+    _PREFILTER_MIDTONE_RATIO = 0.5
+    # Compiled image processing pipelines, created on first use
+    _PIPELINES = {}
+
     def __init__(self, player, state):
         self.log('Init')
 
         self.player = player
         self.state = state
+        self.frame_buffer = None
+        self.frame_memo = UpNextFrameMemo(limit=4)
+        self.image_options = None
+        self.process_pool = None
         self.queue = None
+        self.trace = None
         self.workers = None
 
         self._lock = utils.create_lock()
 
         # Set minimum capture interval to decrease capture rate
         self.capture_interval = 1
+        self.capture_controller = None
+        # Estimated time from start of file when end credits may be detected
+        self.credits_start = None
         # Number of consecutive frame matches required for a positive detection
         # Set to 5s of captured frames as default
         self.match_number = int(
@@ -241,6 +1817,13 @@ class UpNextDetector(object):
             'misses': 0,
             'detected': False
         }
+        # Number of frames processed and number of frames rejected as not
+        # being end credits at each stage of processing
+        self.reject_counts = dict.fromkeys(
+            ('frames', 'histogram', 'entropy', 'credits'), 0
+        )
+        # Frame counts and latencies, kept for the lifetime of the detector
+        self.metrics = UpNextDetectorMetrics()
 
         self.hashes = None
         self.past_hashes = None
@@ -250,24 +1833,6 @@ class UpNextDetector(object):
         self._sigstop = utils.create_event()
         self._sigterm = utils.create_event()
 
-    @staticmethod
-    def _and(bit1, bit2):
-        return 1 if (bit1 and bit2) else 0
-
-    @staticmethod
-    def _eq_biased(bit1, bit2):
-        return (bit1 == bit2) * (1 if bit2 else 0.5)
-
-    @staticmethod
-    def _mul(bit1, bit2):
-        return bit1 * bit2
-
-    @staticmethod
-    def _xor(bit1, bit2):
-        # bit1 and bit2 are bools
-        # bit1 may be None
-        return 0 if bit1 is None or bit1 == bit2 else 1
-
     @staticmethod
     def _generate_initial_hash(hash_width, hash_height, **kwargs):
         blank_token = (0,)
@@ -284,7 +1849,7 @@ class UpNextDetector(object):
         pad_width_alt = (pad_width_alt * hash_width // 16) - (hash_width // 16)
 
         # noinspection IncorrectFormatting
-        return (
+        return UpNextHash.from_tuple(
             border_token * hash_width * pad_height
             + (
                 border_token
@@ -320,51 +1885,78 @@ class UpNextDetector(object):
             + border_token * hash_width * pad_height
         )
 
-    @staticmethod
-    def _generate_mask(image_hash):
-        fuzzy_value = None
-        masked_value = 0
-
-        mask = len(image_hash) / image_hash.count(masked_value)
-        fuzzy_mask = 0.25
-        min_mask = 0.25
-
-        return tuple(
-            mask if bit == masked_value else
-            fuzzy_mask if bit == fuzzy_value else
-            min_mask
-            for bit in image_hash
-        )
+    @classmethod
+    def _compile_pipeline(cls, key, queue, save_file=None):
+        pipeline = image_utils.compile_pipeline(queue, save_file)
+        cls._PIPELINES[key] = pipeline
+        return pipeline
 
-    @staticmethod
-    def _create_hash(image, hash_size, output_file=None):
-        image_hash = image_utils.process(
-            image,
+    @classmethod
+    def _create_hash(cls, image, hash_size, output_file=None):
+        hash_size = tuple(hash_size)
+        key = ('hash', hash_size, output_file)
+        pipeline = cls._PIPELINES.get(key) or cls._compile_pipeline(
+            key,
             queue=[
                 [image_utils.resize, hash_size],
                 [image_utils.points_of_interest],
-                [image_utils.export_data],
+                [image_utils.export_bits],
             ],
             save_file=output_file
         )
+        image_hash = pipeline(image)
 
-        return image_hash
+        return UpNextHash(image_hash, hash_size[0] * hash_size[1])
 
     @classmethod
-    def _create_images(cls, image_data, image_size):
-        image = image_utils.process(
-            image_data,
+    def _get_image_options(cls, video_resolution=None):
+        """Returns a tuple of the options used to create images from captured
+           image data: the size images are resized to, the resize method, and
+           whether the histogram pre-check and credits filter are used. The
+           size is based on video_resolution, if provided, otherwise on the
+           resolution of the playing video"""
+
+        return (
+            cls._get_video_capture_resolution(
+                video_resolution=video_resolution
+            ),
+            SETTINGS.detector_resize_method,
+            SETTINGS.detector_prefilter,
+            SETTINGS.detector_filter,
+        )
+
+    @classmethod
+    def _create_images(cls, image_data, image_size, image_options=None):
+        """Returns a tuple of the processed image and filtered image, where the
+           filtered image is None if the image was rejected as not being end
+           credits by the histogram pre-check"""
+
+        resolution, resize_method, prefilter, use_filter = (
+            image_options or cls._get_image_options()
+        )
+        key = ('image', tuple(image_size), resolution, resize_method)
+        pipeline = cls._PIPELINES.get(key) or cls._compile_pipeline(
+            key,
             queue=[
                 [image_utils.import_data, image_size, False],
-                [image_utils.resize, cls._get_video_capture_resolution()],
+                [image_utils.resize, resolution, resize_method],
                 [image_utils.saturation],
                 [image_utils.auto_level, 5, 95, (0.33, None)],
             ],
             save_file='1_image'
         )
+        image = pipeline(image_data)
 
-        filtered_image = image_utils.process(
-            image,
+        # Skip expensive filtering for frames that are clearly not credits
+        if prefilter and not cls._is_possible_credits(image):
+            return image, None
+
+        if not use_filter:
+            return image, image
+
+        key = ('filter', )
+        pipeline = cls._PIPELINES.get(key) or cls._compile_pipeline(
+            key,
             queue=[
                 [image_utils.posterise, 3],
                 [image_utils.adaptive_filter, (8, 1, True),
@@ -373,26 +1965,82 @@ class UpNextDetector(object):
                  'UnsharpMask,20,400,64', 'TRIM'],
                 [image_utils.apply_filter,
                  'RankFilter,5,50', 'TRIM', None, 'difference'],
-                [image_utils.detail_reduce, image, 50],
+                [image_utils.detail_reduce, 'INPUT', 50],
                 [image_utils.apply_filter,
                  'GaussianBlur,5', 'TRIM', None, 'multiply'],
                 [image_utils.auto_threshold],
             ],
             save_file='2_filter'
-        ) if SETTINGS.detector_filter else image
+        )
+        filtered_image = pipeline(image)
 
         return image, filtered_image
 
     @classmethod
-    def _hash_fuzz(cls, image_hash, masking_hash, factor=5):
-        weights = cls._generate_mask(masking_hash)
+    def _is_possible_credits(cls, image):
+        """Cheap check of the luma histogram of an image to reject frames that
+           can not be end credits, before any expensive filtering is done.
+           End credits are expected to have a mostly dark background and few
+           mid-tone pixels between the background and the text"""
+
+        histogram = image_utils.histogram_bins(image, 16)
+        dark_ratio = sum(histogram[:4])
+        midtone_ratio = sum(histogram[4:12])
 
-        significant_bits = sum(map(cls._mul, image_hash, weights))
-        significance = 100 * significant_bits / len(image_hash)
+        return (dark_ratio >= cls._PREFILTER_DARK_RATIO
+                and midtone_ratio <= cls._PREFILTER_MIDTONE_RATIO)
+
+    @staticmethod
+    def _hash_fuzz(image_hash, masking_hash, factor=5):
+        # Set bits that are unset in the masking hash are weighted by the
+        # inverse proportion of unset bits, all other set bits by a fixed 0.25
+        masked_bits = _popcount(image_hash.bits & masking_hash.unset)
+        significant_bits = 0.25 * (image_hash.num_set - masked_bits)
+        if masked_bits:
+            significant_bits += (
+                masked_bits * masking_hash.size / masking_hash.num_unset
+            )
+        significance = 100 * significant_bits / image_hash.size
         delta = significance - SETTINGS.detect_significance
 
         return factor * delta / SETTINGS.detect_significance
 
+    @staticmethod
+    def _hash_prune(baseline_hash, image_hash, width, level):
+        """Compare coarse hashes, from the next level of the hash pyramid, to
+           cheaply reject a baseline hash that can not be at least level %
+           similar to an image hash. A differing coarse bit requires at least
+           one differing set bit in the full resolution hashes, so the number
+           of differing coarse bits is a lower bound for the number of
+           differing set bits. Returns True if the baseline hash can be
+           rejected without a full comparison"""
+
+        if not baseline_hash or not image_hash:
+            return True
+        if baseline_hash.size != image_hash.size:
+            return True
+
+        baseline_coarse = baseline_hash.coarse(width)
+        image_coarse = image_hash.coarse(width)
+        distance = _popcount(
+            (baseline_coarse.bits ^ image_coarse.bits)
+            & ~baseline_coarse.ignored
+        )
+
+        # Maximum number of differing set bits for the full resolution hashes
+        # to be similar, as evaluated by _hash_similarity
+        num_pixels = baseline_hash.size - baseline_hash.num_ignored
+        weighted_total = num_pixels - (
+            min(baseline_hash.num_unset, image_hash.num_unset) / 2
+        )
+        max_distance = (
+            num_pixels
+            + min(baseline_hash.num_set, image_hash.num_set)
+            + baseline_hash.num_ignored
+            - 2 * level * weighted_total / 100
+        ) / 3
+        return distance > max_distance
+
     @classmethod
     def _hash_similarity(cls, baseline_hash, image_hash, filtered_hash=None):
         """Method to compare the similarity between image hashes"""
@@ -403,20 +2051,26 @@ class UpNextDetector(object):
 
         compare_hash = filtered_hash or image_hash
 
-        num_pixels = len(baseline_hash)
-        if num_pixels != len(compare_hash):
+        num_pixels = baseline_hash.size
+        if num_pixels != compare_hash.size:
             return 0
 
-        # Check whether each pixel is equal
-        bits_eq = sum(map(cls._eq_biased, baseline_hash, compare_hash))
-        bits_xor = tuple(map(cls._xor, baseline_hash, compare_hash))
-        bits_xor_baseline = sum(map(cls._and, bits_xor, baseline_hash))
-        bits_xor_compare = sum(map(cls._and, bits_xor, compare_hash))
+        # Check whether each pixel is equal. Set pixels are weighted as 1,
+        # unset and ignored pixels as 0.5
+        bits_eq = _popcount(baseline_hash.bits & compare_hash.bits) + 0.5 * (
+            _popcount(baseline_hash.unset & compare_hash.unset)
+            + _popcount(baseline_hash.ignored & compare_hash.ignored)
+        )
+        # Penalise set pixels that differ, unless ignored in baseline hash
+        bits_xor_baseline = _popcount(baseline_hash.bits & ~compare_hash.bits)
+        bits_xor_compare = _popcount(
+            compare_hash.bits & ~(baseline_hash.bits | baseline_hash.ignored)
+        )
 
         weighted_total = (
                 num_pixels
-                - baseline_hash.count(None)
-                - (min(baseline_hash.count(0), compare_hash.count(0)) / 2)
+                - baseline_hash.num_ignored
+                - (min(baseline_hash.num_unset, compare_hash.num_unset) / 2)
         )
         bit_compare = bits_eq - bits_xor_baseline - bits_xor_compare
 
@@ -433,11 +2087,13 @@ class UpNextDetector(object):
         return similarity - uncertainty
 
     @classmethod
-    def _get_video_capture_resolution(cls, max_size=8):
+    def _get_video_capture_resolution(cls, max_size=8, video_resolution=None):
         """Method to return a scaled down capture resolution tuple for use in
            capturing the video frame buffer at a specific size/resolution"""
 
-        width, height, aspect_ratio = cls.get_video_resolution()
+        width, height, aspect_ratio = (
+            video_resolution or cls.get_video_resolution()
+        )
         if not aspect_ratio or not width or not height:
             return None, None
 
@@ -462,16 +2118,18 @@ class UpNextDetector(object):
         row_length = size[0]
 
         hashes = [image_hash if image_hash and len(image_hash) == num_bits
-                  else (0,) * num_bits
+                  else UpNextHash(size=num_bits)
                   for image_hash in hashes]
 
+        bit_tuples = [image_hash.to_tuple() for image_hash in hashes]
+
         cls.log('\n\t\t\t'.join(
             [
                 prefix,
                 '{0}|{1}|'.format(
                     size,
                     '|'.join([
-                        str(UpNextHashStore.hash_to_int(image_hash))
+                        str(image_hash.bits)
                         for image_hash in hashes
                     ])
                 )
@@ -483,7 +2141,7 @@ class UpNextDetector(object):
                             '+' if bit else '-' if bit is None else ' '
                             for bit in image_hash[row:row + row_length]
                         ])
-                        for image_hash in hashes
+                        for image_hash in bit_tuples
                     ])
                 ) for row in range(0, num_bits, row_length)
             ]
@@ -493,17 +2151,14 @@ class UpNextDetector(object):
     def log(cls, msg, level=utils.LOGDEBUG):
         utils.log(msg, name=cls.__name__, level=level)
 
-    def _evaluate_similarity(self, image, filtered_image, hash_size):
-        stats = {
-            # Similarity to representative end credits hash
-            'credits': constants.UNDEFINED,
-            # Similarity between detected credits hashes
-            'detected': constants.UNDEFINED,
-            # Similarity to previous frame hash
-            'previous': constants.UNDEFINED,
-            # Similarity to hash from other episodes
-            'episodes': constants.UNDEFINED
-        }
+    @classmethod
+    def _create_hashes(cls, image, filtered_image, hash_size):
+        """Returns a tuple of image, filtered and expanded image hashes, where
+           the expanded hash is None if the image is not possibly credits and
+           the filtered hash is None if no filtered image was created"""
+
+        if filtered_image is None:
+            return cls._create_hash(image, hash_size), None, None
 
         possible_credits, expanded_image = image_utils.process(
             image,
@@ -513,13 +2168,35 @@ class UpNextDetector(object):
             save_file='3_expanded'
         )
 
-        image_hash = self._create_hash(image, hash_size)
-        filtered_hash = self._create_hash(filtered_image, hash_size)
-        expanded_hash = None
+        image_hash = cls._create_hash(image, hash_size)
+        filtered_hash = cls._create_hash(filtered_image, hash_size)
+        expanded_hash = (
+            cls._create_hash(expanded_image, hash_size)
+            if possible_credits else None
+        )
+
+        return image_hash, filtered_hash, expanded_hash
+
+    def _evaluate_similarity(self, hashes):
+        stats = {
+            # Similarity to representative end credits hash
+            'credits': constants.UNDEFINED,
+            # Similarity between detected credits hashes
+            'detected': constants.UNDEFINED,
+            # Similarity to previous frame hash
+            'previous': constants.UNDEFINED,
+            # Similarity to credits template learned from other episodes
+            'learned': constants.UNDEFINED,
+            # Similarity to hash from other episodes
+            'episodes': constants.UNDEFINED,
+            # Match result: True if matched, False if mismatched, None if
+            # possibly matched
+            'match': None,
+        }
 
-        if possible_credits:
-            expanded_hash = self._create_hash(expanded_image, hash_size)
+        image_hash, filtered_hash, expanded_hash = hashes
 
+        if expanded_hash is not None:
             # Calculate similarity between current hash and representative hash
             stats['credits'] = max(self._hash_similarity(
                 self.hashes.data.get(self.hash_index['credits_small']),
@@ -545,13 +2222,14 @@ class UpNextDetector(object):
         # Match if current hash matches representative hash or if current hash
         # is blank
         is_match = (
-                not any(image_hash)
+                not image_hash.bits
                 or stats['credits'] >= SETTINGS.detect_level
         )
         # Unless debugging, return if match found, otherwise continue checking
         if is_match and not SETTINGS.detector_debug:
+            stats['match'] = True
             self._hash_match_hit()
-            return stats, (image_hash, filtered_hash, expanded_hash)
+            return stats
 
         # Calculate similarity between current hash and previous hash
         stats['previous'] = self._hash_similarity(
@@ -570,11 +2248,33 @@ class UpNextDetector(object):
         )
         # Unless debugging, return if match found, otherwise continue checking
         if is_match and not SETTINGS.detector_debug:
+            stats['match'] = True
             self._hash_match_hit()
-            return stats, (image_hash, filtered_hash, expanded_hash)
-
-        old_hashes = self.past_hashes.window(self.hash_index['current'])
+            return stats
+
+        # Match if current hash matches the learned credits template, once end
+        # credits are expected, otherwise check hashes from other episodes.
+        # Candidate hashes are first compared at a lower resolution to skip
+        # full comparisons with hashes that can not match
+        width = self.hashes.hash_size[0]
+        learned_hash = self.hashes.data.get(self.hash_index['credits_learned'])
+        if learned_hash and (
+                self.credits_start is None
+                or self.hash_index['current'][1] >= self.credits_start
+        ) and not self._hash_prune(
+            learned_hash, image_hash, width, SETTINGS.detect_level
+        ):
+            stats['learned'] = self._hash_similarity(learned_hash, image_hash)
+        learned_match = stats['learned'] >= SETTINGS.detect_level
+        is_match = is_match or learned_match
+
+        old_hashes = {} if learned_match else self.past_hashes.window(
+            self.hash_index['current']
+        )
         for self.hash_index['episodes'], old_hash in old_hashes.items():
+            if self._hash_prune(old_hash, image_hash, width,
+                                SETTINGS.detect_level):
+                continue
             stats['episodes'] = self._hash_similarity(
                 old_hash,
                 image_hash
@@ -586,12 +2286,31 @@ class UpNextDetector(object):
 
         # Increment the number of matches
         if is_match:
-            self._hash_match_hit()
+            stats['match'] = True
         # Otherwise increment number of mismatches
         elif not possible_match:
-            self._hash_match_miss()
+            stats['match'] = False
+        self._hash_match_update(stats['match'])
+
+        return stats
+
+    def _update_reject_counts(self, hashes, stats):
+        _, filtered_hash, expanded_hash = hashes
 
-        return stats, (image_hash, filtered_hash, expanded_hash)
+        with self._lock:
+            self.reject_counts['frames'] += 1
+            if filtered_hash is None:
+                self.reject_counts['histogram'] += 1
+            elif expanded_hash is None:
+                self.reject_counts['entropy'] += 1
+            elif stats['credits'] < SETTINGS.detect_level:
+                self.reject_counts['credits'] += 1
+
+    def _hash_match_update(self, match):
+        if match:
+            self._hash_match_hit()
+        elif match is False:
+            self._hash_match_miss()
 
     def _hash_match_hit(self):
         with self._lock:
@@ -614,7 +2333,10 @@ class UpNextDetector(object):
             self.match_counts['misses'] = 0
             self.match_counts['detected'] = False
 
-    def _init_hashes(self):
+    def _init_hashes(self, item=None, aspect_ratio=None):
+        item = item or self.state.current_item
+        aspect_ratio = aspect_ratio or self.get_video_resolution()[2]
+
         self.hash_index = {
             # Hash indexes are tuples containing the following data:
             # (time_to_end, time_from_start, group_idx)
@@ -626,6 +2348,8 @@ class UpNextDetector(object):
             'credits_small': (0, 0, constants.UNDEFINED),
             'credits_large': (0, 1, constants.UNDEFINED),
             'credits_scroll': (0, 2, constants.UNDEFINED),
+            # Credits template learned from other episodes
+            'credits_learned': (0, 3, constants.UNDEFINED),
             # Other episodes hash
             'episodes': None,
             # Detected end credits timestamp from end of file
@@ -633,14 +2357,14 @@ class UpNextDetector(object):
         }
 
         # Hash size as (width, height)
-        hash_size = [8 * self.get_video_resolution()[2], 8]
+        hash_size = [8 * aspect_ratio, 8]
         # Round down width to multiple of 2
         hash_size[0] = int(hash_size[0] - hash_size[0] % 2)
 
         # Hashes for currently playing item
         self.hashes = UpNextHashStore(
             hash_size=hash_size,
-            item=self.state.current_item,
+            item=item,
             data={
                 # Representative hash of centred end credits text on a dark
                 # background
@@ -663,10 +2387,20 @@ class UpNextDetector(object):
             },
         )
 
-        # Hashes from previously played episodes
-        self.past_hashes = UpNextHashStore(hash_size=hash_size)
-        if SETTINGS.detector_save_path and self.hashes.is_valid():
-            self.past_hashes.load(self.hashes.group_name)
+        # Hashes from previously played episodes, re-used from memory if
+        # available, otherwise loaded from disk
+        self.past_hashes = None
+        if self.hashes.is_valid():
+            self.past_hashes = HASH_CACHE.get(self.hashes.group_name)
+        if not self.past_hashes:
+            self.past_hashes = UpNextHashStore(hash_size=hash_size)
+            if SETTINGS.detector_save_path and self.hashes.is_valid():
+                HASH_WRITER.wait(self.hashes.group_name)
+                self.past_hashes.load(self.hashes.group_name)
+
+        template = self.past_hashes.get_template()
+        if template:
+            self.hashes.add(self.hash_index['credits_learned'], template)
 
         self._hash_match_reset()
 
@@ -686,14 +2420,19 @@ class UpNextDetector(object):
         self.queue = queue
         return queue
 
-    def _queue_push(self, queue=None):
+    def _queue_push(self, queue=None):  # pylint: disable=too-many-branches,too-many-locals,too-many-statements
         queue = queue or self.queue
+        controller = self.capture_controller
+        frame_buffer = self.frame_buffer
+        trace = self.trace
         try:
             capturer, size = self._queue_pull(queue)
             capturer.capture(*size)
             abort = False
         except TypeError:
             abort = True
+        interval = self.capture_interval
+        data_limit = controller.data_limit
 
         while not (abort or self._sigterm.is_set() or self._sigstop.is_set()):
             loop_start = timeit.default_timer()
@@ -701,6 +2440,8 @@ class UpNextDetector(object):
             with utils.ContextManager(self, 'player') as (player, error):
                 if error is AttributeError:
                     raise error
+                play_time = player.getTime()
+                total_time = player.getTotalTime() if trace else 0
                 error = player.get_speed() != 1
             if error:
                 self.log('Stop capture: nothing playing')
@@ -715,31 +2456,65 @@ class UpNextDetector(object):
                 ), utils.LOGWARNING)
                 if SETTINGS.detector_data_limit >= 16:
                     SETTINGS.detector_data_limit -= 8
+                controller.max_data_limit = SETTINGS.detector_data_limit
+                controller.data_limit = min(controller.data_limit,
+                                            SETTINGS.detector_data_limit)
+                data_limit = controller.data_limit
+                self.metrics.count('failed')
 
                 image_data = None
-                size = self._get_video_capture_resolution(
-                    max_size=SETTINGS.detector_data_limit
-                )
+                size = self._get_video_capture_resolution(max_size=data_limit)
 
                 del capturer
                 capturer = xbmc.RenderCapture()
 
+            # Otherwise record captured frame, to allow detection to be
+            # replayed later
+            elif trace:
+                trace.write(image_data, size, play_time, total_time)
+
+            frame_idx = None
+            queued = False
             try:
-                queue.put((image_data, size), timeout=self.capture_interval)
+                frame_idx = frame_buffer.acquire(timeout=interval)
+                frame_buffer.put(frame_idx, image_data, size)
+                queue.put(frame_idx, timeout=interval)
+                queued = True
+                self.metrics.count('captured')
+
+                # Sample less frequently until end credits are expected or
+                # until possible end credits have been matched
+                interval, new_data_limit = controller.update(
+                    queue.qsize(), queue.maxsize,
+                    sparse=(not self.match_counts['hits'] and (
+                        self.credits_start is None
+                        or play_time < self.credits_start
+                    ))
+                )
+                if new_data_limit != data_limit:
+                    data_limit = new_data_limit
+                    size = self._get_video_capture_resolution(
+                        max_size=data_limit
+                    )
                 capturer.capture(*size)
 
                 loop_time = timeit.default_timer() - loop_start
-                if loop_time >= self.capture_interval:
+                if loop_time >= interval:
                     raise QueueFull
 
-                abort = utils.wait(self.capture_interval - loop_time)
+                abort = utils.wait(interval - loop_time)
 
             except AttributeError:
                 self.log('Stop capture: detector stopped')
                 break
 
-            except QueueFull:
+            except (QueueEmpty, QueueFull):
                 self.log('Capture/detection desync', utils.LOGWARNING)
+                # Frame was not queued, free slot for next capture
+                if not queued:
+                    if frame_idx is not None:
+                        frame_buffer.release(frame_idx)
+                    self.metrics.count('dropped')
                 abort = utils.abort_requested()
                 continue
 
@@ -774,6 +2549,7 @@ class UpNextDetector(object):
            that end credits are playing."""
 
         queue = self.queue
+        frame_buffer = self.frame_buffer
 
         while not (self._sigterm.is_set() or self._sigstop.is_set()):
             with utils.ContextManager(self, 'player') as (player, error):
@@ -792,9 +2568,10 @@ class UpNextDetector(object):
                 break
 
             try:
-                image_data, size = self._queue_pull(queue,
-                                                    SETTINGS.detector_threads)
+                frame_idx = self._queue_pull(queue, SETTINGS.detector_threads)
+                image_data, size = frame_buffer.get(frame_idx)
                 if not isinstance(image_data, (bytes, bytearray)):
+                    frame_buffer.release(frame_idx)
                     raise QueueEmpty
             except TypeError:
                 self.log('Queue empty - exiting')
@@ -803,54 +2580,272 @@ class UpNextDetector(object):
                 self.log('Queue empty - retry')
                 continue
 
-            image, filtered_image = self._create_images(image_data, size)
+            self._detect(
+                image_data, size, play_time,
+                captured_at=frame_buffer.captured_at(frame_idx),
+                release=partial(frame_buffer.release, frame_idx)
+            )
+            del image_data
 
-            # Check if current hash matches with previous hash, typical end
-            # credits hash, or other episode hashes
-            stats, hashes = self._evaluate_similarity(
-                image, filtered_image, self.hashes.hash_size
+            self._queue_task_done(queue)
+
+        self._queue_task_done(queue)
+
+    def _detect(self, image_data, size, play_time,
+                captured_at=None, release=None):
+        """Create hashes from captured image data and compare them to the
+           previous hash, typical end credits hashes and other episode hashes,
+           then store the current hash and the credits timestamp, if detected.
+           release is called once the image data is no longer required"""
+
+        process_start = timeit.default_timer()
+        # Reuse results from an identical recent frame, if available,
+        # rather than processing the frame again
+        digest = (size, image_utils.frame_digest(image_data, size))
+        memo = self.frame_memo.get(digest)
+        if memo:
+            hashes, stats = memo
+        else:
+            hashes = self._process_frame(image_data, size)
+        image_hash, filtered_hash, expanded_hash = hashes
+        # Frame data is no longer required, free slot for next capture
+        del image_data
+        if release:
+            release()
+
+        # Check if current hash matches with previous hash, typical end
+        # credits hash, or other episode hashes. Repeated frames are still
+        # counted as matches or mismatches, as per the original frame
+        if memo:
+            self._hash_match_update(stats['match'])
+        else:
+            stats = self._evaluate_similarity(hashes)
+            self.frame_memo.put(digest, hashes, stats)
+        process_end = timeit.default_timer()
+        if self.capture_controller:
+            self.capture_controller.record(process_end - process_start)
+        self._update_reject_counts(hashes, stats)
+        self.metrics.record_frame(
+            (captured_at, process_start, process_end),
+            stats['match'],
+            repeated=bool(memo)
+        )
+        self._publish_metrics()
+
+        if SETTINGS.detector_debug:
+            self.log('Match: {0[hits]}/{1}, Miss: {0[misses]}/{2}'.format(
+                self.match_counts, self.match_number, self.mismatch_number
+            ))
+            self.log('Rejected: {0[histogram]}/{0[frames]} histogram, '
+                     '{0[entropy]}/{0[frames]} entropy, '
+                     '{0[credits]}/{0[frames]} credits'.format(
+                         self.reject_counts
+                     ))
+
+            self._print_hashes(
+                [filtered_hash,
+                 expanded_hash,
+                 self.hashes.data.get(self.hash_index['credits_small']),
+                 self.hashes.data.get(self.hash_index['credits_large']),
+                 self.hashes.data.get(self.hash_index['credits_scroll'])],
+                size=self.hashes.hash_size,
+                prefix=(
+                    '{0:.1f}% similar to typical credits, '
+                    '{1:.1f}% similarity in detected credits'
+                ).format(stats['credits'], stats['detected'])
             )
-            image_hash, filtered_hash, expanded_hash = hashes
 
-            if SETTINGS.detector_debug:
-                self.log('Match: {0[hits]}/{1}, Miss: {0[misses]}/{2}'.format(
-                    self.match_counts, self.match_number, self.mismatch_number
-                ))
+            self._print_hashes(
+                [self.hashes.data.get(self.hash_index['previous']),
+                 image_hash,
+                 self.past_hashes.data.get(self.hash_index['episodes'])],
+                size=self.hashes.hash_size,
+                prefix=(
+                    '{0:.1f}% similar to previous hash, '
+                    '{1:.1f}% similar to other episodes, '
+                    '{2:.1f}% similar to learned credits'
+                ).format(stats['previous'], stats['episodes'],
+                         stats['learned'])
+            )
 
-                self._print_hashes(
-                    [filtered_hash,
-                     expanded_hash,
-                     self.hashes.data.get(self.hash_index['credits_small']),
-                     self.hashes.data.get(self.hash_index['credits_large']),
-                     self.hashes.data.get(self.hash_index['credits_scroll'])],
-                    size=self.hashes.hash_size,
-                    prefix=(
-                        '{0:.1f}% similar to typical credits, '
-                        '{1:.1f}% similarity in detected credits'
-                    ).format(stats['credits'], stats['detected'])
-                )
+        # Store current hash for comparison with next video frame
+        self.hashes.add(self.hash_index['current'], image_hash)
+        self.hash_index['previous'] = self.hash_index['current']
 
-                self._print_hashes(
-                    [self.hashes.data.get(self.hash_index['previous']),
-                     image_hash,
-                     self.past_hashes.data.get(self.hash_index['episodes'])],
-                    size=self.hashes.hash_size,
-                    prefix=(
-                        '{0:.1f}% similar to previous hash, '
-                        '{1:.1f}% similar to other episodes'
-                    ).format(stats['previous'], stats['episodes'])
-                )
+        # Store timestamps if credits are detected
+        self.update_timestamp(play_time)
 
-            # Store current hash for comparison with next video frame
-            self.hashes.data[self.hash_index['current']] = image_hash
-            self.hash_index['previous'] = self.hash_index['current']
+    def _wait_for_credits(self):
+        """Wait until shortly before the earliest time that end credits have
+           been detected in other episodes. Returns False if the detector was
+           stopped or nothing is playing, otherwise returns True"""
 
-            # Store timestamps if credits are detected
-            self.update_timestamp(play_time)
+        with utils.ContextManager(self, 'player') as (player, error):
+            if error is AttributeError:
+                raise error
+            total_time = player.getTotalTime()
+            error = False
+        if error:
+            return False
 
-            self._queue_task_done(queue)
+        # Allow for the required number of matches to be detected before the
+        # earliest stored timestamp
+        start_time = self.past_hashes.estimate_credits_start(
+            total_time, lead=2 * self.match_number * self.capture_interval
+        )
+        self.credits_start = start_time
+        if start_time is None:
+            return True
+        self.log('End credits expected from {0:.0f}s'.format(start_time))
 
-        self._queue_task_done(queue)
+        # Set running state to allow waiting to be stopped
+        self._running.set()
+        while not (self._sigterm.is_set() or self._sigstop.is_set()):
+            with utils.ContextManager(self, 'player') as (player, error):
+                if error is AttributeError:
+                    raise error
+                # Re-check play time to account for seeking or pausing
+                delay = start_time - player.getTime()
+                error = False
+            if error:
+                return False
+            if delay <= 0:
+                return True
+            if utils.wait(min(delay, self.capture_interval)):
+                return False
+        return False
+
+    def _hash_store_limit(self):
+        """Number of hashes of the currently playing item to retain. Hashes
+           are only compared to the previous hash, and are only saved for the
+           detection period at the end of the file, or from when end credits
+           are expected to start, plus the window around detected credits.
+           Hashes are indexed by whole seconds, so at most one hash is stored
+           for each second of playback"""
+
+        total_time = self.state.total_time
+        detect_time = self.state.get_detect_time()
+        if detect_time is None:
+            detect_time = max(
+                0, total_time - SETTINGS.detect_period * total_time / 3600
+            )
+        period = total_time - detect_time
+
+        credits_start = self.past_hashes.estimate_credits_start(
+            total_time, lead=2 * self.match_number * self.capture_interval
+        )
+        if credits_start is not None:
+            period = max(period, total_time - credits_start)
+
+        period += 2 * SETTINGS.detect_matches
+        return int(period / max(1, self.capture_interval)) + 1
+
+    @staticmethod
+    def _generate_credits_frame(width, height):
+        """Returns BGRA image data of lines of light text centred on a dark
+           background, used as a typical end credits frame"""
+
+        dark = b'\x10\x10\x10\xff'
+        light = b'\xf0\xf0\xf0\xff'
+        margin = width // 3
+        num_chars = (width - 2 * margin) // 2
+        text_row = (
+            dark * margin
+            + (light + dark) * num_chars
+            + dark * (width - margin - 2 * num_chars)
+        )
+        blank_row = dark * width
+
+        return b''.join([
+            text_row if height // 4 <= row < 3 * height // 4 and row % 3
+            else blank_row
+            for row in range(height)
+        ])
+
+    def _calibrate(self):
+        """Returns the largest data limit for which the time taken to process
+           a captured frame fits within the CPU budget for each capture
+           interval, as used by UpNextCaptureController"""
+
+        aspect_ratio = self.get_video_resolution()[2]
+        CAPTURE_PROFILE.load([
+            round(aspect_ratio, 2),
+            self.hashes.hash_size,
+            SETTINGS.detector_filter,
+            SETTINGS.detector_prefilter,
+            SETTINGS.detector_resize_method,
+        ])
+
+        # Budget is a fraction of a single core, regardless of the number of
+        # worker threads
+        data_limit = CAPTURE_PROFILE.calibrate(
+            self._calibration_sample,
+            max_data_limit=SETTINGS.detector_data_limit,
+            target_latency=(
+                self.capture_interval * SETTINGS.detector_cpu_budget / 100
+            ),
+        )
+
+        # Discard any matches from calibration frames
+        self._hash_match_reset()
+        return data_limit
+
+    def _calibration_sample(self, data_limit):
+        """Process a typical end credits frame, as if it had been captured
+           using data_limit"""
+
+        size = self._get_video_capture_resolution(max_size=data_limit)
+        image_data = self._generate_credits_frame(*size)
+        self._evaluate_similarity(self._process_frame(image_data, size))
+
+    def _process_frame(self, image_data, size):
+        """Returns tuple of image hashes created from captured image data,
+           using the process pool if available"""
+
+        # Pool may be released by another thread while frame is processed
+        process_pool = self.process_pool
+        image_options = self.image_options or self._get_image_options()
+        hashes = None
+        if process_pool:
+            hashes = process_pool.create_hashes(
+                image_data, size, self.hashes.hash_size, image_options
+            )
+        if not hashes:
+            image, filtered_image = self._create_images(
+                image_data, size, image_options
+            )
+            hashes = self._create_hashes(
+                image, filtered_image, self.hashes.hash_size
+            )
+        return hashes
+
+    def _publish_metrics(self, force=False):
+        controller = self.capture_controller
+        return self.metrics.publish(
+            force=force,
+            rejected=dict(self.reject_counts),
+            precompute=image_utils.precompute_stats(),
+            debug_save=image_utils.debug_save_stats(),
+            capture={
+                'interval': controller.interval,
+                'data_limit': controller.data_limit,
+                'latency': controller.latency,
+            } if controller else None,
+        )
+
+    def _process_pool_release(self):
+        with self._lock:
+            process_pool = self.process_pool
+            self.process_pool = None
+        if process_pool:
+            process_pool.close()
+
+    def _trace_release(self):
+        with self._lock:
+            trace = self.trace
+            self.trace = None
+        if trace:
+            trace.close()
 
     def _worker_release(self):
         if not self.workers or not self.queue:
@@ -911,7 +2906,7 @@ class UpNextDetector(object):
         self.hashes.timestamps[self.hashes.group_idx] = None
         self.hash_index['detected_at'] = None
 
-    def start(self, restart=False):
+    def start(self, restart=False):  # pylint: disable=too-many-statements
         """Method to run actual detection test loop in a separate thread"""
 
         resolution = self._get_video_capture_resolution(
@@ -939,13 +2934,61 @@ class UpNextDetector(object):
             utils.event('upnext_credits_detected', internal=True)
             return
 
+        # Wait until end credits are expected, if they can be estimated from
+        # other episodes, rather than continuously running the detector
+        self.credits_start = None
+        if not SETTINGS.detector_debug and not self._wait_for_credits():
+            self.log('Stopped while waiting for end credits')
+            self._running.clear()
+            self._sigstop.clear()
+            self._sigterm.clear()
+            return
+
+        # Only retain the current episode hashes that can be compared or saved
+        self.hashes.set_limit(self._hash_store_limit())
+        # Image options are fixed for the duration of playback
+        self.image_options = self._get_image_options()
+
+        # Choose the initial amount of data captured based on the time taken
+        # to process captured frames on this device
+        data_limit = SETTINGS.detector_data_limit
+        if SETTINGS.detector_autotune:
+            data_limit = self._calibrate()
+        capture_size = self._get_video_capture_resolution(max_size=data_limit)
+
         # Otherwise run the detector in a new thread
         with self._lock:
             self.log('Started')
+            self.frame_memo.clear()
+            self.capture_controller = UpNextCaptureController(
+                min_interval=self.capture_interval,
+                budget=SETTINGS.detector_cpu_budget,
+                data_limit=data_limit,
+                max_data_limit=SETTINGS.detector_data_limit,
+            )
+            if SETTINGS.detector_processes:
+                self.process_pool = UpNextProcessPool.create(
+                    num_processes=SETTINGS.detector_threads - 1,
+                    # BGRA image data at the maximum capture resolution
+                    buffer_size=4 * resolution[0] * resolution[1],
+                    # Same as the time allowed for workers to stop
+                    timeout=(
+                        2 * SETTINGS.detector_threads * self.capture_interval
+                    ),
+                )
+            if SETTINGS.detector_record_trace:
+                self.trace = UpNextCaptureTrace.create(
+                    self.state.current_item, self.get_video_resolution()
+                )
+            # Enough slots for a full queue and a frame being processed by
+            # each worker
+            self.frame_buffer = UpNextFrameBuffer(
+                2 * SETTINGS.detector_threads
+            )
             queue = self._queue_create()
             queue.put_nowait([
                 xbmc.RenderCapture(),
-                resolution,
+                capture_size,
             ])
             self.workers = [utils.run_threaded(self._queue_push,
                                                kwargs={'queue': queue})]
@@ -958,8 +3001,18 @@ class UpNextDetector(object):
 
         queue.join()
         self._worker_release()
+        self._process_pool_release()
+        self._trace_release()
 
-        self.log('Stopped')
+        self.log('Stopped - frames rejected by stage: {0}'.format(
+            self.reject_counts
+        ))
+        self.log('Precomputed element cache: {0}'.format(
+            image_utils.precompute_stats()
+        ))
+        self.log('Repeated frames skipped: {0}'.format(self.frame_memo.hits))
+        self.log('Debug images: {0}'.format(image_utils.debug_save_stats()))
+        UpNextDetectorMetrics.save(self._publish_metrics(force=True))
         self._running.clear()
         self._sigstop.clear()
         self._sigterm.clear()
@@ -974,6 +3027,8 @@ class UpNextDetector(object):
 
             self._queue_clear()
             self._worker_release()
+            self._process_pool_release()
+            self._trace_release()
             utils.wait(1)
 
         # Free references/resources
@@ -982,6 +3037,8 @@ class UpNextDetector(object):
             self.workers = None
             del self.queue
             self.queue = None
+            del self.frame_buffer
+            self.frame_buffer = None
             if terminate:
                 # Invalidate collected hashes if not needed for later use
                 if self.hashes:
@@ -992,6 +3049,56 @@ class UpNextDetector(object):
                 del self.state
                 self.state = None
 
+    def replay(self, filename, store=False):
+        """Run detection on the frames recorded in a capture trace, in the
+           recorded order and as fast as possible, rather than on frames
+           captured from Kodi. Returns a list of tuples of (item, timestamp)
+           for each recorded item, with a timestamp of None if credits were
+           not detected. If store is True then hashes and timestamps are
+           stored after each item, as if each item had been played"""
+
+        results = []
+        details = None
+        for (record_details, play_time, total_time, speed,
+             size, image_data) in UpNextCaptureTrace.read(filename):
+            if record_details is not details:
+                if details:
+                    results.append(self._replay_result(store))
+                details = record_details
+                # Process frames as per the recorded video resolution, rather
+                # than the resolution of any currently playing video
+                self.image_options = self._get_image_options(
+                    details['resolution']
+                )
+                self._init_hashes(item=details['item'],
+                                  aspect_ratio=details['resolution'][2])
+                self.credits_start = self.past_hashes.estimate_credits_start(
+                    total_time, lead=2 * self.match_number * self.capture_interval
+                )
+                self.frame_memo.clear()
+
+            if speed != 1:
+                continue
+            self.hash_index['current'] = (
+                int(total_time - play_time),
+                int(play_time),
+                self.hashes.group_idx
+            )
+            self._detect(image_data, size, play_time)
+
+        if details:
+            results.append(self._replay_result(store))
+        return results
+
+    def _replay_result(self, store):
+        if store:
+            self.store_data()
+        return (
+            {'group_name': self.hashes.group_name,
+             'group_idx': self.hashes.group_idx},
+            self.hashes.timestamps.get(self.hashes.group_idx)
+        )
+
     def store_data(self):
         # Only store data for videos that are grouped by season (i.e. same show
         # title, same season number)
@@ -1002,12 +3109,20 @@ class UpNextDetector(object):
         self.past_hashes.timestamps.update(self.hashes.timestamps)
         # If credit were detected only store the previous +/- 5s of hashes to
         # reduce false positives when comparing to other episodes
-        self.past_hashes.data.update(self.hashes.window(
+        self.past_hashes.update(self.hashes.window(
             self.hash_index['detected_at'], all_episodes=True
         ) if self.match_counts['detected'] else self.hashes.data)
+        # Update the credits template with the newly detected credits
+        if self.match_counts['detected']:
+            self.past_hashes.learn_template()
 
+        # Keep updated hashes in memory for the next episode in the group
+        HASH_CACHE.put(self.hashes.group_name, self.past_hashes)
+
+        # Save in the background so that playback of the next video is not
+        # delayed by disk I/O
         if SETTINGS.detector_save_path:
-            self.past_hashes.save(self.hashes.group_name)
+            HASH_WRITER.push(self.hashes.group_name, self.past_hashes)
 
     def update_timestamp(self, play_time):
         # Timestamp already stored or credits not detected
@@ -1018,5 +3133,9 @@ class UpNextDetector(object):
             self.log('Credits detected')
             self.hash_index['detected_at'] = self.hash_index['current']
             self.hashes.timestamps[self.hashes.group_idx] = play_time
-            self.state.set_detected_popup_time(play_time)
-            utils.event('upnext_credits_detected', internal=True)
+            # Keep hashes around the detected timestamp until they are saved
+            self.hashes.set_limit(None)
+            # Nothing to notify if replaying a capture trace
+            if self.state:
+                self.state.set_detected_popup_time(play_time)
+                utils.event('upnext_credits_detected', internal=True)
@@ -5,6 +5,7 @@
 from __future__ import absolute_import, division, unicode_literals
 
 import errno
+import os
 import os.path
 
 import xbmc
@@ -33,6 +34,26 @@ def create_directory(path):
     return True
 
 
+def write_atomic(filename, data, mode='wb'):
+    """Write data to a temporary file, then rename the temporary file to
+       replace filename, so that filename is never left partially written"""
+
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, mode) as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+
+    try:
+        os.replace(temp_filename, filename)
+    # Python 2 does not have os.replace, and os.rename does not overwrite an
+    # existing file on Windows
+    except AttributeError:
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+
+
 def get_legal_filename(filename, path='', prefix='', suffix=''):
     """Returns a legal filename, from an arbitrary string input, as a string"""
 
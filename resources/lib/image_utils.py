@@ -4,12 +4,225 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import threading
+import timeit
+from collections import OrderedDict
+
 from PIL import Image, ImageChops, ImageDraw, ImageFilter
+import constants
+import utils
 from settings import SETTINGS
 
-_PRECOMPUTED = {
-    '_STACK': [],
-}
+try:
+    from queue import Queue, Full as QueueFull
+except ImportError:
+    from Queue import Queue, Full as QueueFull
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _PrecomputeCache(object):
+    """Cache of precomputed lookup tables, filters and masks, keyed by method
+       and size, shared by all threads. Least recently used elements are
+       discarded once the approximate memory used exceeds the limit (in
+       bytes). Also holds the image stack of the current process call, which
+       is kept separately for each thread"""
+
+    __slots__ = (
+        '_cache',
+        '_local',
+        '_lock',
+        'hits',
+        'limit',
+        'misses',
+        'size',
+    )
+
+    # Approximate memory used by each element that is not an image
+    _ENTRY_SIZE = 2048
+
+    def __init__(self, limit):
+        self._cache = OrderedDict()
+        self._local = threading.local()
+        self._lock = utils.create_lock()
+        self.hits = 0
+        self.limit = limit
+        self.misses = 0
+        self.size = 0
+
+    @classmethod
+    def _estimate_size(cls, element):
+        if isinstance(element, Image.Image):
+            return element.size[0] * element.size[1] * len(element.getbands())
+        return cls._ENTRY_SIZE
+
+    @property
+    def stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            return self.reset_stack()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self.size = 0
+
+    def get(self, key):
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if not cached:
+                self.misses += 1
+                return None
+            # Re-insert as most recently used
+            self._cache[key] = cached
+            self.hits += 1
+        return cached[0]
+
+    def put(self, key, element):
+        """Add element and discard least recently used elements, always
+           keeping at least the most recent element"""
+
+        size = self._estimate_size(element)
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if cached:
+                self.size -= cached[1]
+            self._cache[key] = (element, size)
+            self.size += size
+
+            while self.size > self.limit and len(self._cache) > 1:
+                _, (_, discarded_size) = self._cache.popitem(last=False)
+                self.size -= discarded_size
+
+    def reset_stack(self):
+        stack = []
+        self._local.stack = stack
+        return stack
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._cache),
+                'size': self.size,
+            }
+
+
+_PRECOMPUTED = _PrecomputeCache(constants.DETECTOR_PRECOMPUTE_LIMIT)
+
+
+class _DebugImageWriter(object):
+    """Saves debug images as PNG files in a background thread, so that
+       processing is not delayed by image encoding and disk I/O. Images are
+       dropped, rather than waiting to be queued, if too many images are
+       waiting to be saved"""
+
+    __slots__ = (
+        '_lock',
+        '_queue',
+        '_thread',
+        'dropped',
+        'failed',
+        'saved',
+    )
+
+    def __init__(self, maxsize):
+        self._lock = utils.create_lock()
+        self._queue = Queue(maxsize=maxsize)
+        self._thread = None
+        self.dropped = 0
+        self.failed = 0
+        self.saved = 0
+
+    def _run(self):
+        while True:
+            queued = self._queue.get()
+            if queued is None:
+                self._queue.task_done()
+                break
+
+            saved = False
+            try:
+                image, filename = queued
+                image.save(filename, format='PNG', compress_level=1)
+                saved = True
+            # Keep saving queued images after any error, as the thread is only
+            # restarted when the next image is queued
+            except Exception:  # pylint: disable=broad-except
+                pass
+            # Always mark as done so that flush and stop do not wait forever
+            finally:
+                queued = image = None
+                with self._lock:
+                    if saved:
+                        self.saved += 1
+                    else:
+                        self.failed += 1
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until all queued images have been saved"""
+
+        if self._thread and self._thread.is_alive():
+            self._queue.join()
+
+    def put(self, image, filename):
+        """Queue image to be saved as filename, without waiting. Returns
+           False if the image was dropped, otherwise returns True"""
+
+        with self._lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = utils.run_threaded(self._run)
+
+        try:
+            self._queue.put_nowait((image, filename))
+        except QueueFull:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'saved': self.saved,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'pending': self._queue.qsize(),
+            }
+
+    def stop(self):
+        """Save all queued images and then stop the writer thread"""
+
+        if not (self._thread and self._thread.is_alive()):
+            return
+
+        self._queue.put(None)
+        self._queue.join()
+        self._thread.join()
+        self._thread = None
+
+
+_DEBUG_WRITER = _DebugImageWriter(constants.DETECTOR_DEBUG_SAVE_QUEUE_SIZE)
+
+# Histograms of time taken by each processing step, keyed by step name
+_STEP_TIMES = {}
+_STEP_TIMES_LOCK = threading.Lock()
+
+
+def _step_histogram(name):
+    histogram = _STEP_TIMES.get(name)
+    if histogram is None:
+        with _STEP_TIMES_LOCK:
+            histogram = _STEP_TIMES.setdefault(name, utils.Histogram())
+    return histogram
 
 
 try:
@@ -20,6 +233,51 @@ except NameError:
     _SPLIT = str.split
 
 
+def _auto_level_lut(histogram, min_value=0, max_value=100, clip=(0, None)):
+    levels = [value for value, num in enumerate(histogram) if num]
+    if not levels:
+        return None
+
+    if max_value - min_value == 100:
+        min_value, max_value = levels[0], levels[-1]
+
+    else:
+        percentage = len(levels) / 100
+
+        max_value = max(max_value, min_value + (1 / percentage))
+        max_value = int(max_value * percentage) - 1
+        max_value = levels[max_value]
+
+        min_value = int(min_value * percentage)
+        min_value = levels[min_value]
+
+    if min_value >= max_value:
+        return None
+
+    if clip[0] < 1:
+        offset = 0
+        if clip[1] == 0:
+            scale = max_value
+        elif clip[1] == 1:
+            scale = 255 - min_value
+            offset = min_value
+        else:
+            scale = 255
+
+        scale = 1 / max(clip[0], (max_value - min_value) / scale)
+        offset = scale * (min_value - offset)
+
+        return _linear_lut(scale, offset)
+
+    return _clip_lut(range(256), min_value, max_value)
+
+
+def _auto_threshold_lut(histogram):
+    target = _otsu_threshold(histogram)
+
+    return _precompute('THRESHOLD_LUT,{0}'.format(target))
+
+
 def _bit_depth_lut(bit_depth, scale=None, _int=int):
     num_levels = 2 ** bit_depth
     bit_mask = ~((2 ** (8 - bit_depth)) - 1)
@@ -132,6 +390,61 @@ def _fade_mask(size, level_start, level_stop, steps, power, box,
     return element
 
 
+def _clip_lut(lut, min_value=0, max_value=255):
+    return [
+        min_value if level <= min_value
+        else max_value if level >= max_value
+        else level
+        for level in lut
+    ]
+
+
+def _export_bits_lut(_histogram):
+    return _precompute('BIT_CHAR_LUT')
+
+
+def _export_bits_output(image):
+    return int(image.tobytes(), 2)
+
+
+def _export_data_lut(_histogram):
+    return _precompute('BIT_DEPTH_LUT,1,0.0078125')
+
+
+def _export_data_output(image):
+    return tuple(image.getdata())
+
+
+def _fused_point(image, luts, output=None, use_histogram=True):
+    """Applies a sequence of point operations to an image in a single pass,
+       using a lookup table composed from the lookup table of each operation.
+       Lookup tables derived from the image histogram are calculated from the
+       histogram as transformed by the preceding operations"""
+
+    histogram = image.histogram() if use_histogram else None
+    composed_lut = None
+
+    for lut_method, args in luts:
+        lut = lut_method(histogram, *args)
+        if not lut:
+            continue
+        # Clip levels to 8 bit range, as would be done by Image.point, so that
+        # lookup tables can be composed
+        lut = _clip_lut(lut)
+
+        if composed_lut:
+            composed_lut = [lut[level] for level in composed_lut]
+        else:
+            composed_lut = lut
+        if use_histogram:
+            histogram = _remap_histogram(histogram, lut)
+
+    if composed_lut:
+        image = image.point(composed_lut)
+
+    return output(image) if output else image
+
+
 def _histogram_rank(input_data, percentile, skip_levels=0):
     if isinstance(input_data, Image.Image):
         total = input_data.size[0] * input_data.size[1]
@@ -158,13 +471,115 @@ def _histogram_rank(input_data, percentile, skip_levels=0):
     return target
 
 
-def _precompute(method, size=None, debug=SETTINGS.detector_debug_save):
-    element = _PRECOMPUTED.get(method)
-    try:
-        if element and size == getattr(element, 'size', element.get('size')):
-            return element
-    except AttributeError:
-        pass
+def _linear_lut_numpy(scale, offset):
+    return numpy.trunc(scale * numpy.arange(256) - offset).astype(int).tolist()
+
+
+def _linear_lut_python(scale, offset, _int=int):
+    return [_int(scale * i - offset) for i in range(256)]
+
+
+def _otsu_threshold_numpy(histogram):
+    histogram = numpy.asarray(histogram)
+    levels = numpy.arange(len(histogram))
+
+    delta = histogram / int(histogram.sum())
+    delta_reversed = delta[::-1]
+    cum_sum = numpy.cumsum(delta)[:-1]
+    cum_sum_reversed = numpy.cumsum(delta_reversed)[::-1][1:]
+    cum_integral = numpy.cumsum(delta * levels)[:-1]
+    cum_integral_reversed = numpy.cumsum(
+        delta_reversed * levels[::-1]
+    )[::-1][1:]
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        variance = cum_sum * cum_sum_reversed * (
+            (cum_integral / cum_sum)
+            - (cum_integral_reversed / cum_sum_reversed)
+        ) ** 2
+    variance = numpy.where(
+        (cum_sum != 0) & (cum_sum_reversed != 0)
+        & (cum_integral != 0) & (cum_integral_reversed != 0),
+        variance, 0
+    )
+
+    # Last level with maximum variance
+    target = len(variance) - 1 - int(numpy.argmax(variance[::-1]))
+    return target + 1
+
+
+def _otsu_threshold_python(histogram):  # pylint: disable=too-many-locals
+    cum_sum = [0] * 256
+    cum_sum_reversed = [0] * 256
+    cum_integral = [0] * 256
+    cum_integral_reversed = [0] * 256
+
+    sum_total = sum(histogram)
+    running_total = 0
+    running_total_reversed = 0
+    running_integral = 0
+    running_integral_reversed = 0
+
+    for idx, (num, num_reversed) in enumerate(zip(histogram, histogram[::-1])):
+        delta = num / sum_total
+        running_total += delta
+        running_integral += delta * idx
+
+        delta_reversed = num_reversed / sum_total
+        running_total_reversed += delta_reversed
+        running_integral_reversed += delta_reversed * (255 - idx)
+
+        cum_sum[idx] = running_total
+        cum_sum_reversed[255 - idx] = running_total_reversed
+
+        cum_integral[idx] = running_integral
+        cum_integral_reversed[255 - idx] = running_integral_reversed
+
+    variance = [
+        running_total * running_total_reversed * (
+            (running_integral / running_total)
+            - (running_integral_reversed / running_total_reversed)
+        ) ** 2
+        if running_total and running_total_reversed
+        and running_integral and running_integral_reversed
+        else 0
+        for running_total, running_total_reversed,
+        running_integral, running_integral_reversed in
+        zip(cum_sum[:-1], cum_sum_reversed[1:],
+            cum_integral[:-1], cum_integral_reversed[1:])
+    ]
+
+    target = max(variance)
+    target = max([idx for idx, val in enumerate(variance) if val == target])  # pylint: disable=consider-using-generator
+    target = target + 1
+
+    return target
+
+
+def _points_of_interest_lut(histogram, percentile=50, skip_levels=0):
+    # Transform image to show absolute deviation from median pixel luma
+    target = _histogram_rank(histogram, 50)
+    deviation = _precompute('DEVIATION_LUT,{0}'.format(target))
+
+    # Calculate percentile of absolute deviation from the median to represent
+    # significant pixels and use transformed image as the hash of the
+    # current video frame
+    target = _histogram_rank(
+        _remap_histogram(histogram, deviation), percentile, skip_levels
+    )
+    threshold = _precompute('THRESHOLD_LUT,{0}'.format(target))
+    return [threshold[level] for level in deviation]
+
+
+def _posterise_lut(_histogram, bit_depth):
+    return _precompute('BIT_DEPTH_LUT,{}'.format(bit_depth))
+
+
+def _precompute(method, size=None, debug=SETTINGS.detector_debug_save):  # pylint: disable=too-many-branches,too-many-statements
+    key = (method, size)
+    element = _PRECOMPUTED.get(key)
+    if element is not None:
+        return element
 
     element, _, args = method.partition(',')
     args = _to_numbers(args)
@@ -174,10 +589,33 @@ def _precompute(method, size=None, debug=SETTINGS.detector_debug_save):
         element[0] = 0
         debug = False
 
+    elif element == 'BIT_CHAR_LUT':
+        # Map 1 bit depth levels to ASCII '0' or '1' for parsing as an integer
+        element = [48] * 128 + [49] * 128
+        debug = False
+
     elif element == 'BIT_DEPTH_LUT':
         element = _bit_depth_lut(*args)  # pylint: disable=no-value-for-parameter
         debug = False
 
+    elif element == 'DEVIATION_LUT':
+        # Absolute deviation of each level from the target level
+        element = [abs(i - args[0]) for i in range(256)]
+        debug = False
+
+    elif element == 'RULE_LUTS':
+        element = _rule_luts(*args)  # pylint: disable=no-value-for-parameter
+        debug = False
+
+    elif element == 'ZERO_MASK_LUT':
+        element = [0] * 256
+        element[0] = 255
+        debug = False
+
+    elif element == 'THRESHOLD_LUT':
+        element = [255 if (i > args[0]) else 0 for i in range(256)]
+        debug = False
+
     elif element == 'BORDER_BOX':
         element = _border_box(size, *args)  # pylint: disable=no-value-for-parameter
         debug = False
@@ -204,11 +642,11 @@ def _precompute(method, size=None, debug=SETTINGS.detector_debug_save):
         debug = False
 
     if debug:
-        element.save('{0}_{1}.bmp'.format(
+        _DEBUG_WRITER.put(element, '{0}_{1}.png'.format(
             SETTINGS.detector_save_path, method
         ))
 
-    _PRECOMPUTED[method] = element
+    _PRECOMPUTED.put(key, element)
     return element
 
 
@@ -242,6 +680,55 @@ def _precision(number, decimal_places=3):
     return int(number * factor) / factor
 
 
+def _remap_histogram(histogram, lut):
+    remapped = [0] * 256
+    for level, num in enumerate(histogram):
+        if num:
+            remapped[lut[level]] += num
+    return remapped
+
+
+def _rule_luts(local_min, local_max, percent_lo, percent_hi):
+    """Returns lookup tables of the lowest and highest pixel levels that
+       satisfy a conditional_filter rule, indexed by the aggregate level.
+       Aggregate levels with no matching pixel levels map to an empty range"""
+
+    lower = [255] * 256
+    upper = [0] * 256
+
+    for aggregate in range(256):
+        if not local_max >= aggregate > local_min:
+            continue
+
+        # Pixel to aggregate ratio increases with pixel level, so matching
+        # pixel levels form a single contiguous range
+        levels = [
+            pixel for pixel in range(256)
+            if not aggregate
+            or percent_hi >= pixel / aggregate > percent_lo
+        ]
+        if levels:
+            lower[aggregate] = levels[0]
+            upper[aggregate] = levels[-1]
+
+    return lower, upper
+
+
+def _rule_mask(image, aggregate_image, rule,
+               _lighter=ImageChops.lighter, _point=Image.Image.point,
+               _subtract=ImageChops.subtract):
+    lower, upper = _precompute(
+        'RULE_LUTS,{0},{1},{2},{3}'.format(*rule)
+    )
+
+    # Zero where pixel level is greater than or equal to the lower level
+    below = _subtract(_point(aggregate_image, lower), image)
+    # Zero where pixel level is less than or equal to the upper level
+    above = _subtract(image, _point(aggregate_image, upper))
+
+    return _point(_lighter(below, above), _precompute('ZERO_MASK_LUT'))
+
+
 def _to_numbers(args, _int=int, _float=float, _split=_SPLIT):
     if not args:
         return []
@@ -253,10 +740,20 @@ def _to_numbers(args, _int=int, _float=float, _split=_SPLIT):
     ]
 
 
+# Use NumPy, if available, to calculate linear lookup tables and Otsu
+# thresholds, otherwise use pure Python implementations with identical outputs
+if numpy:
+    _linear_lut = _linear_lut_numpy
+    _otsu_threshold = _otsu_threshold_numpy
+else:
+    _linear_lut = _linear_lut_python
+    _otsu_threshold = _otsu_threshold_python
+
+
 def adaptive_filter(image, sampling, method, args=(), save_file=None,  # pylint: disable=too-many-locals
                     _crop=Image.Image.crop, _copy=Image.Image.copy,
                     _format=_FORMAT, _int=int, _paste=Image.Image.paste,
-                    _range=range, _save=Image.Image.save):
+                    _range=range, _save=_DEBUG_WRITER.put):
     segments, overlap, mask = sampling
 
     crop_box = _precompute(
@@ -296,9 +793,11 @@ def adaptive_filter(image, sampling, method, args=(), save_file=None,  # pylint:
             new_segment = method(new_segment, *args)
 
             _paste(output, new_segment, box=new_segment_location, mask=mask)
+            # Output of each segment is saved, so save a copy as the output
+            # image will be changed by the next segment
             if save_file and SETTINGS.detector_debug_save:
-                _save(output, _format(
-                    '{0}{1}[{2}.{3}].bmp',
+                _save(_copy(output), _format(
+                    '{0}{1}[{2}.{3}].png',
                     SETTINGS.detector_save_path, save_file,
                     vertical_idx, horizontal_idx
                 ))
@@ -307,98 +806,18 @@ def adaptive_filter(image, sampling, method, args=(), save_file=None,  # pylint:
     return image
 
 
-def auto_level(image, min_value=0, max_value=100, clip=(0, None), _int=int):
-    if max_value - min_value == 100:
-        min_value, max_value = image.getextrema()
-
-    else:
-        levels = [value for value, num in enumerate(image.histogram()) if num]
-        percentage = len(levels) / 100
-
-        max_value = max(max_value, min_value + (1 / percentage))
-        max_value = int(max_value * percentage) - 1
-        max_value = levels[max_value]
-
-        min_value = int(min_value * percentage)
-        min_value = levels[min_value]
-
-    if min_value >= max_value:
+def auto_level(image, min_value=0, max_value=100, clip=(0, None)):
+    lut = _auto_level_lut(image.histogram(), min_value, max_value, clip)
+    if not lut:
         return image
 
-    if clip[0] < 1:
-        offset = 0
-        if clip[1] == 0:
-            scale = max_value
-        elif clip[1] == 1:
-            scale = 255 - min_value
-            offset = min_value
-        else:
-            scale = 255
-
-        scale = 1 / max(clip[0], (max_value - min_value) / scale)
-        offset = scale * (min_value - offset)
-
-        return image.point([
-            _int(scale * i - offset)
-            for i in range(256)
-        ])
-
-    return image.point([
-        min_value if i <= min_value else max_value if i >= max_value else i
-        for i in range(256)
-    ])
-
-
-def auto_threshold(image):  # pylint: disable=too-many-locals
-    histogram = image.histogram()
-
-    cum_sum = [0] * 256
-    cum_sum_reversed = [0] * 256
-    cum_integral = [0] * 256
-    cum_integral_reversed = [0] * 256
-
-    sum_total = image.size[0] * image.size[1]
-    running_total = 0
-    running_total_reversed = 0
-    running_integral = 0
-    running_integral_reversed = 0
-
-    for idx, (num, num_reversed) in enumerate(zip(histogram, histogram[::-1])):
-        delta = num / sum_total
-        running_total += delta
-        running_integral += delta * idx
-
-        delta_reversed = num_reversed / sum_total
-        running_total_reversed += delta_reversed
-        running_integral_reversed += delta_reversed * (255 - idx)
-
-        cum_sum[idx] = running_total
-        cum_sum_reversed[255 - idx] = running_total_reversed
-
-        cum_integral[idx] = running_integral
-        cum_integral_reversed[255 - idx] = running_integral_reversed
-
-    variance = [
-        running_total * running_total_reversed * (
-            (running_integral / running_total)
-            - (running_integral_reversed / running_total_reversed)
-        ) ** 2
-        if running_total and running_total_reversed
-        and running_integral and running_integral_reversed
-        else 0
-        for running_total, running_total_reversed,
-        running_integral, running_integral_reversed in
-        zip(cum_sum[:-1], cum_sum_reversed[1:],
-            cum_integral[:-1], cum_integral_reversed[1:])
-    ]
+    return image.point(lut)
 
-    target = max(variance)
-    target = max([idx for idx, val in enumerate(variance) if val == target])  # pylint: disable=consider-using-generator
-    target = target + 1
 
-    image = image.point([255 if (i > target) else 0 for i in range(256)])
+def auto_threshold(image):
+    lut = _auto_threshold_lut(image.histogram())
 
-    return image
+    return image.point(lut)
 
 
 def apply_filter(image, method, extent=None, original=None, output_op=None):
@@ -442,118 +861,56 @@ def apply_filter(image, method, extent=None, original=None, output_op=None):
     return image
 
 
-def conditional_filter(image, rules=((), ()), output=None,  # pylint: disable=too-many-locals
+def conditional_filter(image, rules=((), ()), output=None,
                        filter_args=(None, ), save_file=None,
-                       _draw=ImageDraw.Draw, _format=_FORMAT,
-                       _new=Image.new, _point=ImageDraw.ImageDraw.point,
-                       _save=Image.Image.save, _tuple=tuple):
+                       _composite=Image.composite, _format=_FORMAT,
+                       _lighter=ImageChops.lighter, _new=Image.new,
+                       _save=_DEBUG_WRITER.put,
+                       _subtract=ImageChops.subtract):
     aggregate_image = apply_filter(image, *filter_args)
-    data = enumerate(zip(image.getdata(), aggregate_image.getdata()))
-    inclusions = enumerate(rules[0])
-    exclusions = enumerate(rules[1])
-    width = image.size[0]
-
-    if save_file and SETTINGS.detector_debug_save:
-        data = _tuple(data)
-        inclusions = _tuple(inclusions)
-        exclusions = _tuple(exclusions)
-        rules = inclusions + exclusions
-
-        aggregate_image.save(_format(
-            '{0}{1}[{2}].bmp',
+    debug = save_file and SETTINGS.detector_debug_save
+
+    if debug:
+        _save(aggregate_image, _format(
+            '{0}{1}[{2}].png',
             SETTINGS.detector_save_path, save_file,
             filter_args[0]
         ))
 
-        for idx, (local_min, local_max, percent_lo, percent_hi) in rules:
-            debug_output = _new('L', image.size, 0)
-            draw_canvas = _draw(debug_output)
-            _point(draw_canvas, [
-                (idx % width, idx // width)
-                for idx, (pixel, aggregate) in data
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-            ], fill=255)
-            _save(debug_output, _format(
-                '{0}{1}[{2}][{3}].bmp',
-                SETTINGS.detector_save_path, save_file,
-                filter_args[0],
-                rules[idx]
-            ))
+    # Each rule is evaluated as a mask of matching pixels, with the masks of
+    # all inclusion rules and all exclusion rules combined using a union
+    masks = [None, None]
+    for idx, rule_set in enumerate(rules):
+        for rule in rule_set:
+            mask = _rule_mask(image, aggregate_image, rule)
+            if debug:
+                _save(mask, _format(
+                    '{0}{1}[{2}][{3}].png',
+                    SETTINGS.detector_save_path, save_file,
+                    filter_args[0], rule
+                ))
+            masks[idx] = _lighter(masks[idx], mask) if masks[idx] else mask
 
-    if output != 'FILTER':
-        image = _new('L', image.size, 0)
+    inclusion_mask, exclusion_mask = masks
+    if not inclusion_mask:
+        inclusion_mask = _new('L', image.size, 0)
+    # Difference of inclusion mask and exclusion mask
+    elif exclusion_mask:
+        inclusion_mask = _subtract(inclusion_mask, exclusion_mask)
 
     if output == 'THRESHOLD':
-        draw_canvas = _draw(image)
-        _ = [[
-            _point(draw_canvas, (idx % width, idx // width), fill=pixel)
-            for idx, (pixel, aggregate) in data
-            if (local_max >= aggregate > local_min)
-            and (
-                not aggregate
-                or percent_hi >= pixel / aggregate > percent_lo
-            )
-            and not [
-                1 for _, (local_min, local_max, percent_lo, percent_hi)
-                in exclusions
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-            ]
-        ] for _, (local_min, local_max, percent_lo, percent_hi) in inclusions]
-
-    elif output[:6] == 'FILTER':
-        draw_canvas = _draw(image)
-        _ = [[
-            _point(draw_canvas, (idx % width, idx // width), fill=aggregate)
-            for idx, (pixel, aggregate) in data
-            if (local_max >= aggregate > local_min)
-            and (
-                not aggregate
-                or percent_hi >= pixel / aggregate > percent_lo
-            )
-            and not [
-                1 for _, (local_min, local_max, percent_lo, percent_hi)
-                in exclusions
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-            ]
-        ] for _, (local_min, local_max, percent_lo, percent_hi) in inclusions]
-
-    else:  # if output == 'MASK':
-        draw_canvas = _draw(image)
-        _ = [
-            _point(draw_canvas, [
-                (idx % width, idx // width)
-                for idx, (pixel, aggregate) in data
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-                and not [
-                    1 for _, (local_min, local_max, percent_lo, percent_hi)
-                    in exclusions
-                    if (local_max >= aggregate > local_min)
-                    and (
-                        not aggregate
-                        or percent_hi >= pixel / aggregate > percent_lo
-                    )
-                ]
-            ], fill=255)
-            for _, (local_min, local_max, percent_lo, percent_hi) in inclusions
-        ]
+        return _composite(image, _new('L', image.size, 0), inclusion_mask)
 
-    return image
+    if output == 'FILTER':
+        return _composite(aggregate_image, image, inclusion_mask)
+
+    if output and output[:6] == 'FILTER':
+        return _composite(
+            aggregate_image, _new('L', image.size, 0), inclusion_mask
+        )
+
+    # if output == 'MASK':
+    return inclusion_mask
 
 
 def detail_reduce(image, base_image, reduction=25,
@@ -576,10 +933,16 @@ def detail_reduce(image, base_image, reduction=25,
     return image
 
 
+def export_bits(image):
+    lut = _export_bits_lut(None)
+
+    return _export_bits_output(image.point(lut))
+
+
 def export_data(image):
-    lut = _precompute('BIT_DEPTH_LUT,1,0.0078125')
+    lut = _export_data_lut(None)
 
-    return tuple(image.point(lut).getdata())
+    return _export_data_output(image.point(lut))
 
 
 def entropy_compare(image, filtered_image, threshold=1.10, save_file=None):
@@ -601,7 +964,7 @@ def entropy_compare(image, filtered_image, threshold=1.10, save_file=None):
         output_image.paste(image, mask=expanded_image)
 
         if save_file and SETTINGS.detector_debug_save:
-            output_image.save('{0}{1}_2.bmp'.format(
+            _DEBUG_WRITER.put(output_image, '{0}{1}_2.png'.format(
                 SETTINGS.detector_save_path, save_file
             ))
 
@@ -610,9 +973,37 @@ def entropy_compare(image, filtered_image, threshold=1.10, save_file=None):
     return False, None
 
 
+def frame_digest(input_data, buffer_size, digest_size=(16, 9), bit_depth=6):
+    """Returns a digest of captured image data, as the bytes of a small,
+       reduced bit depth luma thumbnail, so that identical or nearly identical
+       frames have the same digest"""
+
+    image = import_data(input_data, buffer_size)
+    image = resize(image, digest_size, constants.PIL_RESIZE_METHODS[1])
+    lut = _precompute('BIT_DEPTH_LUT,{0},1'.format(bit_depth))
+
+    return image.convert('L').point(lut).tobytes()
+
+
+def histogram_bins(image, bins=16):
+    """Returns the image histogram reduced to the given number of bins, with
+       each bin normalised to the fraction of pixels in the image"""
+
+    histogram = image.histogram()
+    total = sum(histogram)
+    if not total:
+        return [0] * bins
+
+    step = len(histogram) // bins
+    return [
+        sum(histogram[idx:idx + step]) / total
+        for idx in range(0, step * bins, step)
+    ]
+
+
 def image_stack(index):
     def _image_stack_fetch():
-        return _PRECOMPUTED['_STACK'][index]
+        return _PRECOMPUTED.stack[index]
     return _image_stack_fetch
 
 
@@ -660,45 +1051,171 @@ def output_histogram(input_data, scale_to_max=False, save_file=None):
         draw_canvas.line((x_coord, x_axis, x_coord, y_coord), line_colour, 1)
 
     if save_file:
-        image.save('{0}{1}.bmp'.format(SETTINGS.detector_save_path, save_file))
+        _DEBUG_WRITER.put(image, '{0}{1}.png'.format(
+            SETTINGS.detector_save_path, save_file
+        ))
         if isinstance(input_data, Image.Image):
             return None
 
     return image
 
 
-def points_of_interest(image, percentile=50, skip_levels=0, _abs=abs):
-    # Transform image to show absolute deviation from median pixel luma
-    target = _histogram_rank(image, 50)
-    image = image.point([_abs(i - target) for i in range(256)])
-
-    # Calculate percentile of absolute deviation from the median to represent
-    # significant pixels and use transformed image as the hash of the
-    # current video frame
-    target = _histogram_rank(image, percentile, skip_levels)
-    image = image.point([255 if (i > target) else 0 for i in range(256)])
+def points_of_interest(image, percentile=50, skip_levels=0):
+    lut = _points_of_interest_lut(image.histogram(), percentile, skip_levels)
 
-    return image
+    return image.point(lut)
 
 
 def posterise(image, bit_depth):
-    lut = _precompute('BIT_DEPTH_LUT,{}'.format(bit_depth))
+    lut = _posterise_lut(None, bit_depth)
 
     return image.point(lut)
 
 
+def precompute_stats():
+    """Returns hit and miss counts, and approximate memory used, for the cache
+       of precomputed elements"""
+
+    return _PRECOMPUTED.stats()
+
+
+def debug_save_stats():
+    """Returns counts of debug images saved, dropped because too many images
+       were waiting to be saved, failed to be saved, and waiting to be saved"""
+
+    return _DEBUG_WRITER.stats()
+
+
+def debug_save_stop():
+    """Save all debug images waiting to be saved and then stop saving images
+       in the background"""
+
+    _DEBUG_WRITER.stop()
+
+
+def step_stats():
+    """Returns histograms of the time taken by each processing step, run in
+       this process, as dicts keyed by step name"""
+
+    return {
+        name: histogram.snapshot()
+        for name, histogram in _STEP_TIMES.items()
+    }
+
+
+def compile_pipeline(queue, save_file=None,  # pylint: disable=dangerous-default-value,too-many-locals
+                     debug=SETTINGS.detector_debug_save,
+                     _callable=callable, _enumerate=enumerate,
+                     _in_place=frozenset((adaptive_filter, )), _list=list,
+                     _lut_methods={
+                         auto_level: (_auto_level_lut, None),
+                         auto_threshold: (_auto_threshold_lut, None),
+                         export_bits: (_export_bits_lut, _export_bits_output),
+                         export_data: (_export_data_lut, _export_data_output),
+                         points_of_interest: (_points_of_interest_lut, None),
+                         posterise: (_posterise_lut, None),
+                     },
+                     _static_luts=frozenset((
+                         _export_bits_lut, _export_data_lut, _posterise_lut
+                     )),
+                     _tuple=tuple):
+    """Returns a function that applies the queue of processing steps to its
+       input, with the same output as process, but with step arguments only
+       processed once. Consecutive point operations are fused and applied to
+       the image in a single pass"""
+
+    queue = [_list(step) for step in queue]
+
+    # Saving of intermediate images and references to the image stack require
+    # each step to be run separately by process
+    if (debug and save_file) or [
+            arg for step in queue for arg in step[1:]
+            if _callable(arg) and arg.__name__ == '_image_stack_fetch'
+    ]:
+        def _process(data):
+            return process(data, [_list(step) for step in queue], save_file)
+        return _process
+
+    steps = []
+    luts = []
+
+    def _add_luts(output=None):
+        if luts:
+            use_histogram = bool([
+                lut_method for lut_method, _ in luts
+                if lut_method not in _static_luts
+            ])
+            name = '+'.join([
+                lut_method.__name__[1:-4] for lut_method, _ in luts
+            ])
+            steps.append((
+                _fused_point, (_tuple(luts), output, use_histogram), (), False,
+                _step_histogram(name).record
+            ))
+            del luts[:]
+
+    for step in queue:
+        method, args = step[0], _tuple(step[1:])
+        lut_method, output = _lut_methods.get(method, (None, None))
+        if lut_method:
+            luts.append((lut_method, args))
+            if output:
+                _add_luts(output)
+            continue
+
+        _add_luts()
+        steps.append((
+            method,
+            args,
+            _tuple(idx for idx, arg in _enumerate(args) if arg == 'INPUT'),
+            method in _in_place,
+            _step_histogram(method.__name__).record,
+        ))
+    _add_luts()
+
+    def _pipeline(data, _copy=Image.Image.copy, _isinstance=isinstance,
+                  _timer=timeit.default_timer):
+        input_data = data
+        output = None
+
+        for method, args, input_idx, in_place, record in steps:
+            if input_idx:
+                args = [
+                    input_data if idx in input_idx else arg
+                    for idx, arg in _enumerate(args)
+                ]
+            if in_place and _isinstance(data, Image.Image):
+                data = _copy(data)
+
+            start = _timer()
+            output = method(data, *args)
+            record(_timer() - start)
+            if output or _isinstance(output, Image.Image):
+                data = output
+
+        return output
+
+    return _pipeline
+
+
 def process(data, queue, save_file=None, debug=SETTINGS.detector_debug_save,
             _append=list.append, _callable=callable, _copy=Image.Image.copy,
-            _enumerate=enumerate, _float=float, _format=_FORMAT, _int=int,
+            _enumerate=enumerate, _float=float, _format=_FORMAT,
+            _in_place=frozenset((adaptive_filter, )), _int=int,
             _isinstance=isinstance, _list=list, _pop=list.pop, _str=str,
-            _save=Image.Image.save, _tuple=tuple):
-    _PRECOMPUTED['_STACK'] = []
-    if _isinstance(data, Image.Image):
-        data = data.copy()
+            _save=_DEBUG_WRITER.put, _timer=timeit.default_timer,
+            _tuple=tuple):
+    stack = _PRECOMPUTED.reset_stack()
+    input_data = data
     debug = debug and save_file
 
     for step, args in _enumerate(queue):
         method = _pop(args, 0)
+        # Most methods return a new image and leave their input unchanged, so
+        # only copy the input image, which may be the output of a previous
+        # step or the image passed in, for methods that modify it in place
+        if method in _in_place and _isinstance(data, Image.Image):
+            data = _copy(data)
 
         args_enum = _enumerate(args)
         if debug:
@@ -723,11 +1240,16 @@ def process(data, queue, save_file=None, debug=SETTINGS.detector_debug_save,
                     and arg.__name__ == '_image_stack_fetch']:
             args[idx] = args[idx]()
 
+        for idx in [idx for idx, arg in _enumerate(args) if arg == 'INPUT']:
+            args[idx] = input_data
+
+        start = _timer()
         output = method(data, *args)
-        _append(_PRECOMPUTED['_STACK'], output)
+        _step_histogram(method.__name__).record(_timer() - start)
+        _append(stack, output)
 
         if _isinstance(output, Image.Image):
-            data = _copy(output)
+            data = output
         elif output:
             data = output
             continue
@@ -737,12 +1259,9 @@ def process(data, queue, save_file=None, debug=SETTINGS.detector_debug_save,
         if not debug:
             continue
 
-        try:
-            _save(data, _format(
-                '{0}{1}.bmp', SETTINGS.detector_save_path, save_file
-            ))
-        except (IOError, OSError):
-            pass
+        _save(data, _format(
+            '{0}{1}.png', SETTINGS.detector_save_path, save_file
+        ))
 
     return output
 
@@ -8,6 +8,7 @@ from time import time
 import api
 import constants
 import detector
+import image_utils
 import player
 import popuphandler
 import simulation
@@ -566,6 +567,10 @@ class UpNextMonitor(xbmc.Monitor, object):
 
         # Free references/resources
         self._stop_detector(terminate=True)
+        # Ensure that detector hashes and debug images queued for saving are
+        # written to disk
+        detector.HASH_WRITER.stop()
+        image_utils.debug_save_stop()
         self._stop_popuphandler(terminate=True)
         self.waitForAbort(1)
 
@@ -28,12 +28,18 @@ class UpNextSettings(object):
         'detect_mismatches',
         'detect_period',
         'detect_significance',
+        'detector_cpu_budget',
+        'detector_autotune',
         'detector_data_limit',
         'detector_debug',
         'detector_debug_save',
         'detector_filter',
+        'detector_prefilter',
+        'detector_processes',
+        'detector_record_trace',
         'detector_resize_method',
         'detector_save_path',
+        'detector_storage',
         'detector_threads',
         'disabled',
         'early_queue_reset',
@@ -266,10 +272,16 @@ class UpNextSettings(object):
         self.detector_save_path = file_utils.make_legal_path(
             self.get_string('detectorSavePath')
         )
+        self.detector_storage = self.get_int('detectorStorage', default=0)
         self.detector_threads = self.get_int('detectorThreads')
+        self.detector_processes = self.get_bool('detectorProcesses')
         data_limit = self.get_int('detectorDataLimit')
         self.detector_data_limit = data_limit - data_limit % 8
+        self.detector_autotune = self.get_bool('detectorAutotune')
+        self.detector_cpu_budget = self.get_int('detectorCpuBudget',
+                                                default=50)
         self.detector_filter = self.get_bool('detectorFilter')
+        self.detector_prefilter = self.get_bool('detectorPrefilter')
         self.detector_resize_method = constants.PIL_RESIZE_METHODS.get(
             self.get_int('detectorResizeMethod', default=1)
         )
@@ -286,6 +298,8 @@ class UpNextSettings(object):
         self.detector_debug = self.get_bool('detectorDebug')
         self.detector_debug_save = (self.detector_save_path
                                     and self.get_bool('detectorDebugSave'))
+        self.detector_record_trace = (self.detector_save_path
+                                      and self.get_bool('detectorRecordTrace'))
         self.widget_debug = self.get_bool('widgetDebug')
 
         self.start_trigger = self.get_bool('startTrigger')
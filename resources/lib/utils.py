@@ -43,6 +43,84 @@ class ContextManager(object):
         return True
 
 
+class Histogram(object):
+    """Class to count values, such as latencies in seconds, in a fixed number
+       of buckets with upper bounds that double from a minimum value, so that
+       memory used does not grow with the number of values recorded"""
+
+    __slots__ = ('_lock', 'buckets', 'count', 'maximum', 'minimum', 'total', )
+
+    from math import frexp as _frexp
+    _frexp = staticmethod(_frexp)
+
+    def __init__(self, num_buckets=16, minimum=0.0001):
+        self._lock = create_lock()
+        self.buckets = [0] * num_buckets
+        self.count = 0
+        self.maximum = 0
+        self.minimum = minimum
+        self.total = 0
+
+    def record(self, value):
+        if value > self.minimum:
+            idx = min(self._frexp(value / self.minimum)[1],
+                      len(self.buckets) - 1)
+        else:
+            idx = 0
+
+        with self._lock:
+            self.buckets[idx] += 1
+            self.count += 1
+            self.total += value
+            self.maximum = max(self.maximum, value)
+
+    def bound(self, idx):
+        """Returns upper bound of a bucket, or None for the last bucket"""
+
+        if idx >= len(self.buckets) - 1:
+            return None
+        return self.minimum * 2 ** idx
+
+    def percentile(self, fraction):
+        """Returns upper bound of the bucket containing the recorded value at
+           the given fraction of all recorded values, in ascending order"""
+
+        with self._lock:
+            buckets = list(self.buckets)
+            count = self.count
+            maximum = self.maximum
+
+        target = fraction * count
+        total = 0
+        for idx, bucket_count in enumerate(buckets):
+            total += bucket_count
+            if bucket_count and total >= target:
+                bound = self.bound(idx)
+                return maximum if bound is None else min(bound, maximum)
+        return None
+
+    def snapshot(self):
+        """Returns count, mean, maximum, estimated median and 95th percentile,
+           and counts of non-empty buckets as a list of [upper_bound, count]"""
+
+        with self._lock:
+            buckets = list(self.buckets)
+            count = self.count
+            total = self.total
+            maximum = self.maximum
+
+        return {
+            'count': count,
+            'mean': total / count if count else None,
+            'max': maximum,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'buckets': [[self.bound(idx), bucket_count]
+                        for idx, bucket_count in enumerate(buckets)
+                        if bucket_count],
+        }
+
+
 class Profiler(object):
     """Class used to profile a block of code"""
 
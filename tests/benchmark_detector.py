@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+"""UpNext detector benchmark using synthetic sequences of video frames
+
+Runs the detector through the actual capture queue and worker threads, using
+a fake clock for playback time so that results do not depend on wall clock
+time, and outputs the results as JSON. Frames are only processed in order if
+a single worker thread is used, as with more workers the order in which frames
+are processed can vary between runs, as it would in Kodi. Run using:
+
+    make benchmark
+
+or with resources/lib/ and tests/ added to PYTHONPATH:
+
+    python tests/benchmark_detector.py --output results.json
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+import timeit
+
+from PIL import Image, ImageDraw
+
+from settings import SETTINGS
+
+# Disable profiling of detector workers, if the detector is imported here
+_DEBUG, SETTINGS.detector_debug = SETTINGS.detector_debug, False
+import detector  # noqa: E402 pylint: disable=wrong-import-position
+import utils  # noqa: E402 pylint: disable=wrong-import-position
+SETTINGS.detector_debug = _DEBUG
+
+
+# Sequences of (frame type, duration in seconds)
+CREDITS = ('credits', 'end_card')
+SCENARIOS = {
+    'episode': (
+        ('scene', 60),
+        ('title', 5),
+        ('scene', 30),
+        ('fade', 5),
+        ('credits', 40),
+    ),
+    'static_credits': (
+        ('scene', 60),
+        ('fade', 5),
+        ('end_card', 40),
+    ),
+    'no_credits': (
+        ('scene', 40),
+        ('title', 10),
+        ('fade', 5),
+        ('scene', 40),
+        ('fade', 5),
+        ('title', 10),
+    ),
+}
+DATA_LIMITS = (8, 16, 32)
+THREADS = (2, 3, 4)
+SEED = 1
+
+
+class FakeClock(object):  # pylint: disable=too-few-public-methods
+    """Playback time that only advances when the detector waits"""
+
+    __slots__ = ('time', )
+
+    def __init__(self):
+        self.time = 0.0
+
+    def advance(self, delay):
+        # Round up to 0.1s so that small variations in processing time,
+        # subtracted from the capture interval, do not change playback time
+        self.time += math.ceil(10 * max(0, delay or 0)) / 10
+
+
+class FakePlayer(object):
+    """Player that plays at normal speed until the end of the sequence"""
+
+    def __init__(self, clock, duration):
+        self.clock = clock
+        self.duration = duration
+
+    def __enter__(self):
+        return (self, True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return exc_type == RuntimeError
+
+    def getTime(self):  # pylint: disable=invalid-name
+        return self.clock.time
+
+    def getTotalTime(self):  # pylint: disable=invalid-name
+        return self.duration
+
+    def get_speed(self):
+        return 1 if self.clock.time < self.duration else 0
+
+
+class FakeState(object):
+    """Playback state that records the time at which credits are detected"""
+
+    def __init__(self, duration):
+        self.current_item = {'group_name': 'Benchmark', 'group_idx': 1}
+        self.total_time = duration
+        self.detected_at = None
+
+    @staticmethod
+    def get_detect_time():
+        return 0
+
+    def set_detected_popup_time(self, detected_time):
+        if self.detected_at is None:
+            self.detected_at = detected_time
+
+
+class FrameSource(object):
+    """Generates BGRA frames, for a sequence of frame types, that only depend
+       on the frame type, playback time and the random seed"""
+
+    def __init__(self, scenario, seed):
+        self.segments = []
+        start = 0
+        for frame_type, duration in scenario:
+            self.segments.append((start, start + duration, frame_type))
+            start += duration
+        self.duration = start
+        self.seed = seed
+        self._cache = {}
+
+    @property
+    def credits_start(self):
+        for start, _, frame_type in self.segments:
+            if frame_type in CREDITS:
+                return start
+        return None
+
+    def frame(self, play_time, size):
+        for start, end, frame_type in self.segments:
+            if start <= play_time < end:
+                break
+        else:
+            start, end, frame_type = self.segments[-1]
+
+        # Scenes change every 4s, credits and fades change every 1s
+        offset = int(play_time - start)
+        if frame_type == 'scene':
+            offset -= offset % 4
+        elif frame_type in ('title', 'end_card'):
+            offset = 0
+        key = (start, offset, size)
+        if key not in self._cache:
+            image = getattr(self, '_' + frame_type)(
+                size, start, offset, end - start
+            )
+            self._cache = {key: image.tobytes('raw', 'BGRA')}
+        return bytearray(self._cache[key])
+
+    def _scene(self, size, start, offset, _duration):
+        rng = random.Random(hash((self.seed, start, offset)))
+        image = Image.new('RGBA', size, tuple(
+            rng.randint(64, 192) for _ in range(3)
+        ) + (255, ))
+        draw = ImageDraw.Draw(image)
+        width, height = size
+        for _ in range(12):
+            x, y = rng.randint(0, width), rng.randint(0, height)
+            draw.rectangle(
+                (x, y,
+                 x + rng.randint(width // 16, width // 2),
+                 y + rng.randint(height // 16, height // 2)),
+                fill=tuple(rng.randint(0, 255) for _ in range(3)) + (255, )
+            )
+        return image
+
+    def _text(self, size, start, scroll=0):
+        rng = random.Random(hash((self.seed, start)))
+        width, height = size
+        image = Image.new('RGBA', size, (16, 16, 16, 255))
+        draw = ImageDraw.Draw(image)
+        # Lines of centred text, with words of random length
+        line_height = max(2, height // 32)
+        for line in range(height // line_height + 64):
+            y = (line * line_height * 3) // 2 - scroll
+            half_width = rng.randint(width // 8, width // 4)
+            if not 0 <= y < height:
+                continue
+            x = width // 2 - half_width
+            while x < width // 2 + half_width:
+                word = rng.randint(width // 64, width // 24)
+                draw.rectangle((x, y, x + word, y + line_height - 1),
+                               fill=(240, 240, 240, 255))
+                x += word + max(2, width // 96)
+        return image
+
+    def _title(self, size, start, _offset, _duration):
+        return self._text(size, start)
+
+    _end_card = _title
+
+    def _credits(self, size, start, offset, _duration):
+        return self._text(size, start, scroll=offset * max(1, size[1] // 48))
+
+    def _fade(self, size, start, offset, duration):
+        scene = self._scene(size, start, 0, duration)
+        black = Image.new('RGBA', size, (0, 0, 0, 255))
+        return Image.blend(scene, black, min(1, (offset + 1) / duration))
+
+
+def _step_totals(steps):
+    return {
+        name: (stats['count'], stats['count'] * (stats['mean'] or 0))
+        for name, stats in steps.items()
+    }
+
+
+def run(scenario_name, data_limit, num_threads, seed=SEED):  # pylint: disable=too-many-locals
+    """Run the detector over a scenario and return a dict of results"""
+
+    source = FrameSource(SCENARIOS[scenario_name], seed)
+    clock = FakeClock()
+    player = FakePlayer(clock, source.duration)
+    state = FakeState(source.duration)
+    upnext_detector = detector.UpNextDetector(player, state)
+
+    class FakeRenderCapture(object):
+        """Captures the synthetic frame at the current playback time"""
+
+        def __init__(self):
+            self.size = (0, 0)
+
+        def capture(self, width, height):
+            self.size = (width, height)
+
+        def getImage(self, msecs=None):  # pylint: disable=invalid-name,unused-argument
+            return source.frame(clock.time, self.size)
+
+    def fake_wait(timeout=None):
+        # Only advance playback time once there is a free worker for the next
+        # captured frame, as if processing was completed within the capture
+        # interval. Queue includes an unfinished task for the capture loop.
+        queue = upnext_detector.queue
+        deadline = timeit.default_timer() + 10
+        while (queue and queue.unfinished_tasks > num_threads - 1
+               and timeit.default_timer() < deadline):
+            time.sleep(0.0005)
+        clock.advance(timeout)
+        return False
+
+    def run_threaded(target, delay=None, args=None, kwargs=None):  # pylint: disable=unused-argument
+        # Start workers immediately, rather than waiting in real time
+        return run_threaded.original(target, None, args, kwargs)
+
+    run_threaded.original = utils.run_threaded
+
+    saved = (
+        detector.xbmc.RenderCapture,
+        utils.run_threaded,
+        utils.wait,
+        SETTINGS.detector_autotune,
+        SETTINGS.detector_data_limit,
+        SETTINGS.detector_debug,
+        SETTINGS.detector_processes,
+        SETTINGS.detector_record_trace,
+        SETTINGS.detector_save_path,
+        SETTINGS.detector_threads,
+    )
+    detector.xbmc.RenderCapture = FakeRenderCapture
+    utils.run_threaded = run_threaded
+    utils.wait = fake_wait
+    SETTINGS.detector_autotune = False
+    SETTINGS.detector_data_limit = data_limit
+    SETTINGS.detector_debug = False
+    SETTINGS.detector_processes = False
+    SETTINGS.detector_record_trace = False
+    SETTINGS.detector_save_path = ''
+    SETTINGS.detector_threads = num_threads
+    steps_before = _step_totals(detector.image_utils.step_stats())
+
+    try:
+        run_start = timeit.default_timer()
+        upnext_detector.start()
+        wall_time = timeit.default_timer() - run_start
+        upnext_detector.stop(terminate=True)
+    finally:
+        (detector.xbmc.RenderCapture,
+         utils.run_threaded,
+         utils.wait,
+         SETTINGS.detector_autotune,
+         SETTINGS.detector_data_limit,
+         SETTINGS.detector_debug,
+         SETTINGS.detector_processes,
+         SETTINGS.detector_record_trace,
+         SETTINGS.detector_save_path,
+         SETTINGS.detector_threads) = saved
+
+    metrics = upnext_detector.metrics.snapshot()
+    steps = {}
+    for name, (count, total) in _step_totals(metrics['steps']).items():
+        count_before, total_before = steps_before.get(name, (0, 0))
+        if count > count_before:
+            steps[name] = (total - total_before) / (count - count_before)
+
+    processed = metrics['counts']['processed']
+    process_time = metrics['latencies']['process']['mean']
+    credits_start = source.credits_start
+    detected_at = state.detected_at
+    false_positive = detected_at is not None and (
+        credits_start is None or detected_at < credits_start
+    )
+
+    return {
+        'scenario': scenario_name,
+        'data_limit': data_limit,
+        'capture_size': list(upnext_detector._get_video_capture_resolution(  # pylint: disable=protected-access
+            max_size=data_limit
+        )),
+        'threads': num_threads,
+        'frames': processed,
+        'dropped': metrics['counts']['dropped'],
+        'wall_time': wall_time,
+        'fps': processed / wall_time if wall_time else None,
+        'process_time': process_time,
+        'process_fps': 1 / process_time if process_time else None,
+        'capture_to_hash': metrics['latencies']['capture_to_hash']['p95'],
+        'steps': steps,
+        'credits_start': credits_start,
+        'detected_at': detected_at,
+        'seconds_until_detection': (
+            detected_at - credits_start
+            if detected_at is not None and not false_positive else None
+        ),
+        'false_positive': false_positive,
+    }
+
+
+def run_all(scenarios=tuple(SCENARIOS), data_limits=DATA_LIMITS,
+            threads=THREADS, seed=SEED):
+    """Run all combinations of scenarios, data limits and thread counts, and
+       return a dict of results with a summary of each thread count"""
+
+    results = [
+        run(scenario_name, data_limit, num_threads, seed)
+        for num_threads in threads
+        for data_limit in data_limits
+        for scenario_name in scenarios
+    ]
+
+    summary = {}
+    for num_threads in threads:
+        selected = [result for result in results
+                    if result['threads'] == num_threads]
+        detections = [result['seconds_until_detection']
+                      for result in selected
+                      if result['seconds_until_detection'] is not None]
+        summary[str(num_threads)] = {
+            'fps': sum(result['fps'] for result in selected) / len(selected),
+            'false_positive_rate': sum(
+                result['false_positive'] for result in selected
+            ) / len(selected),
+            'detection_rate': len(detections) / len(selected),
+            'seconds_until_detection': (
+                sum(detections) / len(detections) if detections else None
+            ),
+        }
+
+    return {
+        'version': 1,
+        'python': platform.python_version(),
+        'seed': seed,
+        'summary': summary,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS),
+                        default=sorted(SCENARIOS))
+    parser.add_argument('--data-limits', nargs='+', type=int,
+                        default=DATA_LIMITS)
+    parser.add_argument('--threads', nargs='+', type=int, default=THREADS)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('-o', '--output', help='Write results to file')
+    args = parser.parse_args(argv)
+
+    output = json.dumps(run_all(
+        args.scenarios, args.data_limits, args.threads, args.seed
+    ), indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+"""UpNext detector precomputation of credits timestamps from capture traces
+
+Replays capture traces, created using the detector trace recording setting,
+for all episodes of each group (i.e. each season of a show) in parallel
+processes, then stores the detected credits timestamps and hashes in the
+detector save path, in the same way as if each episode had been played.
+
+Episodes are first replayed independently. Episodes where credits were not
+detected are then replayed again, with the hashes of all other episodes in the
+group, so that credits common to other episodes can be detected. Run with
+resources/lib/ and tests/ added to PYTHONPATH:
+
+    python tests/precompute_detector.py traces/ --save-path <save path>
+
+where <save path> is the detector save path used by Kodi, by default:
+
+    <Kodi userdata>/addon_data/service.upnext/detector/
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import constants
+from settings import SETTINGS
+
+# Disable profiling of detector workers, if the detector is imported here
+_DEBUG, SETTINGS.detector_debug = SETTINGS.detector_debug, False
+import detector  # noqa: E402 pylint: disable=wrong-import-position
+SETTINGS.detector_debug = _DEBUG
+
+
+def find_traces(paths):
+    """Returns sorted list of trace files in paths, including trace files in
+       sub-directories of any directories in paths"""
+
+    traces = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            traces.add(path)
+            continue
+        for dir_path, _, filenames in os.walk(path):
+            traces.update(
+                os.path.join(dir_path, filename) for filename in filenames
+                if filename.endswith(constants.DETECTOR_TRACE_SUFFIX)
+            )
+    return sorted(traces)
+
+
+def replay(args):
+    """Replay a capture trace in a worker process, using hashes from other
+       episodes if provided. Returns a tuple of the trace filename, list of
+       (item, timestamp) tuples, and the hash store of the replayed group"""
+
+    filename, group_name, past_hashes = args
+
+    # Hashes are only stored in memory by worker processes, and then saved by
+    # the main process once all traces have been replayed
+    SETTINGS.detector_debug = False
+    SETTINGS.detector_save_path = ''
+    detector.HASH_CACHE.clear()
+    if past_hashes:
+        detector.HASH_CACHE.put(group_name, past_hashes)
+
+    upnext_detector = detector.UpNextDetector(player=None, state=None)
+    results = upnext_detector.replay(filename, store=True)
+    return filename, results, upnext_detector.past_hashes
+
+
+def merge(hash_store, other_hash_store):
+    """Add hashes and timestamps from other_hash_store to hash_store, without
+       replacing detected timestamps with undetected timestamps"""
+
+    hash_store.hash_size = other_hash_store.hash_size
+    hash_store.timestamps.update(
+        (group_idx, timestamp)
+        for group_idx, timestamp in other_hash_store.timestamps.items()
+        if timestamp is not None or group_idx not in hash_store.timestamps
+    )
+    hash_store.update(other_hash_store.data)
+
+
+def precompute(traces, save_path, num_processes=None):
+    """Replay traces and save the detected credits timestamps and hashes for
+       each group to save_path. Returns a list of dicts of results for each
+       replayed item"""
+
+    saved_path, SETTINGS.detector_save_path = (
+        SETTINGS.detector_save_path, save_path
+    )
+    # Hash stores for each group, including any previously stored hashes
+    groups = {}
+    results = {}
+    try:
+        with multiprocessing.Pool(num_processes) as pool:
+            pending = [(filename, None, None) for filename in traces]
+            for replay_pass in (1, 2):
+                for filename, items, hash_store in pool.imap_unordered(
+                        replay, pending
+                ):
+                    for item, timestamp in items:
+                        results[(filename, item['group_idx'])] = dict(
+                            item,
+                            trace=filename,
+                            detected_at=timestamp,
+                            replay_pass=replay_pass
+                        )
+                        # Hashes are not stored for non-episodic videos
+                        group_name = item['group_name']
+                        if not group_name:
+                            continue
+                        if group_name not in groups:
+                            groups[group_name] = detector.UpNextHashStore(
+                                hash_size=hash_store.hash_size
+                            )
+                            groups[group_name].load(group_name)
+                        merge(groups[group_name], hash_store)
+
+                for hash_store in groups.values():
+                    hash_store.learn_template()
+
+                # Replay traces with undetected credits using the hashes of
+                # all other episodes in the group
+                pending = [
+                    (result['trace'], result['group_name'],
+                     groups[result['group_name']])
+                    for result in results.values()
+                    if result['group_name'] and result['detected_at'] is None
+                ]
+                if not pending:
+                    break
+
+        for group_name, hash_store in groups.items():
+            hash_store.save(group_name)
+    finally:
+        SETTINGS.detector_save_path = saved_path
+
+    return [results[key] for key in sorted(results)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', maxsplit=1)[0]
+    )
+    parser.add_argument('paths', nargs='+',
+                        help='Trace files or directories of trace files')
+    parser.add_argument('--save-path', default=SETTINGS.detector_save_path,
+                        help='Detector save path to store hashes in')
+    parser.add_argument('--processes', type=int,
+                        help='Number of worker processes')
+    parser.add_argument('-o', '--output', help='Write results to file')
+    args = parser.parse_args(argv)
+
+    save_path = detector.file_utils.make_legal_path(args.save_path)
+    if not save_path:
+        parser.error('Invalid save path: {0}'.format(args.save_path))
+
+    output = json.dumps(precompute(
+        find_traces(args.paths), save_path, args.processes
+    ), indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+"""UpNext detector replay of recorded capture traces
+
+Runs the detector over the frames recorded in capture traces, created using
+the detector trace recording setting, as fast as possible and without Kodi,
+and outputs detected credits timestamps and detector metrics as JSON. Run with
+resources/lib/ and tests/ added to PYTHONPATH:
+
+    python tests/replay_detector.py traces/*.trace --output results.json
+
+Hashes from other episodes are loaded from --save-path, if provided, otherwise
+each trace is replayed without hashes from other episodes.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import argparse
+import json
+import sys
+import timeit
+
+from settings import SETTINGS
+
+# Disable profiling of detector workers, if the detector is imported here
+_DEBUG, SETTINGS.detector_debug = SETTINGS.detector_debug, False
+import detector  # noqa: E402 pylint: disable=wrong-import-position
+SETTINGS.detector_debug = _DEBUG
+
+
+def replay(filename, save_path=''):
+    """Replay a capture trace and return a dict of results"""
+
+    saved = SETTINGS.detector_debug, SETTINGS.detector_save_path
+    SETTINGS.detector_debug = False
+    SETTINGS.detector_save_path = save_path
+    try:
+        upnext_detector = detector.UpNextDetector(player=None, state=None)
+        replay_start = timeit.default_timer()
+        results = upnext_detector.replay(filename)
+        wall_time = timeit.default_timer() - replay_start
+    finally:
+        SETTINGS.detector_debug, SETTINGS.detector_save_path = saved
+
+    metrics = upnext_detector.metrics.snapshot()
+    processed = metrics['counts']['processed']
+    return {
+        'trace': filename,
+        'items': [
+            dict(item, detected_at=detected_at)
+            for item, detected_at in results
+        ],
+        'frames': processed,
+        'wall_time': wall_time,
+        'fps': processed / wall_time if wall_time else None,
+        'metrics': metrics,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', maxsplit=1)[0]
+    )
+    parser.add_argument('traces', nargs='+')
+    parser.add_argument('--save-path', default='',
+                        help='Load hashes of other episodes from path')
+    parser.add_argument('-o', '--output', help='Write results to file')
+    args = parser.parse_args(argv)
+
+    save_path = args.save_path and detector.file_utils.make_legal_path(
+        args.save_path
+    )
+    output = json.dumps([
+        replay(filename, save_path) for filename in args.traces
+    ], indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,14 +10,47 @@ from __future__ import (
 )
 
 import os
+import shutil
+import tempfile
+import threading
 
 from PIL import Image
 
+import benchmark_detector
 import detector
+import precompute_detector
+import replay_detector
 
 SKIP_TEST_ALL = False
 SKIP_TEST_REP_HASH = False
 SKIP_TEST_HASH_COMPARE = False
+SKIP_TEST_HASH_PACKING = False
+SKIP_TEST_HASH_WINDOW = False
+SKIP_TEST_HASH_ENCODING = False
+SKIP_TEST_HASH_DATABASE = False
+SKIP_TEST_HASH_WRITER = False
+SKIP_TEST_HASH_WRITER_RETRY = False
+SKIP_TEST_HASH_CACHE = False
+SKIP_TEST_CREDITS_ESTIMATE = False
+SKIP_TEST_CAPTURE_CONTROLLER = False
+SKIP_TEST_PROCESS_POOL = False
+SKIP_TEST_FRAME_BUFFER = False
+SKIP_TEST_PREFILTER = False
+SKIP_TEST_COMPILED_PIPELINE = False
+SKIP_TEST_PRECOMPUTE_CACHE = False
+SKIP_TEST_NUMPY_BACKEND = False
+SKIP_TEST_CONDITIONAL_FILTER = False
+SKIP_TEST_FRAME_MEMO = False
+SKIP_TEST_HASH_LIMIT = False
+SKIP_TEST_HASH_STORE_THREADS = False
+SKIP_TEST_CREDITS_TEMPLATE = False
+SKIP_TEST_HASH_PYRAMID = False
+SKIP_TEST_CAPTURE_PROFILE = False
+SKIP_TEST_METRICS = False
+SKIP_TEST_BENCHMARK = False
+SKIP_TEST_CAPTURE_TRACE = False
+SKIP_TEST_PRECOMPUTE = False
+SKIP_TEST_DEBUG_WRITER = False
 
 
 # Test comparisons sourced from:
@@ -233,12 +266,1027 @@ def test_representative_hash():
     assert test_complete is True
 
 
+def test_hash_packing():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_PACKING:
+        assert True
+        return
+
+    hash_size = (14, 8)
+    test_hash = detector.UpNextDetector._generate_initial_hash(*hash_size)  # pylint: disable=protected-access
+    bit_tuple = test_hash.to_tuple()
+    assert len(bit_tuple) == hash_size[0] * hash_size[1]
+    assert None in bit_tuple
+    assert detector.UpNextHash.from_tuple(bit_tuple) == test_hash
+
+    image = Image.new('L', hash_size, 0)
+    image.paste(255, box=(2, 2, 12, 6))
+    image_hash = detector.UpNextDetector._create_hash(image, hash_size)  # pylint: disable=protected-access
+    assert image_hash.to_tuple() == detector.image_utils.export_data(image)
+
+    similarity = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+        image_hash, image_hash
+    )
+    assert similarity == 100
+    similarity = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+        test_hash, image_hash
+    )
+    assert 0 <= similarity < 100
+
+
+def test_hash_window():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_WINDOW:
+        assert True
+        return
+
+    hash_store = detector.UpNextHashStore(timestamps={1: 100, 2: None, 3: 90})
+    for episode in (1, 2, 3, detector.constants.UNDEFINED):
+        for start_time in range(0, 200, 3):
+            hash_store.add(
+                (200 - start_time, start_time, episode),
+                detector.UpNextHash(start_time, 8)
+            )
+
+    window = hash_store.window((95, 105, 2), size=5)
+    assert sorted(window) == [
+        (92, 108, 1), (92, 108, 3),
+        (95, 105, 1), (95, 105, 3),
+        (98, 102, 1), (98, 102, 3),
+    ]
+    assert all(
+        image_hash == hash_store.data[hash_index]
+        for hash_index, image_hash in window.items()
+    )
+
+    window = hash_store.window((50, 150, 2), size=2, all_episodes=True)
+    assert sorted(window) == [(50, 150, 1), (50, 150, 2), (50, 150, 3)]
+
+
+def test_hash_encoding():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_ENCODING:
+        assert True
+        return
+
+    hash_size = [14, 8]
+    num_bits = hash_size[0] * hash_size[1]
+    hash_store = detector.UpNextHashStore(
+        hash_size=hash_size,
+        timestamps={1: 1234.5, 2: None}
+    )
+    for start_time in range(100):
+        hash_store.add(
+            (1500 - start_time, start_time, 1 + start_time % 2),
+            detector.UpNextHash((2 ** num_bits - 1) // (start_time + 1), num_bits)
+        )
+    hash_store.add((0, 0, detector.constants.UNDEFINED),
+                   detector.UpNextHash(1, num_bits))
+
+    loaded_store = detector.UpNextHashStore()
+    loaded_store._decode(hash_store._encode())  # pylint: disable=protected-access
+
+    assert loaded_store.hash_size == hash_size
+    assert loaded_store.timestamps == hash_store.timestamps
+    assert len(loaded_store.data) == len(hash_store.data) - 1
+    assert all(
+        image_hash == hash_store.data[hash_index]
+        for hash_index, image_hash in loaded_store.data.items()
+    )
+    assert (loaded_store.window((1450, 50, 2), size=1)
+            == hash_store.window((1450, 50, 2), size=1))
+
+
+def test_hash_database():
+    if (SKIP_TEST_ALL or SKIP_TEST_HASH_DATABASE
+            or not detector.UpNextHashDatabase.is_available()):
+        assert True
+        return
+
+    hash_size = [14, 8]
+    num_bits = hash_size[0] * hash_size[1]
+    data = {
+        (1500 - start_time, start_time, 1): detector.UpNextHash(
+            (2 ** num_bits - 1) // (start_time + 1), num_bits
+        )
+        for start_time in range(50)
+    }
+    new_data = {(1, 1499, 2): detector.UpNextHash(2 ** num_bits - 1, num_bits)}
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as target:
+        with detector.UpNextHashDatabase(target.name) as database:
+            database.save('Show-1', 0.2, hash_size, {1: None}, data)
+            database.save('Show-1', 0.2, hash_size, {2: 1499}, new_data)
+            database.save('Show-2', 0.2, hash_size, {1: 100}, new_data)
+
+        with detector.UpNextHashDatabase(target.name) as database:
+            version, loaded_size, timestamps, loaded_data = database.load(
+                'Show-1'
+            )
+            assert database.load('Show-3') is None
+
+    data.update(new_data)
+    assert version == 0.2
+    assert loaded_size == hash_size
+    assert timestamps == {1: None, 2: 1499}
+    assert loaded_data == data
+
+
+def test_hash_writer():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_WRITER:
+        assert True
+        return
+
+    save_path = detector.SETTINGS.detector_save_path
+    hash_store = detector.UpNextHashStore(timestamps={1: None})
+    try:
+        detector.SETTINGS.detector_save_path = tempfile.mkdtemp() + os.sep
+
+        hash_store.add((10, 20, 1), detector.UpNextHash(1, 64))
+        detector.HASH_WRITER.push('Show-1', hash_store)
+        hash_store.add((11, 19, 1), detector.UpNextHash(2, 64))
+        hash_store.timestamps[1] = 19
+        detector.HASH_WRITER.push('Show-1', hash_store)
+        detector.HASH_WRITER.wait('Show-1')
+        assert not detector.HASH_WRITER.is_pending('Show-1')
+        detector.HASH_WRITER.stop()
+
+        loaded_store = detector.UpNextHashStore()
+        assert loaded_store.load('Show-1')
+        assert loaded_store.data == hash_store.data
+        assert loaded_store.timestamps == {1: 19}
+        assert not [
+            filename
+            for filename in os.listdir(detector.SETTINGS.detector_save_path)
+            if filename.endswith('.tmp')
+        ]
+    finally:
+        shutil.rmtree(detector.SETTINGS.detector_save_path, ignore_errors=True)
+        detector.SETTINGS.detector_save_path = save_path
+
+
+def test_hash_writer_retry():
+    if (SKIP_TEST_ALL or SKIP_TEST_HASH_WRITER_RETRY
+            or not detector.UpNextHashDatabase.is_available()):
+        assert True
+        return
+
+    def locked_save(*_args, **_kwargs):
+        raise detector.sqlite3.OperationalError('database is locked')
+
+    save = detector.UpNextHashDatabase.save
+    saved = detector.SETTINGS.detector_save_path, detector.SETTINGS.detector_storage
+    hash_store = detector.UpNextHashStore(timestamps={1: None})
+    try:
+        detector.SETTINGS.detector_save_path = tempfile.mkdtemp() + os.sep
+        detector.SETTINGS.detector_storage = (
+            detector.constants.DETECTOR_STORAGE_DATABASE
+        )
+
+        # Hashes that could not be saved are included in the next save
+        detector.UpNextHashDatabase.save = locked_save
+        hash_store.add((10, 20, 1), detector.UpNextHash(1, 64))
+        detector.HASH_WRITER.push('Show-1', hash_store)
+        detector.HASH_WRITER.flush()
+        detector.UpNextHashDatabase.save = save
+        hash_store.add((11, 19, 1), detector.UpNextHash(2, 64))
+        detector.HASH_WRITER.push('Show-1', hash_store)
+        detector.HASH_WRITER.stop()
+
+        loaded_store = detector.UpNextHashStore()
+        assert loaded_store.load('Show-1')
+        assert loaded_store.data == hash_store.data
+    finally:
+        detector.UpNextHashDatabase.save = save
+        shutil.rmtree(detector.SETTINGS.detector_save_path, ignore_errors=True)
+        (detector.SETTINGS.detector_save_path,
+         detector.SETTINGS.detector_storage) = saved
+
+
+def test_hash_cache():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_CACHE:
+        assert True
+        return
+
+    hash_stores = []
+    for num_hashes in (10, 20, 30):
+        hash_store = detector.UpNextHashStore(hash_size=(8, 8))
+        for start_time in range(num_hashes):
+            hash_store.add((100 - start_time, start_time, 1),
+                           detector.UpNextHash(start_time, 64))
+        hash_stores.append(hash_store)
+
+    entry_size = detector.UpNextHashCache._ENTRY_SIZE + 8  # pylint: disable=protected-access
+    cache = detector.UpNextHashCache(limit=45 * entry_size)
+    cache.put('Show-1', hash_stores[0])
+    cache.put('Show-2', hash_stores[1])
+    assert cache.get('Show-1') is hash_stores[0]
+    assert cache.size == 30 * entry_size
+
+    # Least recently used store is discarded when limit is exceeded
+    cache.put('Show-3', hash_stores[2])
+    assert cache.get('Show-2') is None
+    assert cache.get('Show-1') is hash_stores[0]
+    assert cache.size == 40 * entry_size
+
+    # Most recently used store is kept even when limit is exceeded
+    hash_stores[2].add((0, 100, 2), detector.UpNextHash(0, 64))
+    cache.limit = 10 * entry_size
+    cache.put('Show-3', hash_stores[2])
+    assert cache.get('Show-1') is None
+    assert cache.get('Show-3') is hash_stores[2]
+    assert cache.size == 31 * entry_size
+
+
+def test_credits_estimate():
+    if SKIP_TEST_ALL or SKIP_TEST_CREDITS_ESTIMATE:
+        assert True
+        return
+
+    hash_store = detector.UpNextHashStore(timestamps={1: None})
+    assert hash_store.estimate_credits_start(1500) is None
+
+    # Credits start at a consistent time from end of episode
+    for episode, runtime in ((1, 1400), (2, 1500), (3, 1300)):
+        timestamp = runtime - 60.5
+        hash_store.timestamps[episode] = timestamp
+        hash_store.add((runtime - int(timestamp), int(timestamp), episode),
+                       detector.UpNextHash(0, 64))
+    assert hash_store.estimate_credits_start(1600) == 1600 - 60.5
+    assert hash_store.estimate_credits_start(1600, lead=10) == 1600 - 70.5
+
+    # Credits start at a consistent time relative to runtime of episode
+    for episode, runtime in ((1, 1000), (2, 2000), (3, 3000)):
+        timestamp = 0.9 * runtime
+        hash_store.timestamps[episode] = timestamp
+        hash_store.add((runtime - int(timestamp), int(timestamp), episode),
+                       detector.UpNextHash(0, 64))
+    assert hash_store.estimate_credits_start(1500) == 0.9 * 1500
+
+
+def test_capture_controller():
+    if SKIP_TEST_ALL or SKIP_TEST_CAPTURE_CONTROLLER:
+        assert True
+        return
+
+    controller = detector.UpNextCaptureController(
+        min_interval=1, budget=50, data_limit=32
+    )
+    assert controller.update(0, 2) == (1, 32)
+
+    # Processing within budget, use sparse sampling until credits expected
+    controller.record(0.4)
+    assert controller.update(0, 2) == (1, 32)
+    assert controller.update(0, 2, sparse=True) == (2, 32)
+
+    # Processing exceeds budget, capture less often
+    controller.record(1.4)
+    assert controller.latency == 0.4 + 0.2 * (1.4 - 0.4)
+    assert controller.update(1, 2) == (1.2, 32)
+    # Queue is full, back off further
+    interval, data_limit = controller.update(2, 2)
+    assert round(interval, 3) == 1.8
+    assert data_limit == 32
+
+    # Processing far exceeds budget, also reduce data captured
+    controller.latency = 3
+    assert controller.update(0, 2) == (4, 24)
+    assert controller.update(0, 2) == (4, 16)
+
+    # Spare capacity, increase data captured up to initial limit
+    controller.latency = 0.1
+    assert controller.update(0, 2) == (1, 24)
+    assert controller.update(0, 2) == (1, 32)
+    assert controller.update(0, 2) == (1, 32)
+
+
+def test_frame_buffer():
+    if SKIP_TEST_ALL or SKIP_TEST_FRAME_BUFFER:
+        assert True
+        return
+
+    frame_buffer = detector.UpNextFrameBuffer(2)
+    first_idx = frame_buffer.acquire()
+    second_idx = frame_buffer.acquire()
+    assert {first_idx, second_idx} == {0, 1}
+    # All slots in use
+    try:
+        frame_buffer.acquire(timeout=0.01)
+        assert False
+    except detector.QueueEmpty:
+        pass
+
+    image_data = bytearray(4)
+    frame_buffer.put(first_idx, image_data, (1, 1))
+    assert frame_buffer.get(first_idx) == (image_data, (1, 1))
+
+    # Released slot is reused without holding on to old frame data
+    frame_buffer.release(first_idx)
+    assert frame_buffer.get(first_idx)[0] is None
+    assert frame_buffer.acquire() == first_idx
+
+
+def test_prefilter():
+    if SKIP_TEST_ALL or SKIP_TEST_PREFILTER:
+        assert True
+        return
+
+    # Light text on a dark background
+    credits_image = Image.new('L', (64, 36), 0)
+    credits_image.paste(255, (16, 8, 48, 12))
+    credits_image.paste(224, (20, 20, 44, 24))
+    histogram = detector.image_utils.histogram_bins(credits_image, 16)
+    assert len(histogram) == 16
+    assert round(sum(histogram), 6) == 1
+    assert detector.UpNextDetector._is_possible_credits(credits_image)  # pylint: disable=protected-access
+
+    # Mostly mid-tone frame
+    scene_image = Image.new('L', (64, 36), 128)
+    scene_image.paste(0, (0, 0, 64, 4))
+    assert not detector.UpNextDetector._is_possible_credits(scene_image)  # pylint: disable=protected-access
+
+    # Rejected frames skip filtering and only create the image hash
+    hashes = detector.UpNextDetector._create_hashes(  # pylint: disable=protected-access
+        scene_image, None, (16, 8)
+    )
+    assert hashes[0] is not None
+    assert hashes[1:] == (None, None)
+
+
+def test_compiled_pipeline():
+    if SKIP_TEST_ALL or SKIP_TEST_COMPILED_PIPELINE:
+        assert True
+        return
+
+    image = Image.new('L', (32, 18), 16)
+    image.paste(200, (4, 4, 28, 8))
+    image.paste(96, (8, 10, 24, 14))
+
+    queue = [
+        [detector.image_utils.posterise, 3],
+        [detector.image_utils.auto_level, 5, 95, (0.33, None)],
+        [detector.image_utils.detail_reduce, 'INPUT', 50],
+        [detector.image_utils.points_of_interest],
+        [detector.image_utils.export_bits],
+    ]
+    pipeline = detector.image_utils.compile_pipeline(queue)
+    expected = detector.image_utils.process(
+        image, [list(step) for step in queue]
+    )
+
+    # Compiled pipeline can be reused and gives same output as process
+    assert pipeline(image) == expected
+    assert pipeline(image) == expected
+    assert pipeline(image.copy()) == expected
+
+
+def test_precompute_cache():
+    if SKIP_TEST_ALL or SKIP_TEST_PRECOMPUTE_CACHE:
+        assert True
+        return
+
+    cache = detector.image_utils._PrecomputeCache(limit=3 * 64 * 64)  # pylint: disable=protected-access
+    for idx in range(4):
+        cache.put(('BORDER_MASK', idx), Image.new('L', (64, 64)))
+    # Least recently used mask discarded once limit is exceeded
+    assert cache.get(('BORDER_MASK', 0)) is None
+    assert cache.get(('BORDER_MASK', 1)) is not None
+    cache.put(('BORDER_MASK', 4), Image.new('L', (64, 64)))
+    assert cache.get(('BORDER_MASK', 2)) is None
+    assert cache.get(('BORDER_MASK', 1)) is not None
+    assert cache.stats() == {
+        'hits': 2, 'misses': 2, 'entries': 3, 'size': 3 * 64 * 64
+    }
+
+    # Each thread has a separate image stack
+    cache.stack.append(1)
+    stacks = []
+    thread = threading.Thread(target=lambda: stacks.append(cache.stack))
+    thread.start()
+    thread.join()
+    assert stacks == [[]]
+    assert cache.stack == [1]
+    assert not cache.reset_stack()
+
+
+def test_numpy_backend():
+    if (SKIP_TEST_ALL or SKIP_TEST_NUMPY_BACKEND
+            or not detector.image_utils.numpy):
+        assert True
+        return
+
+    image_utils = detector.image_utils
+    histograms = [
+        [(level * 37) % 23 for level in range(256)],
+        [100 if level in (8, 200) else 0 for level in range(256)],
+        [0] * 128 + [1] + [0] * 127,
+    ]
+    for histogram in histograms:
+        assert (
+            image_utils._otsu_threshold_numpy(histogram)  # pylint: disable=protected-access
+            == image_utils._otsu_threshold_python(histogram)  # pylint: disable=protected-access
+        )
+
+    for scale, offset in ((1, 0), (1.33, 20.5), (3.03, -45.7)):
+        assert (
+            image_utils._linear_lut_numpy(scale, offset)  # pylint: disable=protected-access
+            == image_utils._linear_lut_python(scale, offset)  # pylint: disable=protected-access
+        )
+
+
+def test_conditional_filter():
+    if SKIP_TEST_ALL or SKIP_TEST_CONDITIONAL_FILTER:
+        assert True
+        return
+
+    image = Image.new('L', (4, 1))
+    image.putdata([10, 50, 100, 200])
+    # Box blur with radius 0 leaves aggregate image unchanged, so pixel to
+    # aggregate ratio is always 1
+    filter_args = ('BoxBlur,0', )
+    include_bright = (64, 255, 0.5, 1)
+    include_all = (0, 255, 0.5, 1)
+    exclude_mid = (40, 150, 0, 2)
+
+    output = detector.image_utils.conditional_filter(
+        image, ((include_bright, ), ()), 'THRESHOLD', filter_args
+    )
+    assert output.tobytes() == bytes(bytearray([0, 0, 100, 200]))
+
+    output = detector.image_utils.conditional_filter(
+        image, ((include_all, ), (exclude_mid, )), 'MASK', filter_args
+    )
+    assert output.tobytes() == bytes(bytearray([255, 0, 0, 255]))
+
+    # No matching pixels
+    output = detector.image_utils.conditional_filter(
+        image, ((), ()), 'MASK', filter_args
+    )
+    assert output.getextrema() == (0, 0)
+
+
+def test_frame_memo():
+    if SKIP_TEST_ALL or SKIP_TEST_FRAME_MEMO:
+        assert True
+        return
+
+    size = (32, 18)
+    image_data = bytearray([65] * 4 * size[0] * size[1])
+    digest = detector.image_utils.frame_digest(image_data, size)
+    assert len(digest) == 16 * 9
+    # Small differences in captured data give the same digest
+    similar_data = bytearray([66] * 4 * size[0] * size[1])
+    assert detector.image_utils.frame_digest(similar_data, size) == digest
+    different_data = bytearray([128] * 4 * size[0] * size[1])
+    assert detector.image_utils.frame_digest(different_data, size) != digest
+
+    frame_memo = detector.UpNextFrameMemo(limit=2)
+    assert frame_memo.get(digest) is None
+    frame_memo.put(digest, ('hashes', ), {'match': True})
+    frame_memo.put(b'second', ('hashes', ), {'match': False})
+    assert frame_memo.get(digest) == (('hashes', ), {'match': True})
+    # Least recently used frame discarded
+    frame_memo.put(b'third', ('hashes', ), {'match': None})
+    assert frame_memo.get(b'second') is None
+    assert frame_memo.hits == 1
+
+
+def test_hash_limit():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_LIMIT:
+        assert True
+        return
+
+    credits_index = (0, 0, detector.constants.UNDEFINED)
+    hash_store = detector.UpNextHashStore(
+        timestamps={1: None},
+        data={credits_index: detector.UpNextHash(1, 8)},
+    )
+    hash_store.set_limit(10)
+    for start_time in range(100):
+        hash_store.add(
+            (100 - start_time, start_time, 1),
+            detector.UpNextHash(start_time, 8)
+        )
+        # Re-adding an existing hash does not evict older hashes
+        hash_store.add(
+            (100 - start_time, start_time, 1),
+            detector.UpNextHash(start_time, 8)
+        )
+
+    # Representative hash is kept in addition to the 10 most recent hashes
+    assert len(hash_store.data) == 11
+    assert credits_index in hash_store.data
+    assert sorted(hash_store.window((5, 95, 1), size=10, all_episodes=True)) == [
+        (100 - start_time, start_time, 1) for start_time in range(99, 89, -1)
+    ]
+
+    hash_store.set_limit(None)
+    for start_time in range(100, 120):
+        hash_store.add(
+            (100 - start_time, start_time, 1),
+            detector.UpNextHash(start_time, 8)
+        )
+    assert len(hash_store.data) == 31
+
+    # Hashes added without a limit are kept
+    hash_store.set_limit(5)
+    assert len(hash_store.data) == 26
+    assert (-19, 119, 1) in hash_store.data
+    assert (6, 94, 1) not in hash_store.data
+    assert not hash_store.window((6, 94, 1), size=0, all_episodes=True)
+
+
+def test_hash_store_threads():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_STORE_THREADS:
+        assert True
+        return
+
+    hash_store = detector.UpNextHashStore(timestamps={1: None}, limit=50)
+
+    def add_hashes(offset):
+        for start_time in range(offset, 20000, 2):
+            hash_store.add(
+                (20000 - start_time, start_time, 1),
+                detector.UpNextHash(start_time, 8)
+            )
+
+    workers = [
+        threading.Thread(target=add_hashes, args=(offset, ))
+        for offset in (0, 1)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # Time index still matches stored hashes after concurrent adds
+    assert len(hash_store.data) == 50
+    by_start_time, by_end_time = hash_store._index[1]  # pylint: disable=protected-access
+    assert by_start_time == sorted(
+        (start_time, end_time) for end_time, start_time, _ in hash_store.data
+    )
+    assert by_end_time == sorted(
+        (end_time, start_time) for end_time, start_time, _ in hash_store.data
+    )
+
+
+def test_credits_template():
+    if SKIP_TEST_ALL or SKIP_TEST_CREDITS_TEMPLATE:
+        assert True
+        return
+
+    hash_size = (4, 4)
+    num_bits = hash_size[0] * hash_size[1]
+    hash_store = detector.UpNextHashStore(
+        hash_size=hash_size,
+        timestamps={1: 100.5, 2: 110, 3: None}
+    )
+    # Top half of credits hashes is always unset, bottom half is always set
+    # except for the last 4 bits which vary between hashes
+    for episode, detected_at in ((1, 100), (2, 110), (3, 120), (4, 130)):
+        for offset in range(-2, 3):
+            start_time = detected_at + offset
+            hash_store.add(
+                (200 - start_time, start_time, episode),
+                detector.UpNextHash(0x00f0 | (start_time % 16), num_bits)
+            )
+        # Other hashes, outside of the detected window, are not used
+        hash_store.add((100, 100 - detected_at, episode),
+                       detector.UpNextHash(0xffff, num_bits))
+
+    # Not enough episodes with detected credits
+    assert hash_store.learn_template() is None
+    assert hash_store.get_template() is None
+
+    hash_store.timestamps[4] = 130
+    template = hash_store.learn_template(size=2)
+    assert template.to_tuple() == (
+        (0, ) * 8 + (1, ) * 4 + (None, ) * 4
+    )
+    assert hash_store.get_template() == template
+
+    # Template is saved and loaded with other hashes
+    loaded_store = detector.UpNextHashStore()
+    loaded_store._decode(hash_store._encode())  # pylint: disable=protected-access
+    assert loaded_store.get_template() == template
+    assert sorted(loaded_store.timestamps) == [1, 2, 3, 4]
+    assert loaded_store.estimate_credits_start(200) is not None
+
+
+def test_hash_pyramid():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_PYRAMID:
+        assert True
+        return
+
+    image_hash = detector.UpNextHash.from_tuple(
+        (1, 0, 0, 0, 0,
+         0, 0, 0, 0, 1,
+         0, 0, None, 0, 0)
+    )
+    coarse_hash = image_hash.coarse(5)
+    assert coarse_hash.to_tuple() == (1, 0, 1, 0, None, 0)
+    assert image_hash.coarse(5) is coarse_hash
+
+    # Coarse comparison only rejects hashes that are not similar
+    level = 90
+    hash_size = (8, 8)
+    num_bits = hash_size[0] * hash_size[1]
+    baseline_hash = detector.UpNextDetector._generate_initial_hash(  # pylint: disable=protected-access
+        *hash_size
+    )
+    for bits in (0, baseline_hash.bits, 0xff00ff00ff00ff00,
+                 baseline_hash.bits ^ 0x8000000000000001):
+        image_hash = detector.UpNextHash(bits, num_bits)
+        similarity = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+            baseline_hash, image_hash
+        )
+        pruned = detector.UpNextDetector._hash_prune(  # pylint: disable=protected-access
+            baseline_hash, image_hash, hash_size[0], level
+        )
+        assert not pruned or similarity < level
+        assert pruned == (bits == 0xff00ff00ff00ff00)
+
+
+def test_capture_profile():
+    if SKIP_TEST_ALL or SKIP_TEST_CAPTURE_PROFILE:
+        assert True
+        return
+
+    # Synthetic frame is full size BGRA data that is treated as credits
+    image_data = detector.UpNextDetector._generate_credits_frame(63, 36)  # pylint: disable=protected-access
+    assert len(image_data) == 4 * 63 * 36
+    image = Image.frombuffer('RGBA', (63, 36), image_data, 'raw', 'BGRA')
+    assert detector.UpNextDetector._is_possible_credits(image.convert('L'))  # pylint: disable=protected-access
+
+    save_path = detector.SETTINGS.detector_save_path
+    try:
+        detector.SETTINGS.detector_save_path = tempfile.mkdtemp() + os.sep
+
+        profile = detector.UpNextCaptureProfile()
+        profile.load(['config'])
+        measured = []
+        assert profile.calibrate(measured.append, 40, 1) == 40
+        assert measured == [8] * 3 + [16] * 3 + [32] * 3 + [40] * 3
+        assert sorted(profile.latencies) == [8, 16, 32, 40]
+
+        # Measurements are loaded for the same configuration and only the
+        # largest data limit within the target latency is selected
+        loaded_profile = detector.UpNextCaptureProfile()
+        loaded_profile.load(['config'])
+        assert loaded_profile.latencies == profile.latencies
+        loaded_profile.latencies[32] = 2
+        measured = []
+        assert loaded_profile.calibrate(measured.append, 64, 1) == 16
+        assert not measured
+        assert loaded_profile.snapshot()['data_limit'] == 16
+
+        # Measurements are discarded if the configuration is changed
+        loaded_profile = detector.UpNextCaptureProfile()
+        loaded_profile.load(['changed'])
+        assert not loaded_profile.latencies
+    finally:
+        shutil.rmtree(detector.SETTINGS.detector_save_path, ignore_errors=True)
+        detector.SETTINGS.detector_save_path = save_path
+
+
+def test_metrics():
+    if SKIP_TEST_ALL or SKIP_TEST_METRICS:
+        assert True
+        return
+
+    histogram = detector.utils.Histogram(num_buckets=4, minimum=1)
+    for value in (0.5, 1, 3, 3, 100):
+        histogram.record(value)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 5
+    assert snapshot['mean'] == 21.5
+    assert snapshot['max'] == 100
+    assert snapshot['p50'] == 4
+    assert snapshot['p95'] == 100
+    assert snapshot['buckets'] == [[1, 2], [4, 2], [None, 1]]
+
+    metrics = detector.UpNextDetectorMetrics()
+    for _ in range(3):
+        metrics.count('captured')
+    metrics.count('dropped')
+    metrics.record_frame((1.0, 1.5, 2.0), True)
+    metrics.record_frame((2.0, 2.0, 2.5), True, repeated=True)
+    metrics.record_frame((None, 3.0, 3.5), False)
+
+    # Compiled pipeline steps are timed, with point operations fused
+    pipeline = detector.image_utils.compile_pipeline([
+        [detector.image_utils.posterise, 3],
+        [detector.image_utils.auto_level, 5, 95],
+        [detector.image_utils.export_bits],
+    ])
+    pipeline(Image.new('L', (16, 8), 16))
+
+    snapshot = metrics.publish(extra='value')
+    assert snapshot['extra'] == 'value'
+    assert snapshot['counts']['processed'] == 3
+    assert snapshot['rates']['dropped'] == 0.25
+    assert snapshot['rates']['matched'] == 2 / 3
+    assert snapshot['rates']['repeated'] == 1 / 3
+    assert snapshot['latencies']['queue_wait']['count'] == 2
+    assert snapshot['latencies']['process']['count'] == 3
+    assert snapshot['latencies']['capture_to_hash']['max'] == 1
+    assert snapshot['steps']['posterise+auto_level+export_bits']['count']
+
+    # Snapshot is only published again after an interval, unless forced
+    assert metrics.publish() is None
+    assert metrics.publish(force=True)
+
+
+def test_benchmark():
+    if SKIP_TEST_ALL or SKIP_TEST_BENCHMARK:
+        assert True
+        return
+
+    results = benchmark_detector.run_all(
+        scenarios=('episode', 'no_credits'), data_limits=(8, ), threads=(2, )
+    )
+    assert len(results['results']) == 2
+    assert set(results['summary']) == {'2'}
+
+    # Frames are processed in order by a single worker, so results should be
+    # the same for each run
+    episode, no_credits = results['results']
+    assert episode['frames'] and episode['steps']
+    assert episode['credits_start'] == 100
+    assert 0 <= episode['seconds_until_detection'] <= 10
+    assert not episode['false_positive']
+    assert no_credits['credits_start'] is None
+    assert no_credits['seconds_until_detection'] is None
+
+
+def test_capture_trace():  # pylint: disable=too-many-locals
+    if SKIP_TEST_ALL or SKIP_TEST_CAPTURE_TRACE:
+        assert True
+        return
+
+    source = benchmark_detector.FrameSource(
+        benchmark_detector.SCENARIOS['episode'], benchmark_detector.SEED
+    )
+    resolution = (1920, 1080, 16 / 9)
+    size = (341, 192)
+    trace_path = tempfile.mkdtemp()
+    filename = os.path.join(trace_path, 'episode.trace')
+
+    try:
+        # Each recording is appended to the trace file
+        for group_idx in (1, 2):
+            trace = detector.UpNextCaptureTrace(filename)
+            assert trace.open({'group_name': 'Trace', 'group_idx': group_idx},
+                              resolution)
+            for play_time in range(source.duration):
+                assert trace.write(source.frame(play_time, size), size,
+                                   play_time, source.duration)
+            trace.close()
+            assert not trace.write(b'', size, 0, 0)
+
+        records = list(detector.UpNextCaptureTrace.read(filename))
+        assert len(records) == 2 * source.duration
+        details, play_time, total_time, speed, record_size, image_data = (
+            records[-1]
+        )
+        assert details['item'] == {'group_name': 'Trace', 'group_idx': 2}
+        assert details['resolution'] == list(resolution)
+        assert (play_time, total_time, speed) == (source.duration - 1,
+                                                  source.duration, 1)
+        assert record_size == size
+        assert image_data == source.frame(play_time, size)
+
+        # Replay detects credits in each recorded item, in the recorded order
+        results = replay_detector.replay(filename)
+        assert [item['group_idx'] for item in results['items']] == [1, 2]
+        for item in results['items']:
+            assert 0 <= item['detected_at'] - source.credits_start <= 10
+        assert results['frames'] == 2 * source.duration
+
+        # Frames are processed as per the recorded video resolution, regardless
+        # of the resolution of the currently playing video
+        resolution_4_3 = (1440, 1080, 4 / 3)
+        filename_4_3 = os.path.join(trace_path, '4_3.trace')
+        size_4_3 = (294, 221)
+        trace = detector.UpNextCaptureTrace(filename_4_3)
+        assert trace.open({'group_name': 'Trace', 'group_idx': 3},
+                          resolution_4_3)
+        for play_time in range(source.duration):
+            trace.write(source.frame(play_time, size_4_3), size_4_3,
+                        play_time, source.duration)
+        trace.close()
+
+        upnext_detector = detector.UpNextDetector(player=None, state=None)
+        results = upnext_detector.replay(filename_4_3)
+        assert len(results) == 1
+        assert source.credits_start <= results[0][1] < source.duration
+        assert upnext_detector.hashes.hash_size == [10, 8]
+        assert upnext_detector.image_options[0] == size_4_3
+        image, filtered_image = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
+            source.frame(source.duration - 1, size_4_3), size_4_3,
+            upnext_detector.image_options
+        )
+        assert upnext_detector.hashes.data[(1, source.duration - 1, 3)] == (
+            detector.UpNextDetector._create_hashes(  # pylint: disable=protected-access
+                image, filtered_image, [10, 8]
+            )[0]
+        )
+
+        # Recording that was not completely written is skipped
+        with open(filename, mode='rb') as trace_file:
+            trace_data = trace_file.read()
+        with open(filename, mode='wb') as trace_file:
+            trace_file.write(trace_data[:-1000])
+        assert len(list(detector.UpNextCaptureTrace.read(filename))) < len(records)
+    finally:
+        shutil.rmtree(trace_path, ignore_errors=True)
+
+
+def test_precompute():
+    if SKIP_TEST_ALL or SKIP_TEST_PRECOMPUTE:
+        assert True
+        return
+
+    trace_path = tempfile.mkdtemp()
+    save_path = tempfile.mkdtemp() + os.sep
+    try:
+        size = (341, 192)
+        # Seeds of episodes where title cards are not detected as credits
+        episodes = {
+            group_idx: benchmark_detector.FrameSource(
+                benchmark_detector.SCENARIOS[scenario], seed=seed
+            ) for group_idx, (scenario, seed) in enumerate((
+                ('episode', 1),
+                ('episode', 3),
+                ('episode', 4),
+                ('static_credits', 5),
+            ), start=1)
+        }
+        for group_idx, source in episodes.items():
+            trace = detector.UpNextCaptureTrace(os.path.join(
+                trace_path, 'Precompute_{0}.trace'.format(group_idx)
+            ))
+            trace.open({'group_name': 'Precompute', 'group_idx': group_idx},
+                       (1920, 1080, 16 / 9))
+            for play_time in range(source.duration):
+                trace.write(source.frame(play_time, size), size,
+                            play_time, source.duration)
+            trace.close()
+
+        traces = precompute_detector.find_traces([trace_path])
+        assert len(traces) == len(episodes)
+        results = precompute_detector.precompute(traces, save_path, 2)
+        assert [result['group_idx'] for result in results] == [1, 2, 3, 4]
+        for result in results[:3]:
+            assert result['replay_pass'] == 1
+            assert 0 <= (result['detected_at']
+                         - episodes[result['group_idx']].credits_start) <= 10
+        # Episode with undetected credits is replayed with other episode hashes
+        assert results[3]['replay_pass'] == 2
+
+        # Timestamps, hashes and credits template are saved for the group
+        saved_path, detector.SETTINGS.detector_save_path = (
+            detector.SETTINGS.detector_save_path, save_path
+        )
+        try:
+            hash_store = detector.UpNextHashStore()
+            assert hash_store.load('Precompute')
+        finally:
+            detector.SETTINGS.detector_save_path = saved_path
+        for result in results:
+            assert (hash_store.timestamps.get(result['group_idx'])
+                    == result['detected_at'])
+        assert hash_store.get_template()
+
+        # Worker processes replay frames at the recorded video resolution
+        size = (294, 221)
+        source = episodes[1]
+        filename = os.path.join(trace_path, 'Precompute_4_3.trace')
+        trace = detector.UpNextCaptureTrace(filename)
+        trace.open({'group_name': 'Precompute_4_3', 'group_idx': 1},
+                   (1440, 1080, 4 / 3))
+        for play_time in range(source.duration):
+            trace.write(source.frame(play_time, size), size,
+                        play_time, source.duration)
+        trace.close()
+
+        [result] = precompute_detector.precompute([filename], save_path, 1)
+        assert source.credits_start <= result['detected_at'] < source.duration
+        detector.SETTINGS.detector_save_path = save_path
+        try:
+            hash_store = detector.UpNextHashStore()
+            assert hash_store.load('Precompute_4_3')
+        finally:
+            detector.SETTINGS.detector_save_path = saved_path
+        assert hash_store.hash_size == [10, 8]
+        assert hash_store.timestamps.get(1) == result['detected_at']
+    finally:
+        shutil.rmtree(trace_path, ignore_errors=True)
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def test_debug_writer():
+    if SKIP_TEST_ALL or SKIP_TEST_DEBUG_WRITER:
+        assert True
+        return
+
+    class BlockingImage(object):  # pylint: disable=too-few-public-methods
+        """Image that is only saved once released"""
+
+        def __init__(self):
+            self.started = threading.Event()
+            self.released = threading.Event()
+
+        def save(self, filename, **kwargs):  # pylint: disable=unused-argument
+            self.started.set()
+            self.released.wait(5)
+
+    save_path = tempfile.mkdtemp() + os.sep
+    try:
+        writer = detector.image_utils._DebugImageWriter(maxsize=2)  # pylint: disable=protected-access
+        blocking_image = BlockingImage()
+        assert writer.put(blocking_image, save_path + 'blocking.png')
+        assert blocking_image.started.wait(5)
+
+        # Images are queued while the writer is busy, until the queue is full,
+        # and then dropped rather than waiting
+        for idx in range(3):
+            writer.put(Image.new('L', (16, 8), 16 * idx),
+                       '{0}{1}.png'.format(save_path, idx))
+        assert writer.stats() == {
+            'saved': 0, 'dropped': 1, 'failed': 0, 'pending': 2,
+        }
+
+        blocking_image.released.set()
+        writer.flush()
+        assert writer.stats() == {
+            'saved': 3, 'dropped': 1, 'failed': 0, 'pending': 0,
+        }
+        assert sorted(os.listdir(save_path)) == ['0.png', '1.png']
+        with Image.open(save_path + '1.png') as image:
+            assert image.getpixel((0, 0)) == 16
+
+        # Unexpected errors do not prevent waiting for queued images to be saved
+        writer.put(None, save_path + 'invalid.png')
+        writer.flush()
+        writer.put(Image.new('L', (16, 8)), save_path + '2.png')
+        writer.stop()
+        assert writer.stats() == {
+            'saved': 4, 'dropped': 1, 'failed': 1, 'pending': 0,
+        }
+        assert os.path.exists(save_path + '2.png')
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def test_process_pool():
+    if (SKIP_TEST_ALL or SKIP_TEST_PROCESS_POOL
+            or not detector.UpNextProcessPool.is_available()):
+        assert True
+        return
+
+    size = (16, 9)
+    hash_size = (16, 8)
+    image_data = bytearray(
+        (x * 13 + y * 7) % 256
+        for y in range(size[1]) for x in range(size[0]) for _ in range(4)
+    )
+    image_options = detector.UpNextDetector._get_image_options()  # pylint: disable=protected-access
+    image, filtered_image = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
+        image_data, size, image_options
+    )
+    expected = detector.UpNextDetector._create_hashes(  # pylint: disable=protected-access
+        image, filtered_image, hash_size
+    )
+
+    process_pool = detector.UpNextProcessPool.create(
+        num_processes=1, buffer_size=len(image_data), timeout=30
+    )
+    try:
+        assert process_pool.create_hashes(
+            image_data, size, hash_size, image_options
+        ) == expected
+        # Image data too large for shared memory buffer
+        assert process_pool.create_hashes(
+            image_data + image_data, size, hash_size, image_options
+        ) is None
+        # Pool is disabled after an error in the worker process
+        assert process_pool.create_hashes(
+            image_data, size, hash_size, ((0, 0), None, False, False)
+        ) is None
+        assert process_pool.create_hashes(
+            image_data, size, hash_size, image_options
+        ) is None
+    finally:
+        process_pool.close()
+
+
 def test_hash_compare():  # pylint: disable=too-many-locals,too-many-statements
     if SKIP_TEST_ALL or SKIP_TEST_HASH_COMPARE:
         assert True
         return
 
     test_image_path = os.path.dirname(os.path.abspath(__file__)) + '/images/'
+    # Compare filtered hashes of all test images
+    prefilter = detector.SETTINGS.detector_prefilter
+    detector.SETTINGS.detector_prefilter = False
     match_level = 85
     matches = 0
     false_positives = 0
@@ -246,89 +1294,92 @@ def test_hash_compare():  # pylint: disable=too-many-locals,too-many-statements
     false_negatives = 0
     false_negatives_deviation = 0
 
-    for pairs in IMAGE_PAIRS:
-        file1 = pairs[0]
-        file2 = pairs[1]
-        expected_result = pairs[2]
+    try:
+        for pairs in IMAGE_PAIRS:
+            file1 = pairs[0]
+            file2 = pairs[1]
+            expected_result = pairs[2]
 
-        try:
-            image1 = Image.open(test_image_path + file1)
-            image2 = Image.open(test_image_path + file2)
-        except (IOError, OSError) as error_msg:
             try:
-                image1.close()
-                image2.close()
-            except Exception:  # pylint: disable=broad-except
+                image1 = Image.open(test_image_path + file1)
+                image2 = Image.open(test_image_path + file2)
+            except (IOError, OSError) as error_msg:
+                try:
+                    image1.close()
+                    image2.close()
+                except Exception:  # pylint: disable=broad-except
+                    continue
+                print(error_msg)  # pylint: disable=superfluous-parens
                 continue
-            print(error_msg)  # pylint: disable=superfluous-parens
-            continue
 
-        aspect_ratio = image1.width / image1.height
-        # Hash size as (width, height)
-        hash_size = [8 * aspect_ratio, 8]
-        # Round down width to multiple of 2
-        hash_size[0] = int(hash_size[0] - hash_size[0] % 2)
+            aspect_ratio = image1.width / image1.height
+            # Hash size as (width, height)
+            hash_size = [8 * aspect_ratio, 8]
+            # Round down width to multiple of 2
+            hash_size[0] = int(hash_size[0] - hash_size[0] % 2)
 
-        image1, filtered_image1 = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
-            image1, image1.size
-        )
-        hash1 = detector.UpNextDetector._create_hash(image1, hash_size)  # pylint: disable=protected-access
-        filtered_hash1 = detector.UpNextDetector._create_hash(   # pylint: disable=protected-access
-            filtered_image1, hash_size
-        )
+            image1, filtered_image1 = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
+                image1, image1.size
+            )
+            hash1 = detector.UpNextDetector._create_hash(image1, hash_size)  # pylint: disable=protected-access
+            filtered_hash1 = detector.UpNextDetector._create_hash(   # pylint: disable=protected-access
+                filtered_image1, hash_size
+            )
 
-        image2, filtered_image2 = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
-            image2, image2.size
-        )
-        hash2 = detector.UpNextDetector._create_hash(image2, hash_size)  # pylint: disable=protected-access
-        filtered_hash2 = detector.UpNextDetector._create_hash(  # pylint: disable=protected-access
-            filtered_image2, hash_size
-        )
+            image2, filtered_image2 = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
+                image2, image2.size
+            )
+            hash2 = detector.UpNextDetector._create_hash(image2, hash_size)  # pylint: disable=protected-access
+            filtered_hash2 = detector.UpNextDetector._create_hash(  # pylint: disable=protected-access
+                filtered_image2, hash_size
+            )
 
-        similarity_0 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
-            hash1, hash2
-        )
-        similarity_1 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
-            hash1, hash2, filtered_hash2
-        )
-        similarity_2 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
-            hash2, hash1, filtered_hash1
-        )
-        similarity_3 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
-            filtered_hash1, filtered_hash2
-        )
-        similarity = max(similarity_0, similarity_1, similarity_2)
-        is_match = similarity >= match_level
-
-        if is_match is expected_result:
-            matches += 1
-        else:
-            result_summary = (
-                'Comparing: {0} & {1}, '
-                'similarity: {2:2.1f}% / {3:2.1f}% / {4:2.1f}% / {5:2.1f}%, '
-                'matched: {6}, actual: {7}'
+            similarity_0 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+                hash1, hash2
             )
-            detector.UpNextDetector._print_hashes(  # pylint: disable=protected-access
-                [hash1, hash2, filtered_hash1, filtered_hash2],
-                size=hash_size,
-                prefix=result_summary.format(
-                    file1,
-                    file2,
-                    similarity_0,
-                    similarity_1,
-                    similarity_2,
-                    similarity_3,
-                    is_match,
-                    expected_result
-                )
+            similarity_1 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+                hash1, hash2, filtered_hash2
+            )
+            similarity_2 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+                hash2, hash1, filtered_hash1
             )
+            similarity_3 = detector.UpNextDetector._hash_similarity(  # pylint: disable=protected-access
+                filtered_hash1, filtered_hash2
+            )
+            similarity = max(similarity_0, similarity_1, similarity_2)
+            is_match = similarity >= match_level
+
+            if is_match is expected_result:
+                matches += 1
+            else:
+                result_summary = (
+                    'Comparing: {0} & {1}, '
+                    'similarity: {2:2.1f}% / {3:2.1f}% / {4:2.1f}% / {5:2.1f}%, '
+                    'matched: {6}, actual: {7}'
+                )
+                detector.UpNextDetector._print_hashes(  # pylint: disable=protected-access
+                    [hash1, hash2, filtered_hash1, filtered_hash2],
+                    size=hash_size,
+                    prefix=result_summary.format(
+                        file1,
+                        file2,
+                        similarity_0,
+                        similarity_1,
+                        similarity_2,
+                        similarity_3,
+                        is_match,
+                        expected_result
+                    )
+                )
 
-        if is_match and not expected_result:
-            false_positives += 1
-            false_positives_deviation += similarity - match_level
-        if not is_match and expected_result:
-            false_negatives += 1
-            false_negatives_deviation += match_level - similarity
+            if is_match and not expected_result:
+                false_positives += 1
+                false_positives_deviation += similarity - match_level
+            if not is_match and expected_result:
+                false_negatives += 1
+                false_negatives_deviation += match_level - similarity
+    finally:
+        detector.SETTINGS.detector_prefilter = prefilter
 
     num_pairs = len(IMAGE_PAIRS)
     percent_matched_correctly = 100 * matches / len(IMAGE_PAIRS)
@@ -4,12 +4,18 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import os
+import shutil
+import tempfile
+
 import api
+import constants
 import dummydata
 import plugin
 import script
 import upnext
 import utils
+from settings import SETTINGS
 
 SKIP_TEST_ALL = False
 SKIP_TEST_POPUP = False
@@ -93,6 +99,18 @@ def test_overall():
         assert True
         return
 
-    test_run = script.run(['', 'test_upnext', 'upnext'])
-    test_complete = test_run.waitForAbort()
+    # Save detector hashes, capture profile and metrics outside of the source
+    # tree, so that results do not depend on previous test runs
+    save_path = SETTINGS.detector_save_path
+    SETTINGS.detector_save_path = tempfile.mkdtemp() + os.sep
+    try:
+        test_run = script.run(['', 'test_upnext', 'upnext'])
+        test_complete = test_run.waitForAbort()
+        saved_metrics = os.path.exists(
+            SETTINGS.detector_save_path + constants.DETECTOR_METRICS
+        )
+    finally:
+        shutil.rmtree(SETTINGS.detector_save_path, ignore_errors=True)
+        SETTINGS.detector_save_path = save_path
     assert test_complete is True
+    assert saved_metrics